@@ -0,0 +1,67 @@
+# Общие части скриптов замеров и проверок.
+import os
+import sys
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Any, Dict, List, Type
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+SOLUTION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# Добавляет src сервиса в sys.path. Копии lib в сервисах различаются, поэтому скрипт, которому нужны
+# два сервиса, запускает каждый в отдельном процессе.
+def use_service(service: str) -> None:
+    sys.path.insert(0, os.path.join(SOLUTION_PATH, f'service_{service}', 'src'))
+
+
+# Заменяет PgConnect: репозиториям нужен только метод connection(), по соединению на поток.
+class DsnPool:
+    def __init__(self,
+                 dsn: str,
+                 size: int = 1,
+                 connection_class: Type[psycopg.Connection] = psycopg.Connection,
+                 **kwargs: Any
+                 ) -> None:
+        self._pool = ConnectionPool(dsn, min_size=size, max_size=size, open=True,
+                                    connection_class=connection_class, kwargs=kwargs)
+
+    @contextmanager
+    def connection(self):
+        with self._pool.connection() as conn:
+            yield conn
+
+    def close(self) -> None:
+        self._pool.close()
+
+
+# Синтетические заказы в формате сообщений STG-Service: пользователи, продукты и рестораны повторяются по кругу.
+def get_order_messages(first_order_id: int,
+                       size: int,
+                       users: int = 1000,
+                       products: int = 500,
+                       products_per_order: int = 3
+                       ) -> List[Dict]:
+    return [
+        {
+            'object_id': str(order_id),
+            'object_type': 'order',
+            'payload': {
+                'id': str(order_id),
+                'date': '2022-05-01 12:00:00',
+                'cost': Decimal(300),
+                'payment': Decimal(300),
+                'status': 'CLOSED',
+                'restaurant': {'id': f'bench_restaurant_{order_id % 10}', 'name': 'Restaurant'},
+                'user': {'id': f'bench_user_{order_id % users}', 'name': 'User', 'login': 'login'},
+                'products': [
+                    {'id': f'bench_product_{(order_id + k) % products}', 'name': 'Product',
+                     'category': f'category_{k}', 'price': Decimal(100), 'quantity': 1}
+                    for k in range(products_per_order)
+                ]
+            }
+        }
+        for order_id in range(first_order_id, first_order_id + size)
+    ]
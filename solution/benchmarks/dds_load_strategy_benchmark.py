@@ -0,0 +1,71 @@
+# Сравнение стратегий загрузки батча в DDS: временные таблицы (temp_table) против одного запроса
+# с unnest() и data-modifying CTE (cte). Для каждой стратегии грузятся новые заказы, затем те же заказы повторно
+# (повтор - основной случай при перечитывании топика), и выводится число заказов в секунду.
+# Дополнительно выводится прирост строк pg_attribute: временные таблицы добавляют и удаляют их на каждый батч.
+#
+# Схема должна быть создана скриптом ddl.sql. Заказы пишутся в dds с load_src = 'benchmark'.
+#
+# Запуск:
+#   PG_DSN="host=... port=6432 dbname=... user=... password=... sslmode=require" \
+#       python dds_load_strategy_benchmark.py 10 100 1000
+import os
+import sys
+import time
+from typing import List
+
+from common import DsnPool, get_order_messages, use_service
+
+use_service('dds')
+
+from dds_loader.repository.dds_repository import DdsRepository  # noqa: E402
+from dds_loader.repository.model import InputMessage  # noqa: E402
+
+DEFAULT_BATCH_SIZES = [1, 10, 100, 1000]
+STRATEGIES = ['temp_table', 'cte']
+BATCHES = 20
+
+
+def get_messages(first_order_id: int, size: int) -> List[InputMessage]:
+    return [InputMessage.parse_obj(message) for message in get_order_messages(first_order_id, size)]
+
+
+# Статистика pg_stat сбрасывается из сессии асинхронно, pg_stat_force_next_flush() есть в Postgres 15+.
+def get_catalog_rows(db: DsnPool) -> int:
+    with db.connection() as conn:
+        conn.execute("SELECT pg_stat_force_next_flush()")
+    with db.connection() as conn:
+        conn.execute("SELECT pg_stat_clear_snapshot()")
+        return conn.execute("SELECT n_tup_ins FROM pg_stat_sys_tables WHERE relname = 'pg_attribute'").fetchone()[0]
+
+
+def measure(repository: DdsRepository, batches: List[List[InputMessage]]) -> float:
+    started = time.perf_counter()
+    for batch in batches:
+        repository.save_messages(batch)
+    return sum(len(batch) for batch in batches) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    batch_sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_BATCH_SIZES
+    db = DsnPool(os.environ['PG_DSN'])
+    with db.connection() as conn:
+        first_order_id = conn.execute("SELECT COALESCE(MAX(order_id), 0) + 1 FROM dds.h_order").fetchone()[0]
+
+    print(f"{'rows':>6} {'strategy':>11} {'new orders/s':>13} {'repeat orders/s':>16} {'pg_attribute rows':>18}")
+    for size in batch_sizes:
+        for strategy in STRATEGIES:
+            repository = DdsRepository(db, 'CLOSED', 'benchmark', strategy)
+            batches = [get_messages(first_order_id + i * size, size) for i in range(BATCHES)]
+            first_order_id += BATCHES * size
+
+            catalog_rows = get_catalog_rows(db)
+            new_rate = measure(repository, batches)
+            repeat_rate = measure(repository, batches)
+            catalog_rows = get_catalog_rows(db) - catalog_rows
+            print(f"{size:>6} {strategy:>11} {new_rate:>13.0f} {repeat_rate:>16.0f} {catalog_rows:>18}")
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
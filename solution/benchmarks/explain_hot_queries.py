@@ -0,0 +1,344 @@
+# Проверка планов горячих запросов DdsRepository и CdmRepository на большом объеме данных.
+# Скрипт пересоздает схемы stg, dds и cdm скриптом ddl.sql, заполняет DDS и CDM синтетическими заказами
+# и выполняет методы репозиториев (запись батча в DDS обеими стратегиями и в CDM, чтения API витрин),
+# снимая EXPLAIN с каждого запроса перед его выполнением.
+# Если какой-то запрос читает большую таблицу последовательным сканированием, скрипт завершается с кодом 1.
+#
+# Запросы DDS и CDM проверяются в отдельных процессах.
+# Сообщения для CDM процесс DDS передает через временный файл.
+# Схемы stg, dds и cdm удаляются целиком - запускать только на локальной базе.
+#
+# Запуск:
+#   PG_DSN="host=localhost port=5432 dbname=postgres user=postgres password=..." \
+#       python explain_hot_queries.py 1000000
+#   python explain_hot_queries.py 1000000 --reuse   # не пересоздавать данные, только проверить планы
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Callable, Dict, List
+
+import psycopg
+
+from common import SOLUTION_PATH, DsnPool, use_service
+
+SERVICES = ['dds', 'cdm']
+
+DEFAULT_ORDERS = 1000000
+PRODUCTS_PER_ORDER = 3
+ORDERS_PER_USER = 10
+PRODUCTS = 5000
+CATEGORIES = 50
+RESTAURANTS = 200
+BATCH_SIZE = 100
+FINAL_STATUS = 'CLOSED'
+LOAD_SRC = 'explain-hot-queries'
+
+# Последовательное сканирование таблицы меньшего размера считается нормальным планом.
+SEQ_SCAN_MIN_ROWS = 50000
+
+SYNTHETIC_DATA_SQL = """
+    INSERT INTO dds.h_user (h_user_pk, user_id, load_dt, load_src)
+    SELECT md5('user_' || i)::UUID, 'user_' || i, NOW(), %(load_src)s
+    FROM generate_series(1, %(users)s) AS i;
+
+    INSERT INTO dds.s_user_names (hk_user_names_pk, h_user_pk, username, userlogin, hashdiff, load_dt, load_src)
+    SELECT md5('user_' || i)::UUID, md5('user_' || i)::UUID, 'User ' || i, 'login_' || i,
+           md5('User ' || i || '||' || 'login_' || i)::UUID, NOW(), %(load_src)s
+    FROM generate_series(1, %(users)s) AS i;
+
+    INSERT INTO dds.h_restaurant (h_restaurant_pk, restaurant_id, load_dt, load_src)
+    SELECT md5('restaurant_' || i)::UUID, 'restaurant_' || i, NOW(), %(load_src)s
+    FROM generate_series(0, %(restaurants)s - 1) AS i;
+
+    INSERT INTO dds.s_restaurant_names (hk_restaurant_names_pk, h_restaurant_pk, name, hashdiff, load_dt, load_src)
+    SELECT md5('restaurant_' || i)::UUID, md5('restaurant_' || i)::UUID, 'Restaurant ' || i,
+           md5('Restaurant ' || i)::UUID, NOW(), %(load_src)s
+    FROM generate_series(0, %(restaurants)s - 1) AS i;
+
+    INSERT INTO dds.h_category (h_category_pk, category_name, load_dt, load_src)
+    SELECT md5('category_' || i)::UUID, 'category_' || i, NOW(), %(load_src)s
+    FROM generate_series(0, %(categories)s - 1) AS i;
+
+    INSERT INTO dds.h_product (h_product_pk, product_id, load_dt, load_src)
+    SELECT md5('product_' || i)::UUID, 'product_' || i, NOW(), %(load_src)s
+    FROM generate_series(0, %(products)s - 1) AS i;
+
+    INSERT INTO dds.s_product_names (hk_product_names_pk, h_product_pk, name, hashdiff, load_dt, load_src)
+    SELECT md5('product_' || i)::UUID, md5('product_' || i)::UUID, 'Product ' || i,
+           md5('Product ' || i)::UUID, NOW(), %(load_src)s
+    FROM generate_series(0, %(products)s - 1) AS i;
+
+    INSERT INTO dds.l_product_category (hk_product_category_pk, h_product_pk, h_category_pk, load_dt, load_src)
+    SELECT md5('product_' || i || '||' || 'category_' || i %% %(categories)s)::UUID,
+           md5('product_' || i)::UUID, md5('category_' || i %% %(categories)s)::UUID, NOW(), %(load_src)s
+    FROM generate_series(0, %(products)s - 1) AS i;
+
+    INSERT INTO dds.l_product_restaurant (hk_product_restaurant_pk, h_product_pk, h_restaurant_pk, load_dt, load_src)
+    SELECT md5('product_' || i || '||' || 'restaurant_' || i %% %(restaurants)s)::UUID,
+           md5('product_' || i)::UUID, md5('restaurant_' || i %% %(restaurants)s)::UUID, NOW(), %(load_src)s
+    FROM generate_series(0, %(products)s - 1) AS i;
+
+    INSERT INTO dds.h_order (h_order_pk, order_id, order_dt, load_dt, load_src)
+    SELECT md5(i::VARCHAR)::UUID, i, NOW() - (i %% 10000) * INTERVAL '1 minute', NOW(), %(load_src)s
+    FROM generate_series(1, %(orders)s) AS i;
+
+    INSERT INTO dds.s_order_status (hk_order_status_pk, h_order_pk, status, hashdiff, load_dt, load_src)
+    SELECT md5(i::VARCHAR)::UUID, md5(i::VARCHAR)::UUID, s.status, md5(s.status)::UUID, NOW(), %(load_src)s
+    FROM generate_series(1, %(orders)s) AS i
+             CROSS JOIN LATERAL (SELECT CASE WHEN i %% 10 = 0 THEN 'CANCELLED' ELSE 'CLOSED' END AS status) AS s;
+
+    INSERT INTO dds.s_order_cost (hk_order_cost_pk, h_order_pk, cost, payment, hashdiff, load_dt, load_src)
+    SELECT md5(i::VARCHAR)::UUID, md5(i::VARCHAR)::UUID, 300, 300, md5('300.00000||300.00000')::UUID, NOW(),
+           %(load_src)s
+    FROM generate_series(1, %(orders)s) AS i;
+
+    INSERT INTO dds.l_order_user (hk_order_user_pk, h_order_pk, h_user_pk, load_dt, load_src)
+    SELECT md5(i || '||' || 'user_' || (i %% %(users)s + 1))::UUID, md5(i::VARCHAR)::UUID,
+           md5('user_' || (i %% %(users)s + 1))::UUID, NOW(), %(load_src)s
+    FROM generate_series(1, %(orders)s) AS i;
+
+    INSERT INTO dds.l_order_product (hk_order_product_pk, h_order_pk, h_product_pk, load_dt, load_src)
+    SELECT md5(i || '||' || 'product_' || p.n)::UUID, md5(i::VARCHAR)::UUID, md5('product_' || p.n)::UUID, NOW(),
+           %(load_src)s
+    FROM generate_series(1, %(orders)s) AS i
+             CROSS JOIN LATERAL (SELECT DISTINCT (i * 31 + k * 997) %% %(products)s AS n
+                                 FROM generate_series(1, %(products_per_order)s) AS k) AS p;
+
+    INSERT INTO cdm.applied_orders (order_id, user_id, applied_dt)
+    SELECT i, md5('user_' || (i %% %(users)s + 1))::UUID, NOW()
+    FROM generate_series(1, %(orders)s) AS i
+    WHERE i %% 10 <> 0;
+
+    INSERT INTO cdm.user_product_counters (user_id, product_id, product_name, order_cnt)
+    SELECT lou.h_user_pk, lop.h_product_pk, 'Product', COUNT(*)
+    FROM dds.l_order_user AS lou
+             JOIN dds.l_order_product AS lop ON lou.h_order_pk = lop.h_order_pk
+    GROUP BY lou.h_user_pk, lop.h_product_pk;
+
+    INSERT INTO cdm.user_category_counters (user_id, category_id, category_name, order_cnt)
+    SELECT upc.user_id, lpc.h_category_pk, 'Category', SUM(upc.order_cnt)
+    FROM cdm.user_product_counters AS upc
+             JOIN dds.l_product_category AS lpc ON upc.product_id = lpc.h_product_pk
+    GROUP BY upc.user_id, lpc.h_category_pk;
+
+    INSERT INTO cdm.product_counters (product_id, product_name, order_cnt)
+    SELECT product_id, 'Product', SUM(order_cnt)
+    FROM cdm.user_product_counters
+    GROUP BY product_id;
+
+    INSERT INTO cdm.category_counters (category_id, category_name, order_cnt)
+    SELECT category_id, 'Category', SUM(order_cnt)
+    FROM cdm.user_category_counters
+    GROUP BY category_id;
+
+    INSERT INTO cdm.daily_product_counters (order_date, product_id, product_name, order_cnt)
+    SELECT ho.order_dt::DATE, lop.h_product_pk, 'Product', COUNT(*)
+    FROM dds.h_order AS ho
+             JOIN dds.l_order_product AS lop ON ho.h_order_pk = lop.h_order_pk
+    GROUP BY ho.order_dt::DATE, lop.h_product_pk;
+
+    INSERT INTO cdm.daily_category_counters (order_date, category_id, category_name, order_cnt)
+    SELECT dpc.order_date, lpc.h_category_pk, 'Category', SUM(dpc.order_cnt)
+    FROM cdm.daily_product_counters AS dpc
+             JOIN dds.l_product_category AS lpc ON dpc.product_id = lpc.h_product_pk
+    GROUP BY dpc.order_date, lpc.h_category_pk;
+"""
+
+
+# Курсор, который снимает план с запроса в момент, когда репозиторий его выполняет, с теми же параметрами.
+# Репозитории выполняют по одному запросу на execute(); DDL и COPY планов не имеют и не проверяются.
+class ExplainCursor(psycopg.Cursor):
+    plans: List[Dict] = []
+
+    def execute(self, query, params=None, **kwargs):
+        statement = str(query).strip()
+        if statement.upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            with psycopg.Cursor(self.connection) as cur:
+                cur.execute(f"EXPLAIN (FORMAT JSON) {statement}", params)
+                self.plans.append({'statement': statement, 'plan': cur.fetchone()[0][0]['Plan']})
+        return super().execute(query, params, **kwargs)
+
+
+# Соединение без pipeline-режима: запросы, которые репозитории отправляют в pipeline, выполняются по одному,
+# и EXPLAIN выполняется сразу перед своим запросом, когда временные таблицы уже заполнены.
+class ExplainConnection(psycopg.Connection):
+    @contextmanager
+    def pipeline(self):
+        yield None
+
+
+def load_synthetic_data(dsn: str, orders: int) -> None:
+    with psycopg.connect(dsn) as conn:
+        started = time.perf_counter()
+        conn.execute("DROP SCHEMA IF EXISTS stg, dds, cdm CASCADE; CREATE SCHEMA stg; CREATE SCHEMA dds; CREATE SCHEMA cdm;")
+        conn.execute(open(os.path.join(SOLUTION_PATH, 'ddl.sql')).read())
+        with conn.cursor() as cur:
+            for statement in SYNTHETIC_DATA_SQL.split(';'):
+                if statement.strip():
+                    cur.execute(statement, {
+                        'orders': orders,
+                        'users': max(orders // ORDERS_PER_USER, 1),
+                        'products': PRODUCTS,
+                        'categories': CATEGORIES,
+                        'restaurants': RESTAURANTS,
+                        'products_per_order': PRODUCTS_PER_ORDER,
+                        'load_src': LOAD_SRC
+                    })
+        print(f"loaded {orders} orders in {time.perf_counter() - started:.0f}s")
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute("VACUUM ANALYZE")
+
+
+def get_message(order_id: int, users: int, status: str) -> Dict:
+    products = sorted({(order_id * 31 + k * 997) % PRODUCTS for k in range(1, PRODUCTS_PER_ORDER + 1)})
+    return {
+        'object_id': str(order_id),
+        'object_type': 'order',
+        'payload': {
+            'id': str(order_id),
+            'date': '2022-05-01 12:00:00',
+            'cost': Decimal(300),
+            'payment': Decimal(300),
+            'status': status,
+            'restaurant': {'id': f'restaurant_{products[0] % RESTAURANTS}', 'name': 'Restaurant'},
+            'user': {'id': f'user_{order_id % users + 1}', 'name': 'User', 'login': 'login'},
+            'products': [
+                {'id': f'product_{n}', 'name': f'Product {n}', 'category': f'category_{n % CATEGORIES}',
+                 'price': Decimal(100), 'quantity': 1}
+                for n in products
+            ]
+        }
+    }
+
+
+# Горячие запросы DDS-Service. Полная статистика и приращение последнего заказа сохраняются в cdm_messages_path
+# через тот же кодек, что и в Kafka.
+def run_dds_queries(db: DsnPool, orders: int, cdm_messages_path: str) -> None:
+    use_service('dds')
+    from dds_loader.repository.dds_repository import DdsRepository
+    from dds_loader.repository.hash_key import hash_key
+    from dds_loader.repository.model import InputMessage
+    from lib.kafka_connect import codec
+
+    users = max(orders // ORDERS_PER_USER, 1)
+    dds_repository = DdsRepository(db, FINAL_STATUS, LOAD_SRC)
+
+    # Половина батча - уже загруженные заказы со сменой статуса, половина - новые.
+    messages = [get_message(order_id, users, 'CANCELLED') for order_id in range(1, BATCH_SIZE // 2 + 1)]
+    messages += [get_message(orders + order_id, users, FINAL_STATUS) for order_id in range(1, BATCH_SIZE // 2 + 1)]
+    messages = [InputMessage.parse_obj(message) for message in messages]
+    dds_repository.save_messages(messages)
+    # Те же сообщения стратегией cte: повторная загрузка ничего не меняет, но планы запроса снимаются.
+    DdsRepository(db, FINAL_STATUS, LOAD_SRC, 'cte').save_messages(messages)
+
+    order = messages[-1].payload
+    with open(cdm_messages_path, 'wb') as f:
+        f.write(codec.dumps({
+            'user_id': hash_key(order.user.id),
+            'messages': [
+                dds_repository.get_user_stats(order.user),
+                {
+                    'order_id': int(order.id),
+                    'user_id': hash_key(order.user.id),
+                    'order_dt': order.date,
+                    'stats': dds_repository.get_order_stats(order)
+                }
+            ]
+        }))
+
+
+# Горячие запросы CDM-Service: запись сообщений из DDS и чтения API витрин.
+def run_cdm_queries(db: DsnPool, cdm_messages_path: str) -> None:
+    use_service('cdm')
+    from cdm_loader.repository.cdm_repository import CdmRepository
+    from lib.kafka_connect import codec
+
+    cdm_repository = CdmRepository(db)
+    with open(cdm_messages_path, 'rb') as f:
+        data = codec.loads(f.read())
+    for message in data['messages']:
+        cdm_repository.save_message(message)
+
+    cdm_repository.get_user_products(uuid.UUID(data['user_id']))
+    cdm_repository.get_user_categories(uuid.UUID(data['user_id']))
+    for days in (None, 7):
+        cdm_repository.get_top_products(10, days)
+        cdm_repository.get_top_categories(10, days)
+
+
+def get_seq_scans(plan: Dict, large_tables: Dict[str, float]) -> List[str]:
+    scans = []
+    if plan['Node Type'] == 'Seq Scan' and plan['Relation Name'] in large_tables:
+        scans.append(f"{plan['Relation Name']} (~{large_tables[plan['Relation Name']]:.0f} rows)")
+    for child in plan.get('Plans', []):
+        scans += get_seq_scans(child, large_tables)
+    return scans
+
+
+# Выполняет запросы сервиса, снимая с них планы, и возвращает число запросов с последовательным сканированием.
+def check_plans(dsn: str, run_queries: Callable[[DsnPool], None]) -> int:
+    with psycopg.connect(dsn) as conn:
+        large_tables = dict(conn.execute(
+            """
+                SELECT c.relname, c.reltuples
+                FROM pg_class AS c
+                         JOIN pg_namespace AS n ON c.relnamespace = n.oid
+                WHERE n.nspname IN ('dds', 'cdm')
+                  AND c.relkind = 'r'
+                  AND c.reltuples >= %(min_rows)s
+            """,
+            {'min_rows': SEQ_SCAN_MIN_ROWS}
+        ).fetchall())
+
+    ExplainCursor.plans = []
+    db = DsnPool(dsn, 1, ExplainConnection, cursor_factory=ExplainCursor, prepare_threshold=None)
+    run_queries(db)
+    db.close()
+
+    failed = 0
+    for explained in ExplainCursor.plans:
+        seq_scans = get_seq_scans(explained['plan'], large_tables)
+        summary = ' '.join(explained['statement'].split())[:100]
+        if seq_scans:
+            failed += 1
+            print(f"FAIL {summary}\n     seq scan: {', '.join(seq_scans)}")
+        else:
+            print(f"ok   {summary}")
+
+    print(f"{len(ExplainCursor.plans)} statements, {failed} with sequential scans of large tables", flush=True)
+    return failed
+
+
+def main() -> None:
+    dsn = os.environ['PG_DSN']
+    # Процесс одного сервиса: explain_hot_queries.py --service <dds|cdm> <orders> <cdm_messages_path>
+    if '--service' in sys.argv:
+        service, orders, cdm_messages_path = sys.argv[sys.argv.index('--service') + 1:][:3]
+        if service == 'dds':
+            failed = check_plans(dsn, lambda db: run_dds_queries(db, int(orders), cdm_messages_path))
+        else:
+            failed = check_plans(dsn, lambda db: run_cdm_queries(db, cdm_messages_path))
+        sys.exit(1 if failed else 0)
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    orders = int(args[0]) if args else DEFAULT_ORDERS
+
+    if '--reuse' not in sys.argv:
+        load_synthetic_data(dsn, orders)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cdm_messages_path = os.path.join(tmp, 'cdm_messages.json')
+        failed = [
+            service for service in SERVICES
+            if subprocess.run([sys.executable, __file__, '--service', service, str(orders), cdm_messages_path]).returncode
+        ]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# Проверка того, что дорожки KeyedWorkerPool в DDS-Service и CDM-Service идемпотентны при перечитывании батча.
+# Дорожки пишут независимыми транзакциями, а офсеты коммитятся один раз на батч: если одна дорожка упала,
+# записи остальных уже зафиксированы, а батч перечитывается и применяется целиком еще раз.
+# Скрипт прогоняет одни и те же батчи через процессор дважды: без сбоев и с ошибкой в одной дорожке (до или после
+# ее записи в Postgres) и повторной обработкой батча - и сравнивает таблицы схемы и набор отправленных сообщений.
+# Отправленные сообщения при перечитывании дублируются, дубли следующий сервис применяет идемпотентно.
+#
+# Каждый сервис проверяется в отдельном процессе.
+# Схемы stg, dds и cdm пересоздаются скриптом ddl.sql - запускать только на локальной базе.
+#
+# Запуск:
+#   PG_DSN="host=localhost port=5432 dbname=postgres user=postgres password=..." \
+#       python replay_idempotency_check.py
+import logging
+import os
+import random
+import subprocess
+import sys
+import uuid
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import psycopg
+
+from common import SOLUTION_PATH, DsnPool, use_service
+
+SERVICES = ['dds', 'cdm']
+THREADS = 4
+BATCH_SIZE = 40
+ORDERS = 200
+USERS = 15
+PRODUCTS = 30
+FINAL_STATUS = 'CLOSED'
+# Колонки со временем загрузки и суррогатные ключи при повторе законно отличаются.
+IGNORED_COLUMNS = ('load_dt', 'applied_dt', 'id')
+
+
+class InjectedFault(Exception):
+    pass
+
+
+# Топик в памяти: батчи читаются по очереди, rewind возвращает к первому незакоммиченному батчу.
+class ReplayConsumer:
+    def __init__(self, codec: Any, batches: List[List[Any]]) -> None:
+        self._codec = codec
+        self._batches = batches
+        self._next = 0
+        self._committed = 0
+
+    def consume_batch(self, max_messages: int, timeout: float = 3.0) -> List[Any]:
+        if self._next >= len(self._batches):
+            return []
+        self._next += 1
+        return [self._codec.loads(self._codec.dumps(message)) for message in self._batches[self._next - 1]]
+
+    def commit(self, asynchronous: bool = None) -> None:
+        self._committed = self._next
+
+    def rewind(self) -> None:
+        self._next = self._committed
+
+    # Партиций в памяти нет, ребалансировки не бывает.
+    def on_revoke(self, callback: Any) -> None:
+        pass
+
+
+# Сообщения сохраняются в сериализованном виде, строки полной статистики - в порядке сортировки:
+# запрос статистики пользователя не упорядочивает строки.
+class MemoryProducer:
+    def __init__(self, codec: Any) -> None:
+        self._codec = codec
+        self.sent: List[Tuple[str, bytes]] = []
+
+    def produce(self, payload: Any, key: str = None) -> None:
+        if isinstance(payload, list):
+            payload = sorted(payload, key=self._codec.dumps)
+        self.sent.append((key, self._codec.dumps(payload)))
+
+    def flush(self, timeout: float = 10) -> List[str]:
+        return []
+
+
+# Роняет первую дорожку, в которой есть сообщение с ключом fault_key: до записи или после нее.
+class FaultyRepository:
+    def __init__(self, repository: Any, get_key: Callable[[Any], str], fault_key: str, after_save: bool) -> None:
+        self._repository = repository
+        self._get_key = get_key
+        self._fault_key = fault_key
+        self._after_save = after_save
+        self.faults = 0
+
+    def save_messages(self, messages: List[Any]) -> None:
+        armed = not self.faults and any(self._get_key(message) == self._fault_key for message in messages)
+        if armed and not self._after_save:
+            self.faults += 1
+            raise InjectedFault()
+        self._repository.save_messages(messages)
+        if armed:
+            self.faults += 1
+            raise InjectedFault()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._repository, name)
+
+
+def reset_schema(dsn: str) -> None:
+    with psycopg.connect(dsn) as conn:
+        conn.execute("DROP SCHEMA IF EXISTS stg, dds, cdm CASCADE; CREATE SCHEMA stg; CREATE SCHEMA dds; CREATE SCHEMA cdm;")
+        conn.execute(open(os.path.join(SOLUTION_PATH, 'ddl.sql')).read())
+
+
+def dump_schema(dsn: str, schema: str) -> Dict[str, List[Tuple]]:
+    with psycopg.connect(dsn) as conn:
+        tables = [table for table, in conn.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_schema = %(schema)s ORDER BY table_name",
+            {'schema': schema}
+        ).fetchall()]
+        dump = {}
+        for table in tables:
+            columns = [column for column, in conn.execute(
+                """
+                    SELECT column_name
+                    FROM information_schema.columns
+                    WHERE table_schema = %(schema)s AND table_name = %(table)s
+                    ORDER BY ordinal_position
+                """,
+                {'schema': schema, 'table': table}
+            ).fetchall() if column not in IGNORED_COLUMNS]
+            order_by = ', '.join(str(position) for position in range(1, len(columns) + 1))
+            dump[table] = conn.execute(f"SELECT {', '.join(columns)} FROM {schema}.{table} ORDER BY {order_by}").fetchall()
+        return dump
+
+
+# Обрабатывает все батчи; после ошибки процессор сам перематывает консьюмер, и батч читается снова.
+def run_processor(processor: Any) -> None:
+    while True:
+        try:
+            if not processor.run():
+                return
+        except InjectedFault:
+            pass
+
+
+def compare(name: str, clean: Tuple[Dict, Set], replayed: Tuple[Dict, Set]) -> bool:
+    failed = [table for table in clean[0] if clean[0][table] != replayed[0][table]]
+    if clean[1] != replayed[1]:
+        failed.append('sent messages')
+    print(f"{'ok  ' if not failed else 'FAIL'} {name}" + (f": {', '.join(failed)} differ" if failed else ''))
+    return not failed
+
+
+# Сначала версии OPEN всех заказов, затем итоговые. У части заказов в итоговой версии меняется пользователь.
+def get_dds_batches() -> List[List[Dict]]:
+    rnd = random.Random(1)
+    versions: Dict[str, List[Dict]] = {'OPEN': [], 'final': []}
+    for order_id in range(1, ORDERS + 1):
+        products = rnd.sample(range(PRODUCTS), 3)
+        for version, status in (('OPEN', 'OPEN'), ('final', FINAL_STATUS if order_id % 5 else 'CANCELLED')):
+            user_id = f'user_{(order_id + 1) % USERS}' if version == 'final' and order_id % 17 == 0 \
+                else f'user_{order_id % USERS}'
+            versions[version].append({
+                'object_id': str(order_id),
+                'object_type': 'order',
+                'payload': {
+                    'id': str(order_id),
+                    'date': f'2023-01-{order_id % 28 + 1:02d} 12:00:00',
+                    'cost': 300,
+                    'payment': 300,
+                    'status': status,
+                    'restaurant': {'id': f'restaurant_{order_id % 3}', 'name': 'Restaurant'},
+                    'user': {'id': user_id, 'name': f'User {user_id}', 'login': user_id},
+                    'products': [
+                        {'id': f'product_{p}', 'name': f'Product {p}', 'category': f'category_{p % 5}', 'price': 100,
+                         'quantity': 1}
+                        for p in products
+                    ]
+                }
+            })
+    for messages in versions.values():
+        rnd.shuffle(messages)
+    messages = versions['OPEN'] + versions['final']
+    return [messages[i:i + BATCH_SIZE] for i in range(0, len(messages), BATCH_SIZE)]
+
+
+def check_dds(dsn: str) -> bool:
+    use_service('dds')
+    from dds_loader.dds_message_processor_job import DdsMessageProcessor
+    from dds_loader.repository.dds_repository import DdsRepository
+    from lib.kafka_connect import codec
+    from lib.worker import Coalescer, KeyedWorkerPool
+
+    def run(stats_mode: str, fault: str) -> Tuple[Dict, Set]:
+        reset_schema(dsn)
+        db = DsnPool(dsn, THREADS)
+        pool = KeyedWorkerPool(THREADS)
+        repository = DdsRepository(db, FINAL_STATUS, 'replay-check')
+        if fault != 'none':
+            repository = FaultyRepository(repository, lambda message: message.payload.user.id, 'user_1',
+                                          after_save=fault == 'after')
+        producer = MemoryProducer(codec)
+        run_processor(DdsMessageProcessor(ReplayConsumer(codec, get_dds_batches()), producer, repository, pool,
+                                          Coalescer(0, 1000), BATCH_SIZE, FINAL_STATUS, stats_mode,
+                                          logging.getLogger('replay-check')))
+        pool.close()
+        db.close()
+        if fault != 'none' and not repository.faults:
+            raise RuntimeError('no lane failed, check fault_key')
+        return dump_schema(dsn, 'dds'), set(producer.sent)
+
+    ok = True
+    for stats_mode in ('delta', 'snapshot'):
+        clean = run(stats_mode, 'none')
+        for fault in ('before', 'after'):
+            ok &= compare(f"dds {stats_mode}, lane fails {fault} save", clean, run(stats_mode, fault))
+    return ok
+
+
+# Приращения (часть заказов повторяется), затем полная статистика всех пользователей, затем снова приращения.
+def get_cdm_batches() -> List[List[Any]]:
+    rnd = random.Random(2)
+    users = [str(uuid.UUID(int=rnd.getrandbits(128))) for _ in range(USERS)]
+    products = [str(uuid.UUID(int=rnd.getrandbits(128))) for _ in range(PRODUCTS)]
+
+    def get_row(user_id: str, product: int, order_cnt: int) -> Dict:
+        return {
+            'user_id': user_id,
+            'product_id': products[product],
+            'product_name': f'Product {product}',
+            'category_id': products[product % 5],
+            'category_name': f'Category {product % 5}',
+            'order_cnt': order_cnt
+        }
+
+    deltas = []
+    for order_id in range(1, ORDERS + 1):
+        user_id = users[order_id % USERS]
+        deltas.append({
+            'order_id': order_id,
+            'order_dt': f'2023-01-{order_id % 28 + 1:02d}T12:00:00',
+            'user_id': user_id,
+            'stats': [get_row(user_id, product, 1) for product in rnd.sample(range(PRODUCTS), 3)]
+        })
+    deltas += rnd.sample(deltas, ORDERS // 10)
+    rnd.shuffle(deltas)
+
+    batches = [deltas[i:i + BATCH_SIZE] for i in range(0, len(deltas) // 2, BATCH_SIZE)]
+    snapshots = [
+        [get_row(user_id, product, rnd.randint(1, 5)) for product in rnd.sample(range(PRODUCTS), 4)]
+        for user_id in users
+    ]
+    # Полная статистика приходит двумя батчами, чтобы окно CDM-Service копило ее через границу батча.
+    batches += [snapshots[:USERS // 2], snapshots[USERS // 2:]]
+    batches += [deltas[i:i + BATCH_SIZE] for i in range(len(deltas) // 2, len(deltas), BATCH_SIZE)]
+    return batches
+
+
+def check_cdm(dsn: str) -> bool:
+    use_service('cdm')
+    from cdm_loader.cdm_message_processor_job import CdmMessageProcessor
+    from cdm_loader.counters_cache import CountersCache
+    from cdm_loader.repository.cdm_repository import CdmRepository
+    from lib.kafka_connect import codec
+    from lib.worker import Coalescer, KeyedWorkerPool
+
+    def get_user_id(message: Any) -> str:
+        return message[0]['user_id'] if isinstance(message, list) else message['user_id']
+
+    batches = get_cdm_batches()
+
+    # С окном дорожка падает при записи окна: после ошибки перечитываются все батчи окна.
+    def run(fault: str, window: float) -> Tuple[Dict, Set]:
+        reset_schema(dsn)
+        db = DsnPool(dsn, THREADS)
+        pool = KeyedWorkerPool(THREADS)
+        repository = CdmRepository(db)
+        counters_cache = CountersCache(repository, 100, 60)
+        if fault != 'none':
+            get_key = get_user_id if not window else \
+                lambda message: get_user_id(message) if isinstance(message, list) else None
+            repository = FaultyRepository(repository, get_key, get_user_id(batches[-1][0]),
+                                          after_save=fault == 'after')
+        run_processor(CdmMessageProcessor(ReplayConsumer(codec, batches), repository, counters_cache, pool,
+                                          Coalescer(window, USERS), BATCH_SIZE, logging.getLogger('replay-check')))
+        pool.close()
+        db.close()
+        if fault != 'none' and not repository.faults:
+            raise RuntimeError('no lane failed, check fault_key')
+        return dump_schema(dsn, 'cdm'), set()
+
+    ok = True
+    for window in (0, 3600):
+        clean = run('none', window)
+        for fault in ('before', 'after'):
+            ok &= compare(f"cdm, snapshot window {window}s, lane fails {fault} save", clean, run(fault, window))
+    return ok
+
+
+def main() -> None:
+    dsn = os.environ['PG_DSN']
+    if len(sys.argv) > 1:
+        service = sys.argv[1]
+        ok = check_dds(dsn) if service == 'dds' else check_cdm(dsn)
+        sys.exit(0 if ok else 1)
+
+    failed = [service for service in SERVICES if subprocess.run([sys.executable, __file__, service]).returncode]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
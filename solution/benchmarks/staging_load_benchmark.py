@@ -0,0 +1,87 @@
+# Сравнение скорости загрузки временных таблиц DDS-Service: executemany с построчными INSERT против бинарного COPY.
+# Таблицы temp_order и temp_order_items и их строки (хэш-ключи и hashdiff в uuid) строятся самим DdsRepository
+# по ORDER_COLUMNS и ITEM_COLUMNS, COPY выполняет его же __copy_rows. Размер батча задается в заказах,
+# скорость выводится в строках обеих таблиц в секунду.
+#
+# Запуск:
+#   PG_DSN="host=... port=6432 dbname=... user=... password=... sslmode=require" \
+#       python staging_load_benchmark.py 10 1000 10000
+import os
+import sys
+import time
+from typing import Callable, List, Tuple
+
+from psycopg import Cursor
+
+from common import DsnPool, get_order_messages, use_service
+
+use_service('dds')
+
+from dds_loader.repository.dds_repository import DdsRepository  # noqa: E402
+from dds_loader.repository.model import InputMessage  # noqa: E402
+
+DEFAULT_BATCH_SIZES = [10, 100, 1000, 10000]
+REPEATS = 3
+
+Tables = List[Tuple[str, List[Tuple[str, str]], List[Tuple]]]
+
+
+def get_tables(repository: DdsRepository, size: int) -> Tables:
+    orders = [InputMessage.parse_obj(message).payload for message in get_order_messages(1, size)]
+    return [
+        (DdsRepository.ORDER_TEMP_TABLE, DdsRepository.ORDER_COLUMNS, repository._DdsRepository__get_orders(orders)),
+        (DdsRepository.ITEMS_TEMP_TABLE, DdsRepository.ITEM_COLUMNS, repository._DdsRepository__get_items(orders))
+    ]
+
+
+def load_executemany(repository: DdsRepository, cur: Cursor, tables: Tables) -> None:
+    for temp_table, columns, rows in tables:
+        cur.executemany(
+            f"""
+                INSERT INTO {temp_table} ({", ".join(name for name, _ in columns)})
+                VALUES ({", ".join(f"%s::{pg_type}" for _, pg_type in columns)})
+            """,
+            rows
+        )
+
+
+def load_copy(repository: DdsRepository, cur: Cursor, tables: Tables) -> None:
+    for temp_table, columns, rows in tables:
+        repository._DdsRepository__copy_rows(cur, temp_table, columns, rows)
+
+
+def measure(db: DsnPool,
+            repository: DdsRepository,
+            load: Callable[[DdsRepository, Cursor, Tables], None],
+            tables: Tables) -> float:
+    best = float('inf')
+    for _ in range(REPEATS):
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                for temp_table, columns, _ in tables:
+                    repository._DdsRepository__create_temp_table(cur, temp_table, columns)
+                started = time.perf_counter()
+                load(repository, cur, tables)
+                best = min(best, time.perf_counter() - started)
+    return sum(len(rows) for _, _, rows in tables) / best
+
+
+def main() -> None:
+    batch_sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_BATCH_SIZES
+    db = DsnPool(os.environ['PG_DSN'])
+    repository = DdsRepository(db, 'CLOSED', 'benchmark')
+
+    print(f"{'orders':>8} {'rows':>8} {'executemany rows/s':>20} {'COPY rows/s':>14} {'speedup':>8}")
+    for size in batch_sizes:
+        tables = get_tables(repository, size)
+        rows = sum(len(rows) for _, _, rows in tables)
+        executemany_rate = measure(db, repository, load_executemany, tables)
+        copy_rate = measure(db, repository, load_copy, tables)
+        print(f"{size:>8} {rows:>8} {executemany_rate:>20.0f} {copy_rate:>14.0f} "
+              f"{copy_rate / executemany_rate:>7.1f}x")
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Пропускная способность DDS и CDM в зависимости от числа потоков обработки (WORKER_THREADS).
+# Батчи раскладываются по потокам по пользователю через KeyedWorkerPool, как в процессорах сервисов,
+# и выводится число заказов в секунду: для DDS - загрузка батча заказов, для CDM - применение приращений
+# статистики. Пока Postgres не нагружен, потоки прячут сетевые задержки и пропускная способность растет;
+# когда прирост прекращается, упираемся в сам Postgres. Оба сервиса пишут батч фиксированным числом запросов,
+# поэтому потоки ускоряют в основном обработку на стороне Postgres.
+#
+# Каждый сервис замеряется в отдельном процессе.
+# Схема должна быть создана скриптом ddl.sql. Заказы пишутся в dds с load_src = 'benchmark',
+# приращения - в cdm с номерами заказов после уже примененных.
+#
+# Запуск:
+#   PG_DSN="host=... port=6432 dbname=... user=... password=... sslmode=require" \
+#       python worker_threads_benchmark.py 1 2 4 8
+import os
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+from common import DsnPool, get_order_messages, use_service
+
+SERVICES = ['dds', 'cdm']
+DEFAULT_THREADS = [1, 2, 4, 8]
+BATCH_SIZE = 100
+BATCHES = 20
+USERS = 1000
+PRODUCTS = 500
+PRODUCTS_PER_ORDER = 3
+
+
+# Приращения в том виде, в котором CDM получает их из Kafka: UUID приходят строками.
+def get_deltas(first_order_id: int, size: int) -> List[Dict]:
+    return [
+        {
+            'order_id': order_id,
+            'order_dt': '2022-05-01T12:00:00',
+            'user_id': str(uuid.UUID(int=order_id % USERS)),
+            'stats': [
+                {
+                    'user_id': str(uuid.UUID(int=order_id % USERS)),
+                    'product_id': str(uuid.UUID(int=USERS + (order_id + k) % PRODUCTS)),
+                    'product_name': 'Product',
+                    'category_id': str(uuid.UUID(int=USERS + PRODUCTS + k)),
+                    'category_name': f'category_{k}',
+                    'order_cnt': 1
+                }
+                for k in range(PRODUCTS_PER_ORDER)
+            ]
+        }
+        for order_id in range(first_order_id, first_order_id + size)
+    ]
+
+
+def get_first_order_id(db: DsnPool, table: str) -> int:
+    with db.connection() as conn:
+        return conn.execute(f"SELECT COALESCE(MAX(order_id), 0) + 1 FROM {table}").fetchone()[0]
+
+
+# Заказов в секунду по числу потоков для одного сервиса, по строке "потоки скорость" на каждое число потоков.
+def run_service(service: str, thread_counts: List[int]) -> None:
+    use_service(service)
+    from lib.worker import KeyedWorkerPool
+
+    db = DsnPool(os.environ['PG_DSN'], max(thread_counts))
+    if service == 'dds':
+        from dds_loader.repository.dds_repository import DdsRepository
+        from dds_loader.repository.model import InputMessage
+
+        repository = DdsRepository(db, 'CLOSED', 'benchmark')
+        first_order_id = get_first_order_id(db, 'dds.h_order')
+
+        def get_batch(first_id: int) -> List:
+            return [InputMessage.parse_obj(message)
+                    for message in get_order_messages(first_id, BATCH_SIZE, USERS, PRODUCTS, PRODUCTS_PER_ORDER)]
+
+        def get_key(message) -> str:
+            return message.payload.user.id
+    else:
+        from cdm_loader.repository.cdm_repository import CdmRepository
+
+        repository = CdmRepository(db)
+        first_order_id = get_first_order_id(db, 'cdm.applied_orders')
+
+        def get_batch(first_id: int) -> List:
+            return get_deltas(first_id, BATCH_SIZE)
+
+        def get_key(delta) -> str:
+            return delta['user_id']
+
+    for threads in thread_counts:
+        pool = KeyedWorkerPool(threads)
+        batches = [get_batch(first_order_id + i * BATCH_SIZE) for i in range(BATCHES)]
+        first_order_id += BATCHES * BATCH_SIZE
+
+        started = time.perf_counter()
+        for batch in batches:
+            pool.map(batch, get_key, repository.save_messages)
+        rate = BATCHES * BATCH_SIZE / (time.perf_counter() - started)
+
+        pool.close()
+        print(f"{threads} {rate:.0f}", flush=True)
+
+    db.close()
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in SERVICES:
+        run_service(sys.argv[1], [int(arg) for arg in sys.argv[2:]])
+        return
+
+    thread_counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_THREADS
+    rates = {}
+    for service in SERVICES:
+        output = subprocess.run([sys.executable, __file__, service, *map(str, thread_counts)],
+                                check=True, capture_output=True, text=True).stdout
+        rates[service] = dict(line.split() for line in output.splitlines())
+
+    print(f"{'threads':>7} {'DDS orders/s':>13} {'CDM orders/s':>13}")
+    for threads in thread_counts:
+        print(f"{threads:>7} {rates['dds'][str(threads)]:>13} {rates['cdm'][str(threads)]:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,61 @@ CREATE TABLE IF NOT EXISTS cdm.user_category_counters
     UNIQUE (user_id, category_id)
 );
 
+DROP TABLE IF EXISTS cdm.applied_orders;
+
+CREATE TABLE IF NOT EXISTS cdm.applied_orders
+(
+    order_id   INT PRIMARY KEY,
+    user_id    UUID      NOT NULL,
+    applied_dt TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS applied_orders_applied_dt_idx ON cdm.applied_orders (applied_dt);
+
+DROP TABLE IF EXISTS cdm.product_counters;
+
+CREATE TABLE IF NOT EXISTS cdm.product_counters
+(
+    product_id   UUID PRIMARY KEY,
+    product_name VARCHAR NOT NULL,
+    order_cnt    INT     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS product_counters_order_cnt_idx ON cdm.product_counters (order_cnt DESC);
+
+DROP TABLE IF EXISTS cdm.category_counters;
+
+CREATE TABLE IF NOT EXISTS cdm.category_counters
+(
+    category_id   UUID PRIMARY KEY,
+    category_name VARCHAR NOT NULL,
+    order_cnt     INT     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS category_counters_order_cnt_idx ON cdm.category_counters (order_cnt DESC);
+
+DROP TABLE IF EXISTS cdm.daily_product_counters;
+
+CREATE TABLE IF NOT EXISTS cdm.daily_product_counters
+(
+    order_date   DATE    NOT NULL,
+    product_id   UUID    NOT NULL,
+    product_name VARCHAR NOT NULL,
+    order_cnt    INT     NOT NULL CHECK ( order_cnt >= 0 ),
+    PRIMARY KEY (order_date, product_id)
+);
+
+DROP TABLE IF EXISTS cdm.daily_category_counters;
+
+CREATE TABLE IF NOT EXISTS cdm.daily_category_counters
+(
+    order_date    DATE    NOT NULL,
+    category_id   UUID    NOT NULL,
+    category_name VARCHAR NOT NULL,
+    order_cnt     INT     NOT NULL CHECK ( order_cnt >= 0 ),
+    PRIMARY KEY (order_date, category_id)
+);
+
 DROP TABLE IF EXISTS stg.order_events;
 
 CREATE TABLE IF NOT EXISTS stg.order_events
@@ -96,6 +151,9 @@ CREATE TABLE IF NOT EXISTS dds.l_order_product
     load_src            VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS l_order_product_h_order_pk_idx ON dds.l_order_product (h_order_pk, h_product_pk);
+CREATE INDEX IF NOT EXISTS l_order_product_h_product_pk_idx ON dds.l_order_product (h_product_pk, h_order_pk);
+
 DROP TABLE IF EXISTS dds.l_product_restaurant;
 
 CREATE TABLE IF NOT EXISTS dds.l_product_restaurant
@@ -107,6 +165,9 @@ CREATE TABLE IF NOT EXISTS dds.l_product_restaurant
     load_src                 VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS l_product_restaurant_h_product_pk_idx
+    ON dds.l_product_restaurant (h_product_pk, h_restaurant_pk);
+
 DROP TABLE IF EXISTS dds.l_product_category;
 
 CREATE TABLE IF NOT EXISTS dds.l_product_category
@@ -118,6 +179,8 @@ CREATE TABLE IF NOT EXISTS dds.l_product_category
     load_src               VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS l_product_category_h_product_pk_idx ON dds.l_product_category (h_product_pk, h_category_pk);
+
 DROP TABLE IF EXISTS dds.l_order_user;
 
 CREATE TABLE IF NOT EXISTS dds.l_order_user
@@ -129,6 +192,9 @@ CREATE TABLE IF NOT EXISTS dds.l_order_user
     load_src         VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS l_order_user_h_user_pk_idx ON dds.l_order_user (h_user_pk, h_order_pk);
+CREATE INDEX IF NOT EXISTS l_order_user_h_order_pk_idx ON dds.l_order_user (h_order_pk, h_user_pk);
+
 DROP TABLE IF EXISTS dds.s_user_names;
 
 CREATE TABLE IF NOT EXISTS dds.s_user_names
@@ -137,10 +203,13 @@ CREATE TABLE IF NOT EXISTS dds.s_user_names
     h_user_pk        UUID      NOT NULL REFERENCES dds.h_user (h_user_pk),
     username         VARCHAR   NOT NULL,
     userlogin        VARCHAR   NOT NULL,
+    hashdiff         UUID      NOT NULL,
     load_dt          TIMESTAMP NOT NULL,
     load_src         VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS s_user_names_h_user_pk_idx ON dds.s_user_names (h_user_pk);
+
 DROP TABLE IF EXISTS dds.s_product_names;
 
 CREATE TABLE IF NOT EXISTS dds.s_product_names
@@ -148,10 +217,13 @@ CREATE TABLE IF NOT EXISTS dds.s_product_names
     hk_product_names_pk UUID PRIMARY KEY,
     h_product_pk        UUID      NOT NULL REFERENCES dds.h_product (h_product_pk),
     name                VARCHAR   NOT NULL,
+    hashdiff            UUID      NOT NULL,
     load_dt             TIMESTAMP NOT NULL,
     load_src            VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS s_product_names_h_product_pk_idx ON dds.s_product_names (h_product_pk);
+
 DROP TABLE IF EXISTS dds.s_restaurant_names;
 
 CREATE TABLE IF NOT EXISTS dds.s_restaurant_names
@@ -159,10 +231,13 @@ CREATE TABLE IF NOT EXISTS dds.s_restaurant_names
     hk_restaurant_names_pk UUID PRIMARY KEY,
     h_restaurant_pk        UUID      NOT NULL REFERENCES dds.h_restaurant (h_restaurant_pk),
     name                   VARCHAR   NOT NULL,
+    hashdiff               UUID      NOT NULL,
     load_dt                TIMESTAMP NOT NULL,
     load_src               VARCHAR   NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS s_restaurant_names_h_restaurant_pk_idx ON dds.s_restaurant_names (h_restaurant_pk);
+
 DROP TABLE IF EXISTS dds.s_order_cost;
 
 CREATE TABLE IF NOT EXISTS dds.s_order_cost
@@ -171,10 +246,13 @@ CREATE TABLE IF NOT EXISTS dds.s_order_cost
     h_order_pk       UUID           NOT NULL REFERENCES dds.h_order (h_order_pk),
     cost             DECIMAL(19, 5) NOT NULL CHECK ( cost >= 0 ),
     payment          DECIMAL(19, 5) NOT NULL CHECK ( payment >= 0 ),
+    hashdiff         UUID           NOT NULL,
     load_dt          TIMESTAMP      NOT NULL,
     load_src         VARCHAR        NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS s_order_cost_h_order_pk_idx ON dds.s_order_cost (h_order_pk);
+
 DROP TABLE IF EXISTS dds.s_order_status;
 
 CREATE TABLE IF NOT EXISTS dds.s_order_status
@@ -182,6 +260,9 @@ CREATE TABLE IF NOT EXISTS dds.s_order_status
     hk_order_status_pk UUID PRIMARY KEY,
     h_order_pk         UUID      NOT NULL REFERENCES dds.h_order (h_order_pk),
     status             VARCHAR   NOT NULL,
+    hashdiff           UUID      NOT NULL,
     load_dt            TIMESTAMP NOT NULL,
     load_src           VARCHAR   NOT NULL
 );
+
+CREATE INDEX IF NOT EXISTS s_order_status_h_order_pk_idx ON dds.s_order_status (h_order_pk, status);
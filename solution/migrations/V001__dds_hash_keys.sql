@@ -0,0 +1,236 @@
+-- Перевод DDS со случайных ключей (gen_random_uuid) на детерминированные хэш-ключи:
+-- ключ = md5(бизнес-ключи через '||')::uuid, так же, как их считает dds_loader.repository.hash_key.
+-- Ключи сателлитов совпадают с ключами их хабов, в сателлите остается одна актуальная строка на хаб,
+-- предыдущие версии переносятся в таблицы dds.<сателлит>_archive.
+-- Ключи пользователей, продуктов и категорий в CDM - это ключи хабов DDS, поэтому они пересчитываются тоже.
+-- Миграцию нужно применять при остановленных сервисах DDS и CDM.
+
+BEGIN;
+
+-- Соответствие старых и новых ключей хабов
+CREATE TEMP TABLE map_order ON COMMIT DROP AS
+SELECT h_order_pk AS old_pk, md5(order_id::VARCHAR)::UUID AS new_pk, order_id::VARCHAR AS bk
+FROM dds.h_order;
+
+CREATE TEMP TABLE map_user ON COMMIT DROP AS
+SELECT h_user_pk AS old_pk, md5(user_id)::UUID AS new_pk, user_id AS bk
+FROM dds.h_user;
+
+CREATE TEMP TABLE map_product ON COMMIT DROP AS
+SELECT h_product_pk AS old_pk, md5(product_id)::UUID AS new_pk, product_id AS bk
+FROM dds.h_product;
+
+CREATE TEMP TABLE map_category ON COMMIT DROP AS
+SELECT h_category_pk AS old_pk, md5(category_name)::UUID AS new_pk, category_name AS bk
+FROM dds.h_category;
+
+CREATE TEMP TABLE map_restaurant ON COMMIT DROP AS
+SELECT h_restaurant_pk AS old_pk, md5(restaurant_id)::UUID AS new_pk, restaurant_id AS bk
+FROM dds.h_restaurant;
+
+-- Внешние ключи линков и сателлитов на хабы на время перестроения ключей снимаются.
+-- Имена ограничений берутся из каталога: в развернутых схемах они могут отличаться от имен по умолчанию.
+DO
+$$
+    DECLARE
+        fk RECORD;
+    BEGIN
+        FOR fk IN SELECT t.relname AS table_name, c.conname AS constraint_name
+                  FROM pg_constraint AS c
+                           JOIN pg_class AS t ON c.conrelid = t.oid
+                           JOIN pg_class AS r ON c.confrelid = r.oid
+                  WHERE c.contype = 'f'
+                    AND c.connamespace = 'dds'::REGNAMESPACE
+                    AND r.relnamespace = 'dds'::REGNAMESPACE
+                    AND r.relname IN ('h_order', 'h_user', 'h_product', 'h_category', 'h_restaurant')
+                    AND (t.relname LIKE 'l\_%' OR t.relname LIKE 's\_%')
+            LOOP
+                EXECUTE format('ALTER TABLE dds.%I DROP CONSTRAINT %I', fk.table_name, fk.constraint_name);
+            END LOOP;
+    END
+$$;
+
+-- Дубликаты линков по паре хабов схлопываются до одной строки
+DELETE FROM dds.l_order_user AS l
+USING dds.l_order_user AS d
+WHERE l.h_order_pk = d.h_order_pk AND l.h_user_pk = d.h_user_pk AND l.ctid > d.ctid;
+
+DELETE FROM dds.l_order_product AS l
+USING dds.l_order_product AS d
+WHERE l.h_order_pk = d.h_order_pk AND l.h_product_pk = d.h_product_pk AND l.ctid > d.ctid;
+
+DELETE FROM dds.l_product_restaurant AS l
+USING dds.l_product_restaurant AS d
+WHERE l.h_product_pk = d.h_product_pk AND l.h_restaurant_pk = d.h_restaurant_pk AND l.ctid > d.ctid;
+
+DELETE FROM dds.l_product_category AS l
+USING dds.l_product_category AS d
+WHERE l.h_product_pk = d.h_product_pk AND l.h_category_pk = d.h_category_pk AND l.ctid > d.ctid;
+
+-- Ключ сателлита совпадает с ключом хаба, поэтому в сателлите остается последняя загруженная версия по каждому хабу.
+-- Более старые версии не удаляются, а переносятся в dds.<сателлит>_archive с ключом хаба, пересчитанным ниже.
+
+CREATE TABLE IF NOT EXISTS dds.s_user_names_archive (LIKE dds.s_user_names);
+
+WITH archived AS (
+    DELETE FROM dds.s_user_names AS s
+    WHERE s.ctid NOT IN (SELECT DISTINCT ON (h_user_pk) ctid FROM dds.s_user_names ORDER BY h_user_pk, load_dt DESC)
+    RETURNING s.*
+)
+INSERT INTO dds.s_user_names_archive
+SELECT * FROM archived;
+
+CREATE TABLE IF NOT EXISTS dds.s_product_names_archive (LIKE dds.s_product_names);
+
+WITH archived AS (
+    DELETE FROM dds.s_product_names AS s
+    WHERE s.ctid NOT IN (SELECT DISTINCT ON (h_product_pk) ctid FROM dds.s_product_names ORDER BY h_product_pk, load_dt DESC)
+    RETURNING s.*
+)
+INSERT INTO dds.s_product_names_archive
+SELECT * FROM archived;
+
+CREATE TABLE IF NOT EXISTS dds.s_restaurant_names_archive (LIKE dds.s_restaurant_names);
+
+WITH archived AS (
+    DELETE FROM dds.s_restaurant_names AS s
+    WHERE s.ctid NOT IN (SELECT DISTINCT ON (h_restaurant_pk) ctid FROM dds.s_restaurant_names ORDER BY h_restaurant_pk, load_dt DESC)
+    RETURNING s.*
+)
+INSERT INTO dds.s_restaurant_names_archive
+SELECT * FROM archived;
+
+CREATE TABLE IF NOT EXISTS dds.s_order_cost_archive (LIKE dds.s_order_cost);
+
+WITH archived AS (
+    DELETE FROM dds.s_order_cost AS s
+    WHERE s.ctid NOT IN (SELECT DISTINCT ON (h_order_pk) ctid FROM dds.s_order_cost ORDER BY h_order_pk, load_dt DESC)
+    RETURNING s.*
+)
+INSERT INTO dds.s_order_cost_archive
+SELECT * FROM archived;
+
+CREATE TABLE IF NOT EXISTS dds.s_order_status_archive (LIKE dds.s_order_status);
+
+WITH archived AS (
+    DELETE FROM dds.s_order_status AS s
+    WHERE s.ctid NOT IN (SELECT DISTINCT ON (h_order_pk) ctid FROM dds.s_order_status ORDER BY h_order_pk, load_dt DESC)
+    RETURNING s.*
+)
+INSERT INTO dds.s_order_status_archive
+SELECT * FROM archived;
+
+-- Ключи линков
+UPDATE dds.l_order_user AS l
+SET hk_order_user_pk = md5(mo.bk || '||' || mu.bk)::UUID,
+    h_order_pk       = mo.new_pk,
+    h_user_pk        = mu.new_pk
+FROM map_order AS mo, map_user AS mu
+WHERE mo.old_pk = l.h_order_pk AND mu.old_pk = l.h_user_pk;
+
+UPDATE dds.l_order_product AS l
+SET hk_order_product_pk = md5(mo.bk || '||' || mp.bk)::UUID,
+    h_order_pk          = mo.new_pk,
+    h_product_pk        = mp.new_pk
+FROM map_order AS mo, map_product AS mp
+WHERE mo.old_pk = l.h_order_pk AND mp.old_pk = l.h_product_pk;
+
+UPDATE dds.l_product_restaurant AS l
+SET hk_product_restaurant_pk = md5(mp.bk || '||' || mr.bk)::UUID,
+    h_product_pk             = mp.new_pk,
+    h_restaurant_pk          = mr.new_pk
+FROM map_product AS mp, map_restaurant AS mr
+WHERE mp.old_pk = l.h_product_pk AND mr.old_pk = l.h_restaurant_pk;
+
+UPDATE dds.l_product_category AS l
+SET hk_product_category_pk = md5(mp.bk || '||' || mc.bk)::UUID,
+    h_product_pk           = mp.new_pk,
+    h_category_pk          = mc.new_pk
+FROM map_product AS mp, map_category AS mc
+WHERE mp.old_pk = l.h_product_pk AND mc.old_pk = l.h_category_pk;
+
+-- Ключи сателлитов совпадают с ключами хабов
+UPDATE dds.s_user_names AS s
+SET hk_user_names_pk = m.new_pk, h_user_pk = m.new_pk
+FROM map_user AS m
+WHERE m.old_pk = s.h_user_pk;
+
+UPDATE dds.s_product_names AS s
+SET hk_product_names_pk = m.new_pk, h_product_pk = m.new_pk
+FROM map_product AS m
+WHERE m.old_pk = s.h_product_pk;
+
+UPDATE dds.s_restaurant_names AS s
+SET hk_restaurant_names_pk = m.new_pk, h_restaurant_pk = m.new_pk
+FROM map_restaurant AS m
+WHERE m.old_pk = s.h_restaurant_pk;
+
+UPDATE dds.s_order_cost AS s
+SET hk_order_cost_pk = m.new_pk, h_order_pk = m.new_pk
+FROM map_order AS m
+WHERE m.old_pk = s.h_order_pk;
+
+UPDATE dds.s_order_status AS s
+SET hk_order_status_pk = m.new_pk, h_order_pk = m.new_pk
+FROM map_order AS m
+WHERE m.old_pk = s.h_order_pk;
+
+-- Ключи хабов в архиве сателлитов, ключи строк архива остаются прежними
+UPDATE dds.s_user_names_archive AS s
+SET h_user_pk = m.new_pk
+FROM map_user AS m
+WHERE m.old_pk = s.h_user_pk;
+UPDATE dds.s_product_names_archive AS s
+SET h_product_pk = m.new_pk
+FROM map_product AS m
+WHERE m.old_pk = s.h_product_pk;
+UPDATE dds.s_restaurant_names_archive AS s
+SET h_restaurant_pk = m.new_pk
+FROM map_restaurant AS m
+WHERE m.old_pk = s.h_restaurant_pk;
+UPDATE dds.s_order_cost_archive AS s
+SET h_order_pk = m.new_pk
+FROM map_order AS m
+WHERE m.old_pk = s.h_order_pk;
+UPDATE dds.s_order_status_archive AS s
+SET h_order_pk = m.new_pk
+FROM map_order AS m
+WHERE m.old_pk = s.h_order_pk;
+
+-- Ключи хабов
+UPDATE dds.h_order AS h SET h_order_pk = m.new_pk FROM map_order AS m WHERE m.old_pk = h.h_order_pk;
+UPDATE dds.h_user AS h SET h_user_pk = m.new_pk FROM map_user AS m WHERE m.old_pk = h.h_user_pk;
+UPDATE dds.h_product AS h SET h_product_pk = m.new_pk FROM map_product AS m WHERE m.old_pk = h.h_product_pk;
+UPDATE dds.h_category AS h SET h_category_pk = m.new_pk FROM map_category AS m WHERE m.old_pk = h.h_category_pk;
+UPDATE dds.h_restaurant AS h
+SET h_restaurant_pk = m.new_pk
+FROM map_restaurant AS m
+WHERE m.old_pk = h.h_restaurant_pk;
+
+-- Ключи витрин CDM
+UPDATE cdm.user_product_counters AS c
+SET user_id = mu.new_pk, product_id = mp.new_pk
+FROM map_user AS mu, map_product AS mp
+WHERE mu.old_pk = c.user_id AND mp.old_pk = c.product_id;
+
+UPDATE cdm.user_category_counters AS c
+SET user_id = mu.new_pk, category_id = mc.new_pk
+FROM map_user AS mu, map_category AS mc
+WHERE mu.old_pk = c.user_id AND mc.old_pk = c.category_id;
+
+-- Внешние ключи возвращаются с проверкой всех перестроенных строк
+ALTER TABLE dds.l_order_user ADD FOREIGN KEY (h_order_pk) REFERENCES dds.h_order (h_order_pk);
+ALTER TABLE dds.l_order_user ADD FOREIGN KEY (h_user_pk) REFERENCES dds.h_user (h_user_pk);
+ALTER TABLE dds.l_order_product ADD FOREIGN KEY (h_order_pk) REFERENCES dds.h_order (h_order_pk);
+ALTER TABLE dds.l_order_product ADD FOREIGN KEY (h_product_pk) REFERENCES dds.h_product (h_product_pk);
+ALTER TABLE dds.l_product_restaurant ADD FOREIGN KEY (h_product_pk) REFERENCES dds.h_product (h_product_pk);
+ALTER TABLE dds.l_product_restaurant ADD FOREIGN KEY (h_restaurant_pk) REFERENCES dds.h_restaurant (h_restaurant_pk);
+ALTER TABLE dds.l_product_category ADD FOREIGN KEY (h_product_pk) REFERENCES dds.h_product (h_product_pk);
+ALTER TABLE dds.l_product_category ADD FOREIGN KEY (h_category_pk) REFERENCES dds.h_category (h_category_pk);
+ALTER TABLE dds.s_user_names ADD FOREIGN KEY (h_user_pk) REFERENCES dds.h_user (h_user_pk);
+ALTER TABLE dds.s_product_names ADD FOREIGN KEY (h_product_pk) REFERENCES dds.h_product (h_product_pk);
+ALTER TABLE dds.s_restaurant_names ADD FOREIGN KEY (h_restaurant_pk) REFERENCES dds.h_restaurant (h_restaurant_pk);
+ALTER TABLE dds.s_order_cost ADD FOREIGN KEY (h_order_pk) REFERENCES dds.h_order (h_order_pk);
+ALTER TABLE dds.s_order_status ADD FOREIGN KEY (h_order_pk) REFERENCES dds.h_order (h_order_pk);
+
+COMMIT;
@@ -0,0 +1,34 @@
+-- Колонка hashdiff в сателлитах DDS: хэш атрибутов сателлита для проверки изменений одним сравнением.
+-- Формула совпадает с dds_loader.repository.hash_key.hash_diff: md5(атрибуты через '||')::uuid, NULL как пустая строка.
+-- Суммы берутся в текстовом виде DECIMAL(19, 5), так же их форматирует DDS-Service.
+-- Отдельный индекс по hashdiff не нужен: ключ сателлита уникален, проверка находит строку по первичному ключу.
+-- Применяется после V001__dds_hash_keys.sql при остановленном DDS-Service.
+
+BEGIN;
+
+ALTER TABLE dds.s_user_names ADD COLUMN IF NOT EXISTS hashdiff UUID;
+UPDATE dds.s_user_names
+SET hashdiff = md5(COALESCE(username, '') || '||' || COALESCE(userlogin, ''))::UUID;
+ALTER TABLE dds.s_user_names ALTER COLUMN hashdiff SET NOT NULL;
+
+ALTER TABLE dds.s_product_names ADD COLUMN IF NOT EXISTS hashdiff UUID;
+UPDATE dds.s_product_names
+SET hashdiff = md5(COALESCE(name, ''))::UUID;
+ALTER TABLE dds.s_product_names ALTER COLUMN hashdiff SET NOT NULL;
+
+ALTER TABLE dds.s_restaurant_names ADD COLUMN IF NOT EXISTS hashdiff UUID;
+UPDATE dds.s_restaurant_names
+SET hashdiff = md5(COALESCE(name, ''))::UUID;
+ALTER TABLE dds.s_restaurant_names ALTER COLUMN hashdiff SET NOT NULL;
+
+ALTER TABLE dds.s_order_cost ADD COLUMN IF NOT EXISTS hashdiff UUID;
+UPDATE dds.s_order_cost
+SET hashdiff = md5(COALESCE(cost::VARCHAR, '') || '||' || COALESCE(payment::VARCHAR, ''))::UUID;
+ALTER TABLE dds.s_order_cost ALTER COLUMN hashdiff SET NOT NULL;
+
+ALTER TABLE dds.s_order_status ADD COLUMN IF NOT EXISTS hashdiff UUID;
+UPDATE dds.s_order_status
+SET hashdiff = md5(COALESCE(status, ''))::UUID;
+ALTER TABLE dds.s_order_status ALTER COLUMN hashdiff SET NOT NULL;
+
+COMMIT;
@@ -0,0 +1,31 @@
+-- Таблица заказов, приращения которых уже применены к витринам CDM (режим STATS_MODE=delta).
+-- Заказы, уже закрытые в DDS, учтены в витринах полной статистикой, поэтому сразу отмечаются примененными:
+-- их повторная доставка в режиме delta не увеличит счетчики еще раз.
+-- Финальный статус заказа передается переменной psql с тем же значением, что ORDER_FINAL_STATUS в DDS-Service:
+--   psql -v ORDER_FINAL_STATUS="$ORDER_FINAL_STATUS" -f <файл миграции>
+-- Без переменной используется 'CLOSED' - значение по умолчанию в values.yaml DDS-Service.
+-- Применяется до переключения DDS-Service в режим delta, после V001__dds_hash_keys.sql.
+
+\if :{?ORDER_FINAL_STATUS}
+\else
+\set ORDER_FINAL_STATUS CLOSED
+\endif
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS cdm.applied_orders
+(
+    order_id   INT PRIMARY KEY,
+    user_id    UUID      NOT NULL,
+    applied_dt TIMESTAMP NOT NULL
+);
+
+INSERT INTO cdm.applied_orders (order_id, user_id, applied_dt)
+SELECT ho.order_id, lou.h_user_pk, NOW()
+FROM dds.h_order AS ho
+         JOIN dds.s_order_status AS sos ON ho.h_order_pk = sos.h_order_pk
+         JOIN dds.l_order_user AS lou ON ho.h_order_pk = lou.h_order_pk
+WHERE sos.status = :'ORDER_FINAL_STATUS'
+ON CONFLICT (order_id) DO NOTHING;
+
+COMMIT;
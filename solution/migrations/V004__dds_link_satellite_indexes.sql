@@ -0,0 +1,18 @@
+-- Индексы для поиска по ключам хабов в линках и сателлитах DDS.
+-- Первичные ключи линков и сателлитов - хэш-ключи, поиск по колонкам h_*_pk без этих индексов
+-- (статистика пользователя в get_user_stats, связи заказа с продуктами) идет последовательным сканированием.
+-- Второй колонкой индекса линка идет ключ второго хаба, чтобы переход по линку выполнялся через index only scan.
+
+CREATE INDEX IF NOT EXISTS l_order_user_h_user_pk_idx ON dds.l_order_user (h_user_pk, h_order_pk);
+CREATE INDEX IF NOT EXISTS l_order_user_h_order_pk_idx ON dds.l_order_user (h_order_pk, h_user_pk);
+CREATE INDEX IF NOT EXISTS l_order_product_h_order_pk_idx ON dds.l_order_product (h_order_pk, h_product_pk);
+CREATE INDEX IF NOT EXISTS l_order_product_h_product_pk_idx ON dds.l_order_product (h_product_pk, h_order_pk);
+CREATE INDEX IF NOT EXISTS l_product_category_h_product_pk_idx ON dds.l_product_category (h_product_pk, h_category_pk);
+CREATE INDEX IF NOT EXISTS l_product_restaurant_h_product_pk_idx
+    ON dds.l_product_restaurant (h_product_pk, h_restaurant_pk);
+
+CREATE INDEX IF NOT EXISTS s_order_status_h_order_pk_idx ON dds.s_order_status (h_order_pk, status);
+CREATE INDEX IF NOT EXISTS s_order_cost_h_order_pk_idx ON dds.s_order_cost (h_order_pk);
+CREATE INDEX IF NOT EXISTS s_user_names_h_user_pk_idx ON dds.s_user_names (h_user_pk);
+CREATE INDEX IF NOT EXISTS s_product_names_h_product_pk_idx ON dds.s_product_names (h_product_pk);
+CREATE INDEX IF NOT EXISTS s_restaurant_names_h_restaurant_pk_idx ON dds.s_restaurant_names (h_restaurant_pk);
@@ -0,0 +1,88 @@
+-- Общие счетчики продуктов и категорий по всем пользователям (для топов без агрегации по всей витрине)
+-- и дневные счетчики по дате заказа (для топов за период). CDM-Service обновляет их в той же транзакции,
+-- что и счетчики пользователей.
+-- Общие счетчики заполняются из счетчиков пользователей, дневные - из закрытых заказов DDS: приращение заказа
+-- учитывает каждый его продукт один раз, в категории продукта.
+-- В общих счетчиках нет CHECK ( order_cnt >= 0 ): в режиме snapshot в них вставляется разница со старыми
+-- счетчиками пользователя, она бывает отрицательной, а CHECK проверяется до разрешения ON CONFLICT.
+-- Финальный статус заказа передается переменной psql с тем же значением, что ORDER_FINAL_STATUS в DDS-Service:
+--   psql -v ORDER_FINAL_STATUS="$ORDER_FINAL_STATUS" -f <файл миграции>
+-- Без переменной используется 'CLOSED' - значение по умолчанию в values.yaml DDS-Service.
+-- Применяется при остановленном CDM-Service, после V003__cdm_applied_orders.sql.
+
+\if :{?ORDER_FINAL_STATUS}
+\else
+\set ORDER_FINAL_STATUS CLOSED
+\endif
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS cdm.product_counters
+(
+    product_id   UUID PRIMARY KEY,
+    product_name VARCHAR NOT NULL,
+    order_cnt    INT     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS product_counters_order_cnt_idx ON cdm.product_counters (order_cnt DESC);
+
+CREATE TABLE IF NOT EXISTS cdm.category_counters
+(
+    category_id   UUID PRIMARY KEY,
+    category_name VARCHAR NOT NULL,
+    order_cnt     INT     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS category_counters_order_cnt_idx ON cdm.category_counters (order_cnt DESC);
+
+CREATE TABLE IF NOT EXISTS cdm.daily_product_counters
+(
+    order_date   DATE    NOT NULL,
+    product_id   UUID    NOT NULL,
+    product_name VARCHAR NOT NULL,
+    order_cnt    INT     NOT NULL CHECK ( order_cnt >= 0 ),
+    PRIMARY KEY (order_date, product_id)
+);
+
+CREATE TABLE IF NOT EXISTS cdm.daily_category_counters
+(
+    order_date    DATE    NOT NULL,
+    category_id   UUID    NOT NULL,
+    category_name VARCHAR NOT NULL,
+    order_cnt     INT     NOT NULL CHECK ( order_cnt >= 0 ),
+    PRIMARY KEY (order_date, category_id)
+);
+
+TRUNCATE cdm.product_counters, cdm.category_counters, cdm.daily_product_counters, cdm.daily_category_counters;
+
+INSERT INTO cdm.product_counters (product_id, product_name, order_cnt)
+SELECT product_id, MAX(product_name), SUM(order_cnt)
+FROM cdm.user_product_counters
+GROUP BY product_id;
+
+INSERT INTO cdm.category_counters (category_id, category_name, order_cnt)
+SELECT category_id, MAX(category_name), SUM(order_cnt)
+FROM cdm.user_category_counters
+GROUP BY category_id;
+
+CREATE TEMP TABLE closed_order_products ON COMMIT DROP AS
+SELECT DISTINCT ho.order_dt::DATE AS order_date, ho.h_order_pk, lop.h_product_pk
+FROM dds.h_order AS ho
+         JOIN dds.s_order_status AS sos ON ho.h_order_pk = sos.h_order_pk
+         JOIN dds.l_order_product AS lop ON ho.h_order_pk = lop.h_order_pk
+WHERE sos.status = :'ORDER_FINAL_STATUS';
+
+INSERT INTO cdm.daily_product_counters (order_date, product_id, product_name, order_cnt)
+SELECT cop.order_date, cop.h_product_pk, MAX(spn.name), COUNT(*)
+FROM closed_order_products AS cop
+         JOIN dds.s_product_names AS spn ON cop.h_product_pk = spn.h_product_pk
+GROUP BY cop.order_date, cop.h_product_pk;
+
+INSERT INTO cdm.daily_category_counters (order_date, category_id, category_name, order_cnt)
+SELECT cop.order_date, hc.h_category_pk, MAX(hc.category_name), COUNT(*)
+FROM closed_order_products AS cop
+         JOIN dds.l_product_category AS lpc ON cop.h_product_pk = lpc.h_product_pk
+         JOIN dds.h_category AS hc ON lpc.h_category_pk = hc.h_category_pk
+GROUP BY cop.order_date, hc.h_category_pk;
+
+COMMIT;
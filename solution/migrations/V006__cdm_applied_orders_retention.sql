@@ -0,0 +1,6 @@
+-- Индекс для удаления из cdm.applied_orders заказов старше APPLIED_ORDERS_RETENTION_DAYS.
+-- Секционирование по applied_dt не подходит: первичный ключ секционированной таблицы должен включать applied_dt,
+-- а уникальность order_id нужна для пропуска уже примененных заказов.
+-- Применяется после V003__cdm_applied_orders.sql.
+
+CREATE INDEX IF NOT EXISTS applied_orders_applied_dt_idx ON cdm.applied_orders (applied_dt);
@@ -1,34 +1,163 @@
+import atexit
 import logging
+import signal
+import sys
+import time
+import uuid
+from typing import Optional
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask
+from flask import Flask, abort, g, jsonify, request
 
 from app_config import AppConfig
 from cdm_loader.cdm_message_processor_job import CdmMessageProcessor
+from lib.metrics import LatencyStats
+from lib.worker import StreamingWorker
 
 
 app = Flask(__name__)
 
 config = AppConfig()
 
+# Задержки ответов API по маршрутам, доступны на /stats/api.
+latency = LatencyStats()
+
 
 @app.get('/health')
 def health():
     return 'healthy'
 
 
+@app.get('/stats/pg')
+def pg_stats():
+    return config.pg_warehouse_db().stats()
+
+
+# Попадания и промахи кэша витрин.
+@app.get('/stats/cache')
+def cache_stats():
+    return config.counters_cache().stats()
+
+
+@app.get('/stats/api')
+def api_stats():
+    return latency.stats()
+
+
+# Чтение витрин идет через кэш, который процессор сбрасывает при записи счетчиков пользователя.
+@app.get('/users/<user_id>/products')
+def user_products(user_id: str):
+    return jsonify(config.counters_cache().user_products(get_user_id(user_id), get_limit()))
+
+
+@app.get('/users/<user_id>/categories')
+def user_categories(user_id: str):
+    return jsonify(config.counters_cache().user_categories(get_user_id(user_id), get_limit()))
+
+
+@app.get('/top/products')
+def top_products():
+    return jsonify(config.counters_cache().top_products(get_limit(), get_days()))
+
+
+@app.get('/top/categories')
+def top_categories():
+    return jsonify(config.counters_cache().top_categories(get_limit(), get_days()))
+
+
+def get_user_id(user_id: str) -> uuid.UUID:
+    try:
+        return uuid.UUID(user_id)
+    except ValueError:
+        abort(400, f'Invalid user id: {user_id}')
+
+
+def get_limit() -> int:
+    limit = request.args.get('limit', config.DEFAULT_API_LIMIT, type=int)
+    return min(max(limit, 1), config.MAX_API_LIMIT)
+
+
+# Период в днях для топа по дневным счетчикам. Без параметра топ считается за все время.
+# Дневные счетчики ведутся только по приращениям, в режиме snapshot топ за период не отдается.
+def get_days() -> Optional[int]:
+    days = request.args.get('days', type=int)
+    if days is None:
+        return None
+    if config.stats_mode == 'snapshot':
+        abort(400, 'Daily counters are not maintained in snapshot mode')
+    return min(max(days, 1), config.MAX_API_DAYS)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def observe_latency(response):
+    if request.url_rule is not None and 'started' in g:
+        latency.observe(request.url_rule.rule, time.perf_counter() - g.started)
+    return response
+
+
 if __name__ == '__main__':
     app.logger.setLevel(logging.DEBUG)
 
+    # Без cdm.applied_orders запуск в режиме delta падает, с пустой таблицей при заполненных витринах
+    # повторно доставленные заказы посчитаются дважды.
+    if config.stats_mode == 'delta' and config.cdm_repository().applied_orders_missing():
+        app.logger.warning(
+            "STATS_MODE=delta: cdm.applied_orders is empty while the marts are not, redelivered orders "
+            "will be counted twice. Apply migrations/V003__cdm_applied_orders.sql before switching from snapshot mode"
+        )
+
+    consumer = config.kafka_consumer(app.logger)
     proc = CdmMessageProcessor(
-        config.kafka_consumer(),
+        consumer,
         config.cdm_repository(),
+        config.counters_cache(),
+        config.worker_pool(),
+        config.snapshot_window(),
         config.batch_size,
         app.logger
     )
 
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=proc.run, trigger="interval", seconds=25)
-    scheduler.start()
+    atexit.register(config.pg_warehouse_db().close)
+    atexit.register(config.worker_pool().close)
+    atexit.register(consumer.close)
+
+    # Сбросы кэша от процессоров всех экземпляров сервиса.
+    invalidation_listener = config.counters_cache().listen()
+    if invalidation_listener is not None:
+        atexit.register(invalidation_listener.stop)
+
+    # Номера примененных заказов удаляются по сроку хранения, иначе cdm.applied_orders растет без ограничения.
+    if config.applied_orders_retention_days > 0:
+        purge_scheduler = BackgroundScheduler()
+        purge_scheduler.add_job(
+            func=lambda: app.logger.info(
+                "Purged %d applied orders",
+                config.cdm_repository().purge_applied_orders(
+                    config.applied_orders_retention_days,
+                    config.APPLIED_ORDERS_PURGE_BATCH_SIZE
+                )
+            ),
+            trigger="interval",
+            seconds=config.APPLIED_ORDERS_PURGE_INTERVAL
+        )
+        purge_scheduler.start()
+        atexit.register(purge_scheduler.shutdown)
+
+    if config.processing_mode == 'schedule':
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(func=proc.run, trigger="interval", seconds=config.DEFAULT_JOB_INTERVAL)
+        scheduler.start()
+        atexit.register(scheduler.shutdown)
+    else:
+        worker = StreamingWorker(proc.run, app.logger, config.idle_backoff, config.max_idle_backoff)
+        worker.start()
+        atexit.register(worker.stop)
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
     app.run(debug=True, host='0.0.0.0', use_reloader=False)
@@ -1,12 +1,36 @@
 import os
+from logging import Logger
+from typing import Optional
 
+from cdm_loader.counters_cache import CountersCache
 from cdm_loader.repository.cdm_repository import CdmRepository
 from lib.kafka_connect import KafkaConsumer
 from lib.pg import PgConnect
+from lib.redis import RedisClient
+from lib.worker import Coalescer, KeyedWorkerPool
 
 
 class AppConfig:
     CERTIFICATE_PATH = '/crt/YandexInternalRootCA.crt'
+    DEFAULT_JOB_INTERVAL = 25
+    DEFAULT_PROCESSING_MODE = 'stream'
+    DEFAULT_IDLE_BACKOFF = 1.0
+    DEFAULT_MAX_IDLE_BACKOFF = 30.0
+    DEFAULT_PG_POOL_MIN_SIZE = 1
+    DEFAULT_PG_POOL_MAX_SIZE = 4
+    DEFAULT_WORKER_THREADS = 1
+    DEFAULT_STATS_MODE = 'snapshot'
+    DEFAULT_SNAPSHOT_WINDOW = 0.0
+    DEFAULT_SNAPSHOT_WINDOW_MAX_USERS = 1000
+    DEFAULT_COUNTERS_CACHE_SIZE = 1000
+    DEFAULT_COUNTERS_CACHE_TTL = 60.0
+    DEFAULT_COUNTERS_CACHE_CHANNEL = 'cdm-service-counters-invalidate'
+    DEFAULT_APPLIED_ORDERS_RETENTION_DAYS = 30
+    APPLIED_ORDERS_PURGE_INTERVAL = 3600
+    APPLIED_ORDERS_PURGE_BATCH_SIZE = 10000
+    DEFAULT_API_LIMIT = 10
+    MAX_API_LIMIT = 100
+    MAX_API_DAYS = 366
 
     def __init__(self) -> None:
         self.kafka_host = str(os.getenv('KAFKA_HOST'))
@@ -15,6 +39,7 @@ class AppConfig:
         self.kafka_consumer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD'))
         self.kafka_consumer_group = str(os.getenv('KAFKA_CONSUMER_GROUP'))
         self.kafka_consumer_topic = str(os.getenv('KAFKA_SOURCE_TOPIC'))
+        self.kafka_consumer_commit_async = (os.getenv('KAFKA_COMMIT_ASYNC') or 'false').lower() == 'true'
         self.kafka_producer_username = str(os.getenv('KAFKA_CONSUMER_USERNAME'))
         self.kafka_producer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD'))
 
@@ -23,10 +48,46 @@ class AppConfig:
         self.pg_warehouse_dbname = str(os.getenv('PG_WAREHOUSE_DBNAME'))
         self.pg_warehouse_user = str(os.getenv('PG_WAREHOUSE_USER'))
         self.pg_warehouse_password = str(os.getenv('PG_WAREHOUSE_PASSWORD'))
+        self.pg_pool_min_size = int(os.getenv('PG_POOL_MIN_SIZE') or self.DEFAULT_PG_POOL_MIN_SIZE)
+        self.pg_pool_max_size = int(os.getenv('PG_POOL_MAX_SIZE') or self.DEFAULT_PG_POOL_MAX_SIZE)
+        self.pg_prepare_statements = (os.getenv('PG_PREPARE_STATEMENTS') or 'false').lower() == 'true'
+        self._pg_warehouse_db: Optional[PgConnect] = None
+
+        self.counters_cache_size = int(os.getenv('COUNTERS_CACHE_SIZE') or self.DEFAULT_COUNTERS_CACHE_SIZE)
+        self.counters_cache_ttl = float(os.getenv('COUNTERS_CACHE_TTL_SECONDS') or self.DEFAULT_COUNTERS_CACHE_TTL)
+        self.counters_cache_channel = str(
+            os.getenv('COUNTERS_CACHE_CHANNEL') or self.DEFAULT_COUNTERS_CACHE_CHANNEL
+        )
+        self._counters_cache: Optional[CountersCache] = None
+
+        self.redis_host = str(os.getenv('REDIS_HOST') or "")
+        self.redis_port = int(os.getenv('REDIS_PORT') or 0)
+        self.redis_password = str(os.getenv('REDIS_PASSWORD') or "")
+
+        # Режим статистики DDS-Service. В режиме snapshot дневные счетчики не ведутся.
+        self.stats_mode = str(os.getenv('STATS_MODE') or self.DEFAULT_STATS_MODE)
+
+        self.snapshot_window_seconds = float(os.getenv('SNAPSHOT_WINDOW_SECONDS') or self.DEFAULT_SNAPSHOT_WINDOW)
+        self.snapshot_window_max_users = int(
+            os.getenv('SNAPSHOT_WINDOW_MAX_USERS') or self.DEFAULT_SNAPSHOT_WINDOW_MAX_USERS
+        )
+
+        # Сколько дней хранить номера примененных заказов (STATS_MODE=delta). Срок должен быть больше хранения
+        # топика в Kafka: приращение заказа, доставленное повторно после удаления его номера, применится еще раз.
+        # 0 - хранить без ограничения.
+        self.applied_orders_retention_days = int(
+            os.getenv('APPLIED_ORDERS_RETENTION_DAYS') or self.DEFAULT_APPLIED_ORDERS_RETENTION_DAYS
+        )
 
         self.batch_size = int(str(os.getenv('BATCH_SIZE')))
+        self.worker_threads = int(os.getenv('WORKER_THREADS') or self.DEFAULT_WORKER_THREADS)
+        self._worker_pool: Optional[KeyedWorkerPool] = None
+
+        self.processing_mode = str(os.getenv('PROCESSING_MODE') or self.DEFAULT_PROCESSING_MODE)
+        self.idle_backoff = float(os.getenv('IDLE_BACKOFF_SECONDS') or self.DEFAULT_IDLE_BACKOFF)
+        self.max_idle_backoff = float(os.getenv('MAX_IDLE_BACKOFF_SECONDS') or self.DEFAULT_MAX_IDLE_BACKOFF)
 
-    def kafka_consumer(self):
+    def kafka_consumer(self, logger: Logger) -> KafkaConsumer:
         return KafkaConsumer(
             self.kafka_host,
             self.kafka_port,
@@ -34,17 +95,59 @@ class AppConfig:
             self.kafka_consumer_password,
             self.kafka_consumer_topic,
             self.kafka_consumer_group,
-            self.CERTIFICATE_PATH
+            self.CERTIFICATE_PATH,
+            self.kafka_consumer_commit_async,
+            logger
         )
 
-    def pg_warehouse_db(self):
-        return PgConnect(
-            self.pg_warehouse_host,
-            self.pg_warehouse_port,
-            self.pg_warehouse_dbname,
-            self.pg_warehouse_user,
-            self.pg_warehouse_password
-        )
+    # Пул соединений один на приложение - все репозитории работают через него.
+    def pg_warehouse_db(self) -> PgConnect:
+        if self._pg_warehouse_db is None:
+            self._pg_warehouse_db = PgConnect(
+                self.pg_warehouse_host,
+                self.pg_warehouse_port,
+                self.pg_warehouse_dbname,
+                self.pg_warehouse_user,
+                self.pg_warehouse_password,
+                min_size=self.pg_pool_min_size,
+                max_size=self.pg_pool_max_size,
+                prepare=self.pg_prepare_statements
+            )
+        return self._pg_warehouse_db
+
+    # Окно последней полной статистики по каждому пользователю (STATS_MODE=snapshot в DDS-Service).
+    # При нулевом окне статистика схлопывается в пределах батча.
+    def snapshot_window(self) -> Coalescer:
+        return Coalescer(self.snapshot_window_seconds, self.snapshot_window_max_users)
 
     def cdm_repository(self) -> CdmRepository:
         return CdmRepository(self.pg_warehouse_db())
+
+    def redis_client(self) -> RedisClient:
+        return RedisClient(
+            self.redis_host,
+            self.redis_port,
+            self.redis_password,
+            self.CERTIFICATE_PATH
+        )
+
+    # Кэш один на приложение: его читает API и сбрасывает процессор.
+    # Без REDIS_HOST сброс не рассылается другим экземплярам, и их ответы устаревают до COUNTERS_CACHE_TTL_SECONDS.
+    def counters_cache(self) -> CountersCache:
+        if self._counters_cache is None:
+            self._counters_cache = CountersCache(
+                self.cdm_repository(),
+                self.counters_cache_size,
+                self.counters_cache_ttl,
+                self.redis_client() if self.redis_host else None,
+                self.counters_cache_channel
+            )
+        return self._counters_cache
+
+    # Пул потоков обработки батча. Каждый поток держит свое соединение к Postgres,
+    # поэтому WORKER_THREADS не должен превышать PG_POOL_MAX_SIZE. При WORKER_THREADS=1 батч обрабатывается
+    # в потоке процессора, как раньше.
+    def worker_pool(self) -> KeyedWorkerPool:
+        if self._worker_pool is None:
+            self._worker_pool = KeyedWorkerPool(self.worker_threads)
+        return self._worker_pool
@@ -1,8 +1,11 @@
 from datetime import datetime
 from logging import Logger
+from typing import Dict, List, Union
 
 from lib.kafka_connect import KafkaConsumer
+from lib.worker import Coalescer, KeyedWorkerPool
 
+from cdm_loader.counters_cache import CountersCache
 from cdm_loader.repository.cdm_repository import CdmRepository
 
 
@@ -10,21 +13,82 @@ class CdmMessageProcessor:
     def __init__(self,
                  consumer: KafkaConsumer,
                  cdm_repository: CdmRepository,
+                 counters_cache: CountersCache,
+                 worker_pool: KeyedWorkerPool,
+                 snapshot_window: Coalescer,
                  batch_size: int,
                  logger: Logger,
                  ) -> None:
         self._consumer = consumer
         self._cdm_repository = cdm_repository
+        self._counters_cache = counters_cache
+        self._worker_pool = worker_pool
+        self._snapshot_window = snapshot_window
         self._batch_size = batch_size
         self._logger = logger
 
-    def run(self) -> None:
+        self._consumer.on_revoke(self.__drop_window)
+
+    def run(self) -> int:
         self._logger.info(f"{datetime.utcnow()}: START")
 
-        for _ in range(self._batch_size):
-            message = self._consumer.consume()
-            if not message:
-                break
-            self._cdm_repository.save_message(message)
+        messages = self._consumer.consume_batch(self._batch_size)
+        try:
+            if all(isinstance(message, list) for message in messages):
+                # Полная статистика пользователя заменяет все предыдущие, поэтому в окне копится
+                # только последняя по каждому пользователю, а записываются витрины один раз за окно.
+                for stats in messages:
+                    if stats:
+                        self._snapshot_window.add(self.__get_user_id(stats), stats)
+                if self._snapshot_window.due():
+                    self.__save_snapshots()
+            else:
+                # Приращения нельзя применять раньше статистики, которая пришла до них и еще лежит в окне.
+                self.__save_snapshots()
+                self.__save_messages(messages)
+        except Exception:
+            # Консьюмер перематывается на первое незакоммиченное сообщение, то есть и на начало окна:
+            # окно заполнится заново при перечитывании.
+            self._consumer.rewind()
+            self._snapshot_window.clear()
+            raise
+
+        # Пока в окне есть незаписанная статистика, офсеты не коммитим: после перезапуска она перечитается.
+        if not len(self._snapshot_window):
+            self._consumer.commit()
 
         self._logger.info(f"{datetime.utcnow()}: FINISH")
+        return len(messages)
+
+    # Окно может держать сообщения отозванных партиций, которые теперь дочитает их новый владелец.
+    # Окно сбрасывается целиком, а консьюмер перематывается на первое незакоммиченное сообщение, чтобы ни коммит
+    # отозванных партиций, ни следующий коммит оставшихся не перескочил через сброшенное.
+    def __drop_window(self) -> None:
+        self._snapshot_window.clear()
+        self._consumer.rewind()
+
+    # Окно очищается только после записи в витрины.
+    def __save_snapshots(self) -> None:
+        snapshots = list(self._snapshot_window.items().values())
+        if not snapshots:
+            return
+        self.__save_messages(snapshots)
+        self._snapshot_window.clear()
+
+    # Сообщения раскладываются по потокам по пользователю: строки витрин одного пользователя
+    # обновляются по порядку и только одним потоком. Каждый поток пишет свою часть батча одной транзакцией.
+    # Пустая статистика не содержит user_id, записывать по ней нечего.
+    def __save_messages(self, messages: List[Union[List[Dict], Dict]]) -> None:
+        self._worker_pool.map([message for message in messages if message], self.__get_user_id, self.__save_lane)
+
+    # Кэш API сбрасывается после коммита, чтобы следующее чтение увидело новые счетчики.
+    def __save_lane(self, messages: List[Union[List[Dict], Dict]]) -> None:
+        self._cdm_repository.save_messages(messages)
+        self._counters_cache.invalidate(self.__get_user_id(message) for message in messages)
+
+    # Полная статистика - непустой список строк одного пользователя, приращение - словарь с user_id.
+    @staticmethod
+    def __get_user_id(message: Union[List[Dict], Dict]) -> str:
+        if isinstance(message, list):
+            return message[0]['user_id']
+        return message['user_id']
@@ -0,0 +1,89 @@
+import logging
+import uuid
+from logging import Logger
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+
+from lib.cache import TTLCache
+from lib.redis import RedisClient
+from cdm_loader.repository.cdm_repository import CdmRepository
+
+
+# Кэш витрин для API чтения. Счетчики пользователя хранятся целиком, отсортированными по убыванию,
+# top-N пользователя отдается срезом. Вызывающий получает копии строк, изменить закэшированные строки он не может.
+# Процессор сбрасывает записи пользователей после записи их строк в витрины, глобальный топ сбрасывается после
+# любой записи. Сброс рассылается через канал Redis, и кэши всех экземпляров сервиса сбрасывают те же записи.
+# Если сброс не удалось разослать, запись витрин не повторяется: TTL ограничивает устаревание, как и при чтении
+# из Postgres, пересекшемся с записью. Сообщения, пропущенные при разрыве соединения, кэш не восстанавливает
+# и после переподписки очищается целиком.
+class CountersCache:
+    def __init__(self,
+                 cdm_repository: CdmRepository,
+                 max_size: int,
+                 ttl: float,
+                 redis: Optional[RedisClient] = None,
+                 channel: str = '',
+                 logger: Optional[Logger] = None
+                 ) -> None:
+        self._repository = cdm_repository
+        self._logger = logger or logging.getLogger(__name__)
+        self._redis = redis
+        self._channel = channel
+        self._products = TTLCache(max_size, ttl)
+        self._categories = TTLCache(max_size, ttl)
+        self._top = TTLCache(max_size, ttl)
+
+    def user_products(self, user_id: uuid.UUID, limit: int) -> List[Dict]:
+        return self.__get(self._products, user_id, lambda: self._repository.get_user_products(user_id), limit)
+
+    def user_categories(self, user_id: uuid.UUID, limit: int) -> List[Dict]:
+        return self.__get(self._categories, user_id, lambda: self._repository.get_user_categories(user_id), limit)
+
+    def top_products(self, limit: int, days: Optional[int] = None) -> List[Dict]:
+        return self.__get(self._top, ('products', limit, days),
+                          lambda: self._repository.get_top_products(limit, days), limit)
+
+    def top_categories(self, limit: int, days: Optional[int] = None) -> List[Dict]:
+        return self.__get(self._top, ('categories', limit, days),
+                          lambda: self._repository.get_top_categories(limit, days), limit)
+
+    def invalidate(self, user_ids: Iterable[str]) -> None:
+        user_ids = list(user_ids)
+        self.__drop(user_ids)
+        if self._redis is None:
+            return
+        try:
+            self._redis.publish(self._channel, user_ids)
+        except Exception as e:
+            self._logger.warning('Counters cache invalidation was not published: %s', e)
+
+    # Подписка на сбросы, разосланные экземплярами сервиса (и этим тоже - повторный сброс ничего не меняет).
+    def listen(self):
+        if self._redis is None:
+            return None
+        return self._redis.subscribe(self._channel, self.__drop, self._logger, self.clear)
+
+    def clear(self) -> None:
+        self._products.clear()
+        self._categories.clear()
+        self._top.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'user_products': self._products.stats(),
+            'user_categories': self._categories.stats(),
+            'top': self._top.stats()
+        }
+
+    def __drop(self, user_ids: List[str]) -> None:
+        for user_id in user_ids:
+            self._products.invalidate(uuid.UUID(user_id))
+            self._categories.invalidate(uuid.UUID(user_id))
+        self._top.clear()
+
+    @staticmethod
+    def __get(cache: TTLCache, key: Hashable, load: Callable[[], List[Dict]], limit: int) -> List[Dict]:
+        rows = cache.get(key)
+        if rows is None:
+            rows = load()
+            cache.put(key, rows)
+        return [dict(row) for row in rows[:limit]]
@@ -1,79 +1,329 @@
 import uuid
-from typing import Dict, List
+from datetime import date, datetime
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from lib.pg import PgConnect
 from psycopg import Cursor
+from psycopg.rows import dict_row
 
 
 class CdmRepository:
+    # Строки витрины передаются колонками-массивами и разворачиваются unnest(): текст запросов не зависит
+    # от размера батча, поэтому они готовятся на сервере (при PG_PREPARE_STATEMENTS=true) и не планируются заново.
+    MART_ROWS = """
+        SELECT *
+        FROM unnest(%(user_id)s::UUID[], %(id)s::UUID[], %(name)s::VARCHAR[], %(order_cnt)s::INT[])
+                 AS s(user_id, id, name, order_cnt)
+    """
+    DAILY_ROWS = """
+        SELECT *
+        FROM unnest(%(order_date)s::DATE[], %(id)s::UUID[], %(name)s::VARCHAR[], %(order_cnt)s::INT[])
+                 AS s(order_date, id, name, order_cnt)
+    """
+
     def __init__(self, db: PgConnect) -> None:
         self._db = db
 
-    def save_message(self, message: List[Dict]):
-        message_id = uuid.uuid4().hex
-        temp_table = f"temp_user_stats_{message_id}"
+    # Сообщение из DDS - либо полная статистика пользователя (список строк), которая перезаписывает витрины,
+    # либо приращение от одного закрытого заказа (словарь с order_id), которое прибавляется к витринам.
+    def save_message(self, message: Union[List[Dict], Dict]):
+        self.save_messages([message])
+
+    def save_snapshot(self, stats: List[Dict]):
+        self.save_messages([stats])
+
+    def save_delta(self, delta: Dict):
+        self.save_messages([delta])
+
+    # Весь батч сообщений применяется в одной транзакции. Подряд идущие сообщения одного вида схлопываются
+    # в Python в строки витрин, уникальные по ключу, и записываются одной парой upsert-запросов.
+    def save_messages(self, messages: List[Union[List[Dict], Dict]]):
         with self._db.connection() as conn:
             with conn.cursor() as cur:
-                self.__create_temp_table(cur, temp_table)
-                self.__load_temp_table(cur, temp_table, message)
-                self.__load_data_marts(cur, temp_table)
+                for is_snapshot, group in groupby(messages, key=lambda message: isinstance(message, list)):
+                    if is_snapshot:
+                        self.__save_snapshots(cur, list(group))
+                    else:
+                        self.__save_deltas(cur, list(group))
 
-    def __create_temp_table(self, cur: Cursor, temp_table: str):
-        cur.execute(
-            f"""
-                CREATE TEMP TABLE {temp_table}
-                (
-                    user_id         UUID,
-                    product_id      UUID,
-                    product_name    VARCHAR,
-                    category_id     UUID,
-                    category_name   VARCHAR,
-                    order_cnt       INT
-                )
-                    ON COMMIT DROP;
+    # Счетчики пользователя по продуктам и категориям, по убыванию числа заказов.
+    def get_user_products(self, user_id: uuid.UUID) -> List[Dict]:
+        return self.__fetch(
+            """
+                SELECT product_id, product_name, order_cnt
+                FROM cdm.user_product_counters
+                WHERE user_id = %(user_id)s
+                ORDER BY order_cnt DESC, product_name;
+            """,
+            {"user_id": user_id}
+        )
+
+    def get_user_categories(self, user_id: uuid.UUID) -> List[Dict]:
+        return self.__fetch(
             """
+                SELECT category_id, category_name, order_cnt
+                FROM cdm.user_category_counters
+                WHERE user_id = %(user_id)s
+                ORDER BY order_cnt DESC, category_name;
+            """,
+            {"user_id": user_id}
         )
 
-    def __load_temp_table(self, cur: Cursor, temp_table: str, stats: List[Dict]):
-        cur.executemany(
+    # Самые заказываемые продукты и категории по всем пользователям - из общих счетчиков по индексу на order_cnt,
+    # а за последние days дней, включая сегодняшний, - из дневных счетчиков.
+    def get_top_products(self, limit: int, days: Optional[int] = None) -> List[Dict]:
+        return self.__get_top('product', limit, days)
+
+    def get_top_categories(self, limit: int, days: Optional[int] = None) -> List[Dict]:
+        return self.__get_top('category', limit, days)
+
+    # Удаляет из cdm.applied_orders заказы, примененные больше retention_days дней назад, порциями по batch_size
+    # в отдельных транзакциях, чтобы не держать долгие блокировки. Возвращает число удаленных заказов.
+    def purge_applied_orders(self, retention_days: int, batch_size: int) -> int:
+        purged = 0
+        while True:
+            with self._db.connection() as conn:
+                deleted = conn.execute(
+                    """
+                        DELETE FROM cdm.applied_orders
+                        WHERE order_id IN (SELECT order_id
+                                           FROM cdm.applied_orders
+                                           WHERE applied_dt < NOW() - make_interval(days => %(days)s)
+                                           LIMIT %(limit)s);
+                    """,
+                    {"days": retention_days, "limit": batch_size},
+                    prepare=True
+                ).rowcount
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
+    # Приращения пропускают только заказы из cdm.applied_orders. Если таблица пуста, а витрины уже заполнены
+    # (не применена V003, витрины велись в режиме snapshot), повторно доставленные заказы посчитаются в витринах
+    # второй раз. Без таблицы запрос падает: приращения без нее не применить.
+    def applied_orders_missing(self) -> bool:
+        with self._db.connection() as conn:
+            return conn.execute(
+                """
+                    SELECT NOT EXISTS (SELECT 1 FROM cdm.applied_orders)
+                               AND EXISTS (SELECT 1 FROM cdm.user_product_counters);
+                """
+            ).fetchone()[0]
+
+    def __get_top(self, mart: str, limit: int, days: Optional[int]) -> List[Dict]:
+        if days is None:
+            return self.__fetch(
+                f"""
+                    SELECT {mart}_id, {mart}_name, order_cnt
+                    FROM cdm.{mart}_counters
+                    WHERE order_cnt > 0
+                    ORDER BY order_cnt DESC
+                    LIMIT %(limit)s;
+                """,
+                {"limit": limit}
+            )
+        return self.__fetch(
             f"""
-                INSERT INTO {temp_table} (user_id, product_id, product_name, category_id, category_name, order_cnt)
-                VALUES 
-                (
-                    %(user_id)s,
-                    %(product_id)s,
-                    %(product_name)s,
-                    %(category_id)s,
-                    %(category_name)s,
-                    %(order_cnt)s
-                )
+                SELECT {mart}_id, MAX({mart}_name) AS {mart}_name, SUM(order_cnt) AS order_cnt
+                FROM cdm.daily_{mart}_counters
+                WHERE order_date > CURRENT_DATE - %(days)s
+                GROUP BY {mart}_id
+                ORDER BY order_cnt DESC
+                LIMIT %(limit)s;
             """,
-            stats
+            {"limit": limit, "days": days}
         )
 
-    def __load_data_marts(self, cur: Cursor, temp_table: str):
+    def __fetch(self, query: str, params: Dict) -> List[Dict]:
+        with self._db.connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(query, params, prepare=True)
+                return cur.fetchall()
+
+    # Полная статистика заменяет все строки пользователя в витринах, поэтому из нескольких снимков пользователя
+    # применяется только самый новый. Пустой снимок не содержит user_id и пропускается.
+    def __save_snapshots(self, cur: Cursor, snapshots: List[List[Dict]]):
+        latest = {stats[0]['user_id']: stats for stats in snapshots if stats}
+        stats = [row for rows in latest.values() for row in rows]
+        with cur.connection.pipeline():
+            self.__load_data_marts(
+                cur,
+                self.__sum_rows(stats, 'product_id', 'product_name'),
+                self.__sum_rows(stats, 'category_id', 'category_name'),
+                incremental=False,
+                users=[uuid.UUID(user_id) for user_id in latest]
+            )
+
+    # Приращение применяется один раз на заказ: номера заказов фиксируются в cdm.applied_orders
+    # в той же транзакции, что и обновление витрин. Уже примененные заказы пропускаются,
+    # приращения остальных складываются по ключам витрин.
+    def __save_deltas(self, cur: Cursor, deltas: List[Dict]):
+        orders = {delta['order_id']: delta for delta in deltas}
         cur.execute(
-            f"""
-                INSERT INTO cdm.user_product_counters (user_id, product_id, product_name, order_cnt)
-                SELECT  tt.user_id          AS user_id, 
-                        tt.product_id       AS product_id, 
-                        tt.product_name     AS product_name, 
-                        SUM(tt.order_cnt)   AS order_cnt
-                FROM {temp_table} AS tt
-                GROUP BY user_id, product_id, product_name
-                ON CONFLICT (user_id, product_id) DO UPDATE 
-                SET product_name = EXCLUDED.product_name,
-                    order_cnt = EXCLUDED.order_cnt;
-                    
-                INSERT INTO cdm.user_category_counters (user_id, category_id, category_name, order_cnt) 
-                SELECT  tt.user_id          AS user_id, 
-                        tt.category_id       AS category_id, 
-                        tt.category_name     AS category_name, 
-                        SUM(tt.order_cnt)   AS order_cnt
-                FROM {temp_table} AS tt
-                GROUP BY user_id, category_id, category_name
-                ON CONFLICT (user_id, category_id) DO UPDATE 
-                SET category_name = EXCLUDED.category_name,
-                    order_cnt = EXCLUDED.order_cnt;
             """
+                INSERT INTO cdm.applied_orders (order_id, user_id, applied_dt)
+                SELECT o.order_id, o.user_id, NOW()
+                FROM unnest(%(order_id)s::INT[], %(user_id)s::UUID[]) AS o(order_id, user_id)
+                ON CONFLICT (order_id) DO NOTHING
+                RETURNING order_id;
+            """,
+            {
+                "order_id": list(orders),
+                "user_id": [uuid.UUID(delta['user_id']) for delta in orders.values()]
+            },
+            prepare=True
         )
+        applied = [orders[order_id] for order_id, in cur.fetchall()]
+        stats = [row for delta in applied for row in delta['stats']]
+        if not stats:
+            return
+
+        # Дневные счетчики ведутся по дате заказа. Приращения без order_dt (отправленные до его появления)
+        # в них не попадают.
+        daily_stats = [
+            dict(row, order_date=datetime.fromisoformat(delta['order_dt']).date())
+            for delta in applied if delta.get('order_dt')
+            for row in delta['stats']
+        ]
+        with cur.connection.pipeline():
+            self.__load_data_marts(
+                cur,
+                self.__sum_rows(stats, 'product_id', 'product_name'),
+                self.__sum_rows(stats, 'category_id', 'category_name'),
+                incremental=True
+            )
+            self.__load_daily_marts(
+                cur,
+                self.__sum_rows(daily_stats, 'product_id', 'product_name', 'order_date'),
+                self.__sum_rows(daily_stats, 'category_id', 'category_name', 'order_date')
+            )
+
+    # Строки статистики по ключу (key_field, id), счетчики строк с одинаковым ключом складываются.
+    @staticmethod
+    def __sum_rows(stats: List[Dict],
+                   id_field: str,
+                   name_field: str,
+                   key_field: str = 'user_id') -> Dict[Tuple[Any, str], Tuple[str, int]]:
+        rows = {}
+        for row in stats:
+            key = (row[key_field], row[id_field])
+            order_cnt = rows[key][1] + row['order_cnt'] if key in rows else row['order_cnt']
+            rows[key] = (row[name_field], order_cnt)
+        return rows
+
+    @staticmethod
+    def __get_arrays(rows: Dict[Tuple[Any, str], Tuple[str, int]], key_field: str) -> Dict[str, List]:
+        return {
+            key_field: [uuid.UUID(key) if key_field == 'user_id' else key for key, _ in rows],
+            "id": [uuid.UUID(obj_id) for _, obj_id in rows],
+            "name": [name for name, _ in rows.values()],
+            "order_cnt": [order_cnt for _, order_cnt in rows.values()]
+        }
+
+    # Сначала обновляются общие счетчики: в режиме snapshot их приращение - разница между новыми счетчиками
+    # пользователей users и всеми сохраненными, включая продукты и категории, которых в новой статистике нет.
+    # Затем такие строки пользователей удаляются, остальные перезаписываются. Строки пользователя меняет только
+    # один поток, поэтому между этими запросами их никто не изменит.
+    # incremental=True прибавляет order_cnt к счетчикам пользователя, иначе счетчики перезаписываются.
+    def __load_data_marts(self,
+                          cur: Cursor,
+                          products: Dict[Tuple[str, str], Tuple[str, int]],
+                          categories: Dict[Tuple[str, str], Tuple[str, int]],
+                          incremental: bool,
+                          users: Optional[List[uuid.UUID]] = None):
+        marts = [('product', self.__get_arrays(products, 'user_id')),
+                 ('category', self.__get_arrays(categories, 'user_id'))]
+        if not incremental:
+            for _, arrays in marts:
+                arrays['users'] = users
+        for mart, arrays in marts:
+            cur.execute(self.__get_total_upsert(mart, incremental), arrays, prepare=True)
+        if not incremental:
+            for mart, arrays in marts:
+                cur.execute(self.__get_user_delete(mart), arrays, prepare=True)
+        for mart, arrays in marts:
+            cur.execute(self.__get_user_upsert(mart, incremental), arrays, prepare=True)
+
+    def __load_daily_marts(self,
+                           cur: Cursor,
+                           products: Dict[Tuple[date, str], Tuple[str, int]],
+                           categories: Dict[Tuple[date, str], Tuple[str, int]]):
+        for mart, rows in (('product', products), ('category', categories)):
+            cur.execute(self.__get_daily_upsert(mart), self.__get_arrays(rows, 'order_date'), prepare=True)
+
+    # Витрины продуктов и категорий устроены одинаково, запросы строятся по имени витрины (product или category).
+    def __get_user_upsert(self, mart: str, incremental: bool) -> str:
+        order_cnt = "c.order_cnt + EXCLUDED.order_cnt" if incremental else "EXCLUDED.order_cnt"
+        return f"""
+            INSERT INTO cdm.user_{mart}_counters AS c (user_id, {mart}_id, {mart}_name, order_cnt)
+            SELECT  s.user_id           AS user_id,
+                    s.id                AS {mart}_id,
+                    s.name              AS {mart}_name,
+                    s.order_cnt         AS order_cnt
+            FROM ({self.MART_ROWS}) AS s
+            ON CONFLICT (user_id, {mart}_id) DO UPDATE
+            SET {mart}_name = EXCLUDED.{mart}_name,
+                order_cnt = {order_cnt};
+        """
+
+    def __get_user_delete(self, mart: str) -> str:
+        return f"""
+            DELETE FROM cdm.user_{mart}_counters AS c
+            WHERE c.user_id = ANY (%(users)s::UUID[])
+              AND NOT EXISTS (SELECT 1
+                              FROM ({self.MART_ROWS}) AS s
+                              WHERE s.user_id = c.user_id
+                                AND s.id = c.{mart}_id);
+        """
+
+    # Общие и дневные счетчики разделяются потоками разных пользователей: строки вставляются в порядке ключа,
+    # чтобы транзакции блокировали их в одном порядке и не попадали во взаимную блокировку.
+    def __get_total_upsert(self, mart: str, incremental: bool) -> str:
+        if incremental:
+            return f"""
+                INSERT INTO cdm.{mart}_counters AS c ({mart}_id, {mart}_name, order_cnt)
+                SELECT  s.id                AS {mart}_id,
+                        MAX(s.name)         AS {mart}_name,
+                        SUM(s.order_cnt)    AS order_cnt
+                FROM ({self.MART_ROWS}) AS s
+                GROUP BY s.id
+                ORDER BY s.id
+                ON CONFLICT ({mart}_id) DO UPDATE
+                SET {mart}_name = EXCLUDED.{mart}_name,
+                    order_cnt = c.order_cnt + EXCLUDED.order_cnt;
+            """
+        return f"""
+            INSERT INTO cdm.{mart}_counters AS c ({mart}_id, {mart}_name, order_cnt)
+            SELECT  d.id                AS {mart}_id,
+                    MAX(d.name)         AS {mart}_name,
+                    SUM(d.order_cnt)    AS order_cnt
+            FROM (SELECT COALESCE(s.id, u.{mart}_id)                            AS id,
+                         COALESCE(s.name, u.{mart}_name)                        AS name,
+                         COALESCE(s.order_cnt, 0) - COALESCE(u.order_cnt, 0)    AS order_cnt
+                  FROM ({self.MART_ROWS}) AS s
+                           FULL JOIN (SELECT *
+                                      FROM cdm.user_{mart}_counters
+                                      WHERE user_id = ANY (%(users)s::UUID[])) AS u
+                                     ON u.user_id = s.user_id AND u.{mart}_id = s.id) AS d
+            GROUP BY d.id
+            HAVING SUM(d.order_cnt) <> 0
+            ORDER BY d.id
+            ON CONFLICT ({mart}_id) DO UPDATE
+            SET {mart}_name = EXCLUDED.{mart}_name,
+                order_cnt = c.order_cnt + EXCLUDED.order_cnt;
+        """
+
+    def __get_daily_upsert(self, mart: str) -> str:
+        return f"""
+            INSERT INTO cdm.daily_{mart}_counters AS c (order_date, {mart}_id, {mart}_name, order_cnt)
+            SELECT  s.order_date        AS order_date,
+                    s.id                AS {mart}_id,
+                    s.name              AS {mart}_name,
+                    s.order_cnt         AS order_cnt
+            FROM ({self.DAILY_ROWS}) AS s
+            ORDER BY s.order_date, s.id
+            ON CONFLICT (order_date, {mart}_id) DO UPDATE
+            SET {mart}_name = EXCLUDED.{mart}_name,
+                order_cnt = c.order_cnt + EXCLUDED.order_cnt;
+        """
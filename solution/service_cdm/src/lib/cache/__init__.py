@@ -0,0 +1 @@
+from .ttl_cache import TTLCache  # noqa
@@ -1,7 +1,11 @@
-import json
-from typing import Dict, Optional
+import logging
+import threading
+from logging import Logger
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from confluent_kafka import Consumer, Producer
+from confluent_kafka import Consumer, KafkaError, Message, Producer, TopicPartition
+
+from . import codec
 
 
 def error_callback(err):
@@ -9,7 +13,15 @@ def error_callback(err):
 
 
 class KafkaProducer:
-    def __init__(self, host: str, port: int, user: str, password: str, topic: str, cert_path: str) -> None:
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 user: str,
+                 password: str,
+                 topic: str,
+                 cert_path: str,
+                 pipelined: bool = False
+                 ) -> None:
         params = {
             'bootstrap.servers': f'{host}:{port}',
             'security.protocol': 'SASL_SSL',
@@ -21,11 +33,67 @@ class KafkaProducer:
         }
 
         self.topic = topic
+        self.pipelined = pipelined
         self.p = Producer(params)
 
-    def produce(self, payload: Dict) -> None:
-        self.p.produce(self.topic, json.dumps(payload))
-        self.p.flush(10)
+        self._delivery_errors: List[str] = []
+        self._lock = threading.Lock()
+
+    # В pipelined-режиме сообщение только ставится в очередь librdkafka,
+    # подтверждения собираются в on_delivery, а ждем брокер мы один раз в flush.
+    # Сообщения с одинаковым key попадают в одну партицию и читаются одним консьюмером группы по порядку.
+    def produce(self, payload: Dict, key: Optional[str] = None) -> None:
+        value = codec.dumps(payload)
+        while True:
+            try:
+                self.p.produce(self.topic, value, key=key, on_delivery=self.__on_delivery)
+                break
+            except BufferError:
+                # Локальная очередь заполнена - ждем, пока брокер подтвердит часть сообщений.
+                self.p.poll(1)
+
+        if self.pipelined:
+            self.p.poll(0)
+        else:
+            self.p.flush(10)
+
+    # Дожидается доставки всех сообщений из очереди и возвращает накопленные ошибки доставки.
+    # Что с ними делать, решает процессор.
+    def flush(self, timeout: float = 10) -> List[str]:
+        remaining = self.p.flush(timeout)
+
+        with self._lock:
+            errors = self._delivery_errors
+            self._delivery_errors = []
+
+        if remaining:
+            errors.append(f'{remaining} messages were not delivered in {timeout} seconds')
+        return errors
+
+    def __on_delivery(self, err, msg) -> None:
+        if err is None:
+            return
+        with self._lock:
+            self._delivery_errors.append(f'{msg.topic()}: {err}')
+
+
+# Сообщение Kafka с исходными байтами значения. JSON разбирается лениво, при первом обращении к json(),
+# поэтому value можно передать дальше (например, в Postgres) без повторной сериализации.
+class KafkaMessage:
+    __slots__ = ('topic', 'partition', 'offset', 'key', 'value', '_decoded')
+
+    def __init__(self, msg: Message) -> None:
+        self.topic = msg.topic()
+        self.partition = msg.partition()
+        self.offset = msg.offset()
+        self.key = msg.key()
+        self.value = msg.value()
+        self._decoded = None
+
+    def json(self) -> Any:
+        if self._decoded is None:
+            self._decoded = codec.loads(self.value)
+        return self._decoded
 
 
 class KafkaConsumer:
@@ -36,8 +104,11 @@ class KafkaConsumer:
                  password: str,
                  topic: str,
                  group: str,
-                 cert_path: str
+                 cert_path: str,
+                 commit_async: bool = False,
+                 logger: Optional[Logger] = None
                  ) -> None:
+        self._logger = logger or logging.getLogger(__name__)
         params = {
             'bootstrap.servers': f'{host}:{port}',
             'security.protocol': 'SASL_SSL',
@@ -49,19 +120,110 @@ class KafkaConsumer:
             'auto.offset.reset': 'earliest',
             'enable.auto.commit': False,
             'error_cb': error_callback,
-            'debug': 'all',
+            'on_commit': self.__on_commit,
             'client.id': 'someclientkey'
         }
 
         self.topic = topic
+        self.commit_async = commit_async
         self.c = Consumer(params)
-        self.c.subscribe([topic])
+        self.c.subscribe([topic], on_revoke=self.__on_revoke)
+
+        # Следующий офсет для коммита и первый незакоммиченный офсет по каждой партиции.
+        self._offsets: Dict[Tuple[str, int], int] = {}
+        self._uncommitted: Dict[Tuple[str, int], int] = {}
+        self._revoke_callbacks: List[Callable[[], None]] = []
 
     def consume(self, timeout: float = 3.0) -> Optional[Dict]:
         msg = self.c.poll(timeout=timeout)
-        if not msg:
+        if not msg or not self.__check(msg):
             return None
-        if msg.error():
-            raise Exception(msg.error())
-        val = msg.value().decode()
-        return json.loads(val)
+        self.__track([msg])
+        return codec.loads(msg.value())
+
+    def consume_batch(self, max_messages: int, timeout: float = 3.0) -> List[Dict]:
+        return [msg.json() for msg in self.consume_raw_batch(max_messages, timeout)]
+
+    def consume_raw_batch(self, max_messages: int, timeout: float = 3.0) -> List[KafkaMessage]:
+        msgs = self.c.consume(num_messages=max_messages, timeout=timeout)
+        # Сообщения без ошибок учитываются до проверки ошибок: при ошибке rewind вернет консьюмер
+        # и на них, а не только на сообщения прошлых батчей.
+        good = [msg for msg in msgs if not msg.error()]
+        self.__track(good)
+        for msg in msgs:
+            if msg.error():
+                self.__check(msg)
+        return [KafkaMessage(msg) for msg in good]
+
+    # Коммитит офсеты всех вычитанных сообщений.
+    # Вызывать после того, как батч сохранен в Postgres и отправлен дальше в Kafka.
+    def commit(self, asynchronous: Optional[bool] = None) -> None:
+        if not self._offsets:
+            return
+        if asynchronous is None:
+            asynchronous = self.commit_async
+
+        offsets = [TopicPartition(topic, partition, offset) for (topic, partition), offset in self._offsets.items()]
+        self.c.commit(offsets=offsets, asynchronous=asynchronous)
+        self._offsets = {}
+        self._uncommitted = {}
+
+    # Возвращает консьюмер на первое незакоммиченное сообщение, если батч не удалось обработать.
+    # Процессор может не коммитить несколько батчей подряд (пока копит окно), поэтому перечитываются все они,
+    # а не только последний.
+    def rewind(self) -> None:
+        for (topic, partition), offset in self._uncommitted.items():
+            self.c.seek(TopicPartition(topic, partition, offset))
+            self._offsets[(topic, partition)] = offset
+
+    # Покидает группу консьюмеров сразу, не дожидаясь session.timeout.ms: партиции переходят к другим экземплярам
+    # без паузы. Вызывать после остановки потока, который читает из консьюмера.
+    def close(self) -> None:
+        self.c.close()
+
+    # Вызывается, когда партиции отзываются при ребалансировке, до коммита их офсетов. Процессор, который копит
+    # вычитанное между коммитами, должен здесь отказаться от накопленного и вызвать rewind().
+    def on_revoke(self, callback: Callable[[], None]) -> None:
+        self._revoke_callbacks.append(callback)
+
+    # Конец партиции - не ошибка: сообщение пропускается. На остальных ошибках консьюмер сначала
+    # перематывается на первое незакоммиченное сообщение, чтобы следующий коммит не перескочил через вычитанное.
+    def __check(self, msg: Message) -> bool:
+        err = msg.error()
+        if err is None:
+            return True
+        if err.code() == KafkaError._PARTITION_EOF:
+            self._logger.debug('Reached end of %s [%s] at offset %s', msg.topic(), msg.partition(), msg.offset())
+            return False
+        self.rewind()
+        raise Exception(err)
+
+    def __track(self, msgs: List) -> None:
+        for msg in msgs:
+            tp = (msg.topic(), msg.partition())
+            self._uncommitted.setdefault(tp, msg.offset())
+            self._offsets[tp] = msg.offset() + 1
+
+    def __on_commit(self, err, partitions) -> None:
+        if err is not None:
+            self._logger.error('Offsets commit failed: %s', err)
+
+    # Сначала процессор отказывается от накопленного (и перематывает консьюмер на первое незакоммиченное сообщение),
+    # затем офсеты обработанного в отозванных партициях коммитятся синхронно, чтобы новый владелец не перечитывал
+    # уже сохраненное. После этого партиции больше не наши - их дочитает новый владелец.
+    def __on_revoke(self, consumer, partitions) -> None:
+        for callback in self._revoke_callbacks:
+            callback()
+
+        revoked = [(p.topic, p.partition) for p in partitions]
+        offsets = [TopicPartition(topic, partition, self._offsets[(topic, partition)])
+                   for topic, partition in revoked if (topic, partition) in self._offsets]
+        if offsets:
+            try:
+                self.c.commit(offsets=offsets, asynchronous=False)
+            except Exception as e:
+                self._logger.error('Offsets commit of revoked partitions failed: %s', e)
+
+        for tp in revoked:
+            self._offsets.pop(tp, None)
+            self._uncommitted.pop(tp, None)
@@ -0,0 +1 @@
+from .latency import LatencyStats  # noqa
@@ -0,0 +1,41 @@
+import threading
+from collections import deque
+from typing import Deque, Dict
+
+
+# Задержки ответов по имени (например, по маршруту API): число запросов, среднее, максимум
+# и перцентили по последним window замерам. Потокобезопасный.
+class LatencyStats:
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window: int = 1000) -> None:
+        self._window = window
+        self._counts: Dict[str, int] = {}
+        self._totals: Dict[str, float] = {}
+        self._max: Dict[str, float] = {}
+        self._recent: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._totals[name] = self._totals.get(name, 0.0) + seconds
+            self._max[name] = max(self._max.get(name, 0.0), seconds)
+            self._recent.setdefault(name, deque(maxlen=self._window)).append(seconds)
+
+    # Значения в миллисекундах.
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            result = {}
+            for name, count in self._counts.items():
+                recent = sorted(self._recent[name])
+                result[name] = {
+                    'count': count,
+                    'avg_ms': self._totals[name] / count * 1000,
+                    'max_ms': self._max[name] * 1000,
+                    **{
+                        f'p{p}_ms': recent[min(len(recent) - 1, len(recent) * p // 100)] * 1000
+                        for p in self.PERCENTILES
+                    }
+                }
+            return result
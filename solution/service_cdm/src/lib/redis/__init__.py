@@ -0,0 +1 @@
+from .redis_client import RedisClient  # noqa
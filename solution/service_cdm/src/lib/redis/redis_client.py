@@ -0,0 +1,47 @@
+import json
+import time
+from logging import Logger
+from typing import Any, Callable, Optional
+
+import redis
+
+
+class RedisClient:
+    RESUBSCRIBE_DELAY = 1.0
+
+    def __init__(self, host: str, port: int, password: str, cert_path: str) -> None:
+        self._client = redis.StrictRedis(
+            host=host,
+            port=port,
+            password=password,
+            ssl=True,
+            ssl_ca_certs=cert_path)
+
+    def publish(self, channel: str, message: Any) -> None:
+        self._client.publish(channel, json.dumps(message))
+
+    # Слушает канал в фоновом потоке и передает разобранные сообщения в handler.
+    # Сообщения, отправленные, пока соединение было разорвано, не доставляются: после ошибки соединения поток
+    # переподписывается на канал и вызывает on_reconnect, чтобы подписчик мог отказаться от того, что пропустил.
+    # Возвращает поток, у которого есть stop().
+    def subscribe(self,
+                  channel: str,
+                  handler: Callable[[Any], None],
+                  logger: Logger,
+                  on_reconnect: Optional[Callable[[], None]] = None):
+        handlers = {channel: lambda message: handler(json.loads(message['data']))}
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**handlers)
+
+        def on_error(e: BaseException, pubsub, thread) -> None:
+            logger.warning('Redis subscription to %s failed: %s', channel, e)
+            time.sleep(self.RESUBSCRIBE_DELAY)
+            try:
+                pubsub.subscribe(**handlers)
+            except Exception as e:
+                logger.warning('Redis resubscription to %s failed: %s', channel, e)
+                return
+            if on_reconnect is not None:
+                on_reconnect()
+
+        return pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=on_error)
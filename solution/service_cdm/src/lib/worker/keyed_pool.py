@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List
+
+
+# Параллельная обработка батча по ключам. Сообщения раскладываются по дорожкам (lane) по хэшу ключа:
+# сообщения с одним ключом всегда попадают в одну дорожку и обрабатываются в исходном порядке,
+# дорожки обрабатываются одновременно в пуле из threads потоков.
+# map() возвращается только после завершения всех дорожек, поэтому после него все сообщения батча
+# обработаны и офсеты можно коммитить, а при ошибке - перечитать батч целиком.
+# Дорожки пишут независимыми транзакциями: если одна дорожка упала, записи остальных уже зафиксированы
+# и при перечитывании батча применятся повторно. Поэтому каждый job обязан быть идемпотентным при повторе
+# (проверка - solution/benchmarks/replay_idempotency_check.py).
+class KeyedWorkerPool:
+    def __init__(self, threads: int) -> None:
+        self._threads = max(threads, 1)
+        self._executor = ThreadPoolExecutor(self._threads, thread_name_prefix='keyed-worker') \
+            if self._threads > 1 else None
+
+    def map(self, items: List[Any], key: Callable[[Any], Hashable], job: Callable[[List[Any]], None]) -> None:
+        if self._executor is None:
+            job(items)
+            return
+
+        lanes: List[List[Any]] = [[] for _ in range(self._threads)]
+        for item in items:
+            lanes[hash(key(item)) % self._threads].append(item)
+
+        futures = [self._executor.submit(job, lane) for lane in lanes if lane]
+        # Дожидаемся всех дорожек, даже если одна из них упала, и только потом пробрасываем первую ошибку.
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -1,10 +1,14 @@
+import atexit
 import logging
+import signal
+import sys
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask
 
 from app_config import AppConfig
 from dds_loader.dds_message_processor_job import DdsMessageProcessor
+from lib.worker import StreamingWorker
 
 app = Flask(__name__)
 
@@ -16,20 +20,41 @@ def health():
     return 'healthy'
 
 
+@app.get('/stats/pg')
+def pg_stats():
+    return config.pg_warehouse_db().stats()
+
+
 if __name__ == '__main__':
     app.logger.setLevel(logging.DEBUG)
 
+    consumer = config.kafka_consumer(app.logger)
     proc = DdsMessageProcessor(
-        config.kafka_consumer(),
+        consumer,
         config.kafka_producer(),
         config.dds_repository(),
+        config.worker_pool(),
+        config.stats_window(),
         config.batch_size,
         config.order_final_status,
+        config.stats_mode,
         app.logger
     )
 
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=proc.run, trigger="interval", seconds=25)
-    scheduler.start()
+    atexit.register(config.pg_warehouse_db().close)
+    atexit.register(config.worker_pool().close)
+    atexit.register(consumer.close)
+
+    if config.processing_mode == 'schedule':
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(func=proc.run, trigger="interval", seconds=config.DEFAULT_JOB_INTERVAL)
+        scheduler.start()
+        atexit.register(scheduler.shutdown)
+    else:
+        worker = StreamingWorker(proc.run, app.logger, config.idle_backoff, config.max_idle_backoff)
+        worker.start()
+        atexit.register(worker.stop)
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
     app.run(debug=True, host='0.0.0.0', use_reloader=False)
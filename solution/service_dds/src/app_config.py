@@ -1,12 +1,26 @@
 import os
+from logging import Logger
+from typing import Optional
 
 from dds_loader.repository.dds_repository import DdsRepository
 from lib.kafka_connect import KafkaConsumer, KafkaProducer
 from lib.pg import PgConnect
+from lib.worker import Coalescer, KeyedWorkerPool
 
 
 class AppConfig:
     CERTIFICATE_PATH = '/crt/YandexInternalRootCA.crt'
+    DEFAULT_JOB_INTERVAL = 25
+    DEFAULT_PROCESSING_MODE = 'stream'
+    DEFAULT_IDLE_BACKOFF = 1.0
+    DEFAULT_MAX_IDLE_BACKOFF = 30.0
+    DEFAULT_PG_POOL_MIN_SIZE = 1
+    DEFAULT_PG_POOL_MAX_SIZE = 4
+    DEFAULT_WORKER_THREADS = 1
+    DEFAULT_STATS_MODE = 'snapshot'
+    DEFAULT_LOAD_STRATEGY = 'temp_table'
+    DEFAULT_STATS_WINDOW = 0.0
+    DEFAULT_STATS_WINDOW_MAX_USERS = 1000
 
     def __init__(self) -> None:
         self.kafka_host = str(os.getenv('KAFKA_HOST'))
@@ -15,20 +29,36 @@ class AppConfig:
         self.kafka_consumer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD'))
         self.kafka_consumer_group = str(os.getenv('KAFKA_CONSUMER_GROUP'))
         self.kafka_consumer_topic = str(os.getenv('KAFKA_SOURCE_TOPIC'))
+        self.kafka_consumer_commit_async = (os.getenv('KAFKA_COMMIT_ASYNC') or 'false').lower() == 'true'
         self.kafka_producer_username = str(os.getenv('KAFKA_CONSUMER_USERNAME'))
         self.kafka_producer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD'))
         self.kafka_producer_topic = str(os.getenv('KAFKA_DESTINATION_TOPIC'))
+        self.kafka_producer_pipelined = (os.getenv('KAFKA_PRODUCER_PIPELINED') or 'true').lower() == 'true'
 
         self.pg_warehouse_host = str(os.getenv('PG_WAREHOUSE_HOST'))
         self.pg_warehouse_port = int(str(os.getenv('PG_WAREHOUSE_PORT')))
         self.pg_warehouse_dbname = str(os.getenv('PG_WAREHOUSE_DBNAME'))
         self.pg_warehouse_user = str(os.getenv('PG_WAREHOUSE_USER'))
         self.pg_warehouse_password = str(os.getenv('PG_WAREHOUSE_PASSWORD'))
+        self.pg_pool_min_size = int(os.getenv('PG_POOL_MIN_SIZE') or self.DEFAULT_PG_POOL_MIN_SIZE)
+        self.pg_pool_max_size = int(os.getenv('PG_POOL_MAX_SIZE') or self.DEFAULT_PG_POOL_MAX_SIZE)
+        self.pg_prepare_statements = (os.getenv('PG_PREPARE_STATEMENTS') or 'false').lower() == 'true'
+        self._pg_warehouse_db: Optional[PgConnect] = None
 
         self.order_final_status = str(os.getenv('ORDER_FINAL_STATUS'))
         self.load_src = str(os.getenv('LOAD_SRC'))
+        self.stats_mode = str(os.getenv('STATS_MODE') or self.DEFAULT_STATS_MODE)
+        self.stats_window_seconds = float(os.getenv('STATS_WINDOW_SECONDS') or self.DEFAULT_STATS_WINDOW)
+        self.stats_window_max_users = int(os.getenv('STATS_WINDOW_MAX_USERS') or self.DEFAULT_STATS_WINDOW_MAX_USERS)
+        self.load_strategy = str(os.getenv('DDS_LOAD_STRATEGY') or self.DEFAULT_LOAD_STRATEGY)
 
         self.batch_size = int(str(os.getenv('BATCH_SIZE')))
+        self.worker_threads = int(os.getenv('WORKER_THREADS') or self.DEFAULT_WORKER_THREADS)
+        self._worker_pool: Optional[KeyedWorkerPool] = None
+
+        self.processing_mode = str(os.getenv('PROCESSING_MODE') or self.DEFAULT_PROCESSING_MODE)
+        self.idle_backoff = float(os.getenv('IDLE_BACKOFF_SECONDS') or self.DEFAULT_IDLE_BACKOFF)
+        self.max_idle_backoff = float(os.getenv('MAX_IDLE_BACKOFF_SECONDS') or self.DEFAULT_MAX_IDLE_BACKOFF)
 
     def kafka_producer(self):
         return KafkaProducer(
@@ -37,10 +67,11 @@ class AppConfig:
             self.kafka_producer_username,
             self.kafka_producer_password,
             self.kafka_producer_topic,
-            self.CERTIFICATE_PATH
+            self.CERTIFICATE_PATH,
+            self.kafka_producer_pipelined
         )
 
-    def kafka_consumer(self):
+    def kafka_consumer(self, logger: Logger) -> KafkaConsumer:
         return KafkaConsumer(
             self.kafka_host,
             self.kafka_port,
@@ -48,21 +79,43 @@ class AppConfig:
             self.kafka_consumer_password,
             self.kafka_consumer_topic,
             self.kafka_consumer_group,
-            self.CERTIFICATE_PATH
+            self.CERTIFICATE_PATH,
+            self.kafka_consumer_commit_async,
+            logger
         )
 
-    def pg_warehouse_db(self):
-        return PgConnect(
-            self.pg_warehouse_host,
-            self.pg_warehouse_port,
-            self.pg_warehouse_dbname,
-            self.pg_warehouse_user,
-            self.pg_warehouse_password
-        )
+    # Пул соединений один на приложение - все репозитории работают через него.
+    def pg_warehouse_db(self) -> PgConnect:
+        if self._pg_warehouse_db is None:
+            self._pg_warehouse_db = PgConnect(
+                self.pg_warehouse_host,
+                self.pg_warehouse_port,
+                self.pg_warehouse_dbname,
+                self.pg_warehouse_user,
+                self.pg_warehouse_password,
+                min_size=self.pg_pool_min_size,
+                max_size=self.pg_pool_max_size,
+                prepare=self.pg_prepare_statements
+            )
+        return self._pg_warehouse_db
+
+    # Окно пользователей, статистика которых отправляется в режиме STATS_MODE=snapshot.
+    # При нулевом окне статистика отправляется по каждому батчу, один раз на пользователя.
+    def stats_window(self) -> Coalescer:
+        return Coalescer(self.stats_window_seconds, self.stats_window_max_users)
 
     def dds_repository(self) -> DdsRepository:
         return DdsRepository(
             self.pg_warehouse_db(),
             self.order_final_status,
-            self.load_src
+            self.load_src,
+            self.load_strategy
         )
+
+    # Пул потоков обработки батча. Каждый поток держит свое соединение к Postgres,
+    # поэтому WORKER_THREADS не должен превышать PG_POOL_MAX_SIZE. При WORKER_THREADS=1 батч обрабатывается
+    # в потоке процессора, как раньше.
+    def worker_pool(self) -> KeyedWorkerPool:
+        if self._worker_pool is None:
+            self._worker_pool = KeyedWorkerPool(self.worker_threads)
+        return self._worker_pool
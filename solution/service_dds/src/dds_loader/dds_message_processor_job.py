@@ -1,10 +1,13 @@
 from datetime import datetime
 from logging import Logger
+from typing import Dict, List
 
 from lib.kafka_connect.kafka_connectors import KafkaConsumer, KafkaProducer
+from lib.worker import Coalescer, KeyedWorkerPool
 
 from dds_loader.repository.dds_repository import DdsRepository
-from dds_loader.repository.model import InputMessage
+from dds_loader.repository.hash_key import hash_key
+from dds_loader.repository.model import InputMessage, Order, User
 
 
 class DdsMessageProcessor:
@@ -12,31 +15,106 @@ class DdsMessageProcessor:
                  consumer: KafkaConsumer,
                  producer: KafkaProducer,
                  dds_repository: DdsRepository,
+                 worker_pool: KeyedWorkerPool,
+                 stats_window: Coalescer,
                  batch_size: int,
                  final_order_status: str,
+                 stats_mode: str,
                  logger: Logger) -> None:
         self._logger = logger
         self._consumer = consumer
         self._producer = producer
         self._dds_repository = dds_repository
+        self._worker_pool = worker_pool
+        self._stats_window = stats_window
         self._batch_size = batch_size
         self._final_order_status = final_order_status
+        self._stats_mode = stats_mode
 
-    # функция, которая будет вызываться по расписанию.
-    def run(self) -> None:
+        self._consumer.on_revoke(self.__drop_window)
+
+    # функция, которая будет вызываться по расписанию или в цикле StreamingWorker.
+    # Возвращает количество вычитанных из топика сообщений.
+    def run(self) -> int:
         # Пишем в лог, что джоб был запущен.
         self._logger.info(f"{datetime.utcnow()}: START")
 
-        for _ in range(self._batch_size):
-            message = self._consumer.consume()
-            if not message:
-                break
+        messages = self._consumer.consume_batch(self._batch_size)
+        try:
+            # Заказы раскладываются по потокам по пользователю: сателлит пользователя и его окно статистики
+            # меняет один поток, заказы пользователя обрабатываются по порядку, а продукты и рестораны,
+            # общие для потоков, вставляются идемпотентно. Если пользователь заказа в батче поменялся, все версии
+            # заказа идут в поток пользователя из последней версии, чтобы не обрабатываться параллельно.
+            users = {message['payload']['id']: message['payload']['user']['id'] for message in messages}
+            self._worker_pool.map(messages, lambda message: users[message['payload']['id']], self.__process_batch)
+            self.__flush()
+            if self._stats_window.due():
+                self.__produce_user_stats()
+        except Exception:
+            # Консьюмер перематывается на первое незакоммиченное сообщение, то есть и на начало окна:
+            # окно заполнится заново при перечитывании.
+            self._consumer.rewind()
+            self._stats_window.clear()
+            raise
 
-            input_message = InputMessage.parse_obj(message)
-            self._dds_repository.save_message(input_message)
-            if input_message.payload.status == self._final_order_status:
-                stats = self._dds_repository.get_user_stats(input_message.payload.user)
-                self._producer.produce(stats)
+        # Пока в окне есть пользователи без отправленной статистики, офсеты не коммитим:
+        # после перезапуска эти заказы перечитаются и пользователи снова попадут в окно.
+        if not len(self._stats_window):
+            self._consumer.commit()
 
         # Пишем в лог, что джоб успешно завершен.
         self._logger.info(f"{datetime.utcnow()}: FINISH")
+        return len(messages)
+
+    # В режиме delta по каждому закрытому заказу сразу отправляется приращение, которое CDM прибавляет
+    # к витринам один раз на заказ.
+    # В режиме snapshot отправляется полная статистика пользователя по всем его закрытым заказам. Пользователи
+    # с закрытыми заказами копятся в окне STATS_WINDOW_SECONDS, и статистика считается один раз на пользователя
+    # за окно: несколько заказов пользователя подряд не пересчитывают и не перезаписывают витрины несколько раз.
+    # Snapshot пересчитывает витрины пользователя целиком и подходит для сверки.
+    def __process_batch(self, messages: List[Dict]) -> None:
+        input_messages = [InputMessage.parse_obj(message) for message in messages]
+        self._dds_repository.save_messages(input_messages)
+
+        # Заказ мог прийти в батче несколько раз, статистику отправляем по последней версии.
+        orders = {message.payload.id: message.payload for message in input_messages}
+        final_orders = [order for order in orders.values() if order.status == self._final_order_status]
+
+        if self._stats_mode == 'snapshot':
+            for order in final_orders:
+                self._stats_window.add(order.user.id, order.user)
+            return
+
+        # Ключ - хэш-ключ пользователя: сообщения пользователя читает один экземпляр CDM-Service, по порядку.
+        for order in final_orders:
+            delta = self.__get_order_delta(order)
+            self._producer.produce(delta, key=str(delta['user_id']))
+
+    def __get_order_delta(self, order: Order) -> Dict:
+        return {
+            "order_id": int(order.id),
+            "order_dt": order.date,
+            "user_id": hash_key(order.user.id),
+            "stats": self._dds_repository.get_order_stats(order)
+        }
+
+    # Окно может держать сообщения отозванных партиций, которые теперь дочитает их новый владелец.
+    # Окно сбрасывается целиком, а консьюмер перематывается на первое незакоммиченное сообщение, чтобы ни коммит
+    # отозванных партиций, ни следующий коммит оставшихся не перескочил через сброшенное.
+    def __drop_window(self) -> None:
+        self._stats_window.clear()
+        self._consumer.rewind()
+
+    # Статистика по всем пользователям окна запрашивается одним pipeline.
+    # Окно очищается только после подтверждения доставки.
+    def __produce_user_stats(self) -> None:
+        users: List[User] = list(self._stats_window.items().values())
+        for user, stats in zip(users, self._dds_repository.get_users_stats(users)):
+            self._producer.produce(stats, key=str(hash_key(user.id)))
+        self.__flush()
+        self._stats_window.clear()
+
+    def __flush(self) -> None:
+        delivery_errors = self._producer.flush()
+        if delivery_errors:
+            raise Exception(f'Failed to deliver messages: {delivery_errors}')
@@ -1,398 +1,506 @@
-import uuid
-from typing import Dict, List
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Tuple
 
 from lib.pg.pg_connect import PgConnect
 from psycopg import Cursor
+from psycopg.errors import DeadlockDetected
 from psycopg.rows import dict_row
 
+from .hash_key import hash_diff, hash_key
 from .model import InputMessage, Order, User
 
 
 class DdsRepository:
-    def __init__(self, db: PgConnect, final_status: str, load_src: str) -> None:
+    # Масштаб колонок cost и payment в s_order_cost - DECIMAL(19, 5)
+    MONEY_SCALE = Decimal('0.00001')
+
+    # Временные таблицы удаляются в конце транзакции, поэтому имена фиксированные: текст запросов
+    # загрузки не меняется от батча к батчу.
+    ORDER_TEMP_TABLE = 'temp_order'
+    ITEMS_TEMP_TABLE = 'temp_order_items'
+
+    # Сколько раз повторить загрузку батча, если Postgres прервал ее из-за взаимной блокировки.
+    DEADLOCK_RETRIES = 3
+
+    # Колонки строк заказов и продуктов батча с типами Postgres: по ним строятся временные таблицы,
+    # COPY и unnest() в загрузке без временных таблиц.
+    ORDER_COLUMNS = [
+        ('seq', 'int4'),
+        ('h_order_pk', 'uuid'),
+        ('order_id', 'int4'),
+        ('order_date', 'timestamp'),
+        ('order_cost', 'numeric'),
+        ('order_payment', 'numeric'),
+        ('order_status', 'varchar'),
+        ('order_cost_hashdiff', 'uuid'),
+        ('order_status_hashdiff', 'uuid'),
+        ('h_user_pk', 'uuid'),
+        ('user_id', 'varchar'),
+        ('user_name', 'varchar'),
+        ('user_login', 'varchar'),
+        ('user_names_hashdiff', 'uuid'),
+        ('h_restaurant_pk', 'uuid'),
+        ('restaurant_id', 'varchar'),
+        ('restaurant_name', 'varchar'),
+        ('restaurant_names_hashdiff', 'uuid'),
+        ('hk_order_user_pk', 'uuid'),
+        ('load_src', 'varchar')
+    ]
+    ITEM_COLUMNS = [
+        ('seq', 'int4'),
+        ('h_order_pk', 'uuid'),
+        ('h_restaurant_pk', 'uuid'),
+        ('h_product_pk', 'uuid'),
+        ('product_id', 'varchar'),
+        ('product_name', 'varchar'),
+        ('product_names_hashdiff', 'uuid'),
+        ('h_category_pk', 'uuid'),
+        ('product_category', 'varchar'),
+        ('hk_order_product_pk', 'uuid'),
+        ('hk_product_restaurant_pk', 'uuid'),
+        ('hk_product_category_pk', 'uuid'),
+        ('load_src', 'varchar')
+    ]
+
+    # Статистика пользователя по всем его заказам в финальном статусе. Запрос готовится на сервере
+    # (при PG_PREPARE_STATEMENTS=true) и не планируется заново на каждый вызов.
+    USER_STATS_QUERY = """
+        SELECT uopc.user_id           AS user_id,
+               uopc.h_product_pk      AS product_id,
+               spn.name               AS product_name,
+               uopc.h_category_pk     AS category_id,
+               hc.category_name       AS category_name,
+               COUNT(uopc.h_order_pk) AS order_cnt
+        FROM (SELECT hu.h_user_pk      AS user_id,
+                     lou.h_order_pk    AS h_order_pk,
+                     lop.h_product_pk  AS h_product_pk,
+                     lpc.h_category_pk AS h_category_pk
+              FROM dds.h_user AS hu
+                       LEFT JOIN dds.l_order_user AS lou ON hu.h_user_pk = lou.h_user_pk
+                       LEFT JOIN dds.s_order_status AS sos ON lou.h_order_pk = sos.h_order_pk
+                       LEFT JOIN dds.l_order_product AS lop ON lou.h_order_pk = lop.h_order_pk
+                       LEFT JOIN dds.l_product_category AS lpc ON lop.h_product_pk = lpc.h_product_pk
+              WHERE hu.user_id = %(user_id)s
+                AND sos.status = %(final_status)s) AS uopc
+                 LEFT JOIN dds.s_product_names AS spn ON uopc.h_product_pk = spn.h_product_pk
+                 LEFT JOIN dds.h_category AS hc ON uopc.h_category_pk = hc.h_category_pk
+        GROUP BY user_id, product_id, product_name, category_id, category_name;
+    """
+
+    def __init__(self, db: PgConnect, final_status: str, load_src: str, load_strategy: str = 'temp_table') -> None:
         self._db = db
         self._final_status = final_status
         self._load_src = load_src
+        self._load_strategy = load_strategy
 
     def save_message(self, message: InputMessage) -> None:
-        order = message.payload
+        self.save_messages([message])
 
-        message_id = uuid.uuid4().hex
-        order_temp_table = f"temp_order_{message_id}"
-        items_temp_table = f"temp_order_items_{message_id}"
-        h_order_temp_table = f"h_temp_order_{message_id}"
-        h_items_temp_table = f"h_temp_order_items_{message_id}"
+    # Загружает весь батч заказов одним набором запросов к хабам, линкам и сателлитам.
+    # Хабы, линки и сателлиты, общие для нескольких заказов (один пользователь, один продукт), схлопываются в запросах.
+    # Ключи хабов, линков и сателлитов детерминированные (hash_key от бизнес-ключей) и считаются в Python
+    # при подготовке строк батча, поэтому читать сгенерированные ключи обратно из хабов не нужно.
+    # Строки батча передаются либо через временные таблицы (temp_table), либо массивами в unnest()
+    # единственного запроса с data-modifying CTE (cte) - без создания временных таблиц в системном каталоге.
+    def save_messages(self, messages: List[InputMessage]) -> None:
+        # Если заказ пришел в батче несколько раз, берем последнюю версию.
+        orders = list({message.payload.id: message.payload for message in messages}.values())
+        if not orders:
+            return
 
-        with self._db.connection() as conn:
-            with conn.cursor() as cur:
-                self.__create_temp_tables(cur, order_temp_table, items_temp_table)
-                self.__load_order_temp_table(cur, order_temp_table, order)
-                self.__load_items_temp_table(cur, items_temp_table, order)
-                self.__load_hubs(cur, order_temp_table, items_temp_table)
-                self.__load_h_temp_tables(cur, order_temp_table, items_temp_table, h_order_temp_table,
-                                          h_items_temp_table)
-                self.__load_links(cur, h_order_temp_table, h_items_temp_table)
-                self.__load_satellites(cur, h_order_temp_table, h_items_temp_table)
+        order_rows = self.__get_orders(orders)
+        item_rows = self.__get_items(orders)
+
+        # При параллельной обработке батчи разных потоков могут одновременно вставлять одни и те же
+        # новые продукты, категории и рестораны в разном порядке. Загрузка идемпотентна, поэтому
+        # транзакцию, прерванную из-за взаимной блокировки, можно просто повторить.
+        for attempt in range(self.DEADLOCK_RETRIES + 1):
+            try:
+                self.__load(order_rows, item_rows)
+                return
+            except DeadlockDetected:
+                if attempt == self.DEADLOCK_RETRIES:
+                    raise
 
     def get_user_stats(self, user: User) -> List[Dict]:
+        return self.get_users_stats([user])[0]
+
+    # Статистика нескольких пользователей: запросы отправляются в pipeline-режиме одним обменом с сервером,
+    # у каждого запроса свой курсор, результаты читаются после синхронизации pipeline.
+    def get_users_stats(self, users: List[User]) -> List[List[Dict]]:
         with self._db.connection() as conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                        SELECT uopc.user_id           AS user_id,
-                               uopc.h_product_pk      AS product_id,
-                               spn.name               AS product_name,
-                               uopc.h_category_pk     AS category_id,
-                               hc.category_name       AS category_name,
-                               COUNT(uopc.h_order_pk) AS order_cnt
-                        FROM (SELECT hu.h_user_pk      AS user_id,
-                                     lou.h_order_pk    AS h_order_pk,
-                                     lop.h_product_pk  AS h_product_pk,
-                                     lpc.h_category_pk AS h_category_pk
-                              FROM dds.h_user AS hu
-                                       LEFT JOIN dds.l_order_user AS lou ON hu.h_user_pk = lou.h_user_pk
-                                       LEFT JOIN dds.s_order_status AS sos ON lou.h_order_pk = sos.h_order_pk
-                                       LEFT JOIN dds.l_order_product AS lop ON lou.h_order_pk = lop.h_order_pk
-                                       LEFT JOIN dds.l_product_category AS lpc ON lop.h_product_pk = lpc.h_product_pk
-                              WHERE hu.user_id = %(user_id)s
-                                AND sos.status = %(final_status)s) AS uopc
-                                 LEFT JOIN dds.s_product_names AS spn ON uopc.h_product_pk = spn.h_product_pk
-                                 LEFT JOIN dds.h_category AS hc ON uopc.h_category_pk = hc.h_category_pk
-                        GROUP BY user_id, product_id, product_name, category_id, category_name;
-                    """,
-                    {
-                        "user_id": user.id,
-                        "final_status": self._final_status
-                    }
-                )
-                return cur.fetchall()
+            cursors = []
+            with conn.pipeline():
+                for user in users:
+                    cur = conn.cursor(row_factory=dict_row)
+                    cur.execute(
+                        self.USER_STATS_QUERY,
+                        {
+                            "user_id": user.id,
+                            "final_status": self._final_status
+                        },
+                        prepare=True
+                    )
+                    cursors.append(cur)
+            return [cur.fetchall() for cur in cursors]
+
+    # Приращение счетчиков витрин от одного заказа в финальном статусе: по строке на каждый продукт заказа
+    # с order_cnt = 1. Считается из самого заказа, без обращения к истории пользователя в DDS: ключи
+    # пользователя, продуктов и категорий - те же хэш-ключи, что и в хабах.
+    def get_order_stats(self, order: Order) -> List[Dict]:
+        user_id = hash_key(order.user.id)
+        products = {product.id: product for product in order.products}
+        return [
+            {
+                "user_id": user_id,
+                "product_id": hash_key(product.id),
+                "product_name": product.name,
+                "category_id": hash_key(product.category),
+                "category_name": product.category,
+                "order_cnt": 1
+            }
+            for product in products.values()
+        ]
 
-    def __create_temp_tables(self, cur: Cursor, order_temp_table: str, items_temp_table: str) -> None:
+    def __load(self, order_rows: List[Tuple], item_rows: List[Tuple]) -> None:
+        with self._db.connection() as conn:
+            with conn.cursor() as cur:
+                if self._load_strategy == 'cte':
+                    self.__load_cte(cur, order_rows, item_rows)
+                else:
+                    self.__load_temp_tables(cur, order_rows, item_rows)
+
+    # Запросы до и после COPY отправляются в pipeline-режиме: без ожидания ответа на каждый запрос,
+    # один обмен с сервером на группу. Сам COPY в pipeline выполнить нельзя.
+    def __load_temp_tables(self, cur: Cursor, order_rows: List[Tuple], item_rows: List[Tuple]) -> None:
+        with cur.connection.pipeline():
+            self.__create_temp_table(cur, self.ORDER_TEMP_TABLE, self.ORDER_COLUMNS)
+            self.__create_temp_table(cur, self.ITEMS_TEMP_TABLE, self.ITEM_COLUMNS)
+        self.__copy_rows(cur, self.ORDER_TEMP_TABLE, self.ORDER_COLUMNS, order_rows)
+        self.__copy_rows(cur, self.ITEMS_TEMP_TABLE, self.ITEM_COLUMNS, item_rows)
+        with cur.connection.pipeline():
+            for statement in self.__get_load_statements(self.ORDER_TEMP_TABLE, self.ITEMS_TEMP_TABLE):
+                cur.execute(statement)
+
+    def __create_temp_table(self, cur: Cursor, temp_table: str, columns: List[Tuple[str, str]]) -> None:
         cur.execute(
             f"""
-                CREATE TEMP TABLE {order_temp_table}
-                (
-                    order_id        INT,
-                    order_date      TIMESTAMP,
-                    order_cost      NUMERIC(19, 5),
-                    order_payment   NUMERIC(19, 5),
-                    order_status    VARCHAR,
-                    user_id         VARCHAR,
-                    user_name       VARCHAR,
-                    user_login      VARCHAR,
-                    restaurant_id   VARCHAR,
-                    restaurant_name VARCHAR,
-                    load_src        VARCHAR
-                )
-                    ON COMMIT DROP;
-        
-                CREATE TEMP TABLE {items_temp_table}
+                CREATE TEMP TABLE {temp_table}
                 (
-                    order_id         INT,
-                    restaurant_id    VARCHAR,
-                    product_id       VARCHAR,
-                    product_name     VARCHAR,
-                    product_category VARCHAR,
-                    load_src         VARCHAR
+                    {", ".join(f"{name} {pg_type}" for name, pg_type in columns)}
                 )
                     ON COMMIT DROP;
             """
         )
 
-    def __load_order_temp_table(self, cur: Cursor, order_temp_table: str, order: Order) -> None:
+    # Временные таблицы заполняются через бинарный COPY с явно заданными типами колонок:
+    # один поток данных на таблицу вместо отдельного INSERT на каждую строку.
+    def __copy_rows(self, cur: Cursor, temp_table: str, columns: List[Tuple[str, str]], rows: List[Tuple]) -> None:
+        with cur.copy(
+                f"""
+                    COPY {temp_table} ({", ".join(name for name, _ in columns)})
+                    FROM STDIN (FORMAT BINARY)
+                """
+        ) as copy:
+            copy.set_types([pg_type for _, pg_type in columns])
+            for row in rows:
+                copy.write_row(row)
+
+    # Один запрос на батч: строки заказов и продуктов приходят колонками-массивами и разворачиваются unnest(),
+    # каждая загрузка хаба, линка и сателлита - отдельный data-modifying CTE. Все CTE видят один снимок данных,
+    # внешние ключи линков и сателлитов на хабы проверяются в конце запроса, когда хабы уже вставлены.
+    # Текст запроса одинаков для любого батча, поэтому запрос готовится на сервере (при PG_PREPARE_STATEMENTS=true).
+    def __load_cte(self, cur: Cursor, order_rows: List[Tuple], item_rows: List[Tuple]) -> None:
+        statements = self.__get_load_statements('batch_orders', 'batch_items')
+        ctes = ",\n".join(f"load_{i} AS ({statement})" for i, statement in enumerate(statements))
         cur.execute(
             f"""
-                INSERT INTO {order_temp_table} 
-                (order_id, order_date, order_cost, order_payment, order_status, user_id, user_name, user_login, 
-                    restaurant_id, restaurant_name, load_src)
-                VALUES 
-                (
-                    %(order_id)s,
-                    %(order_date)s,
-                    %(order_cost)s,
-                    %(order_payment)s,
-                    %(order_status)s,
-                    %(user_id)s,
-                    %(user_name)s,
-                    %(user_login)s,
-                    %(restaurant_id)s,
-                    %(restaurant_name)s,
-                    %(load_src)s
-                )
+                WITH batch_orders AS ({self.__get_unnest('o', self.ORDER_COLUMNS)}),
+                     batch_items AS ({self.__get_unnest('i', self.ITEM_COLUMNS)}),
+                     {ctes}
+                SELECT 1;
             """,
             {
-                "order_id": order.id,
-                "order_date": order.date,
-                "order_cost": order.cost,
-                "order_payment": order.payment,
-                "order_status": order.status,
-                "user_id": order.user.id,
-                "user_name": order.user.name,
-                "user_login": order.user.login,
-                "restaurant_id": order.restaurant.id,
-                "restaurant_name": order.restaurant.name,
-                "load_src": self._load_src
-            }
+                **self.__get_arrays('o', self.ORDER_COLUMNS, order_rows),
+                **self.__get_arrays('i', self.ITEM_COLUMNS, item_rows)
+            },
+            prepare=True
         )
 
-    def __get_items(self, order: Order) -> List[Dict]:
+    def __get_unnest(self, prefix: str, columns: List[Tuple[str, str]]) -> str:
+        arrays = ", ".join(f"%({prefix}_{name})s::{pg_type}[]" for name, pg_type in columns)
+        return f"SELECT * FROM unnest({arrays}) AS t({', '.join(name for name, _ in columns)})"
+
+    def __get_arrays(self, prefix: str, columns: List[Tuple[str, str]], rows: List[Tuple]) -> Dict[str, List]:
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        return {f"{prefix}_{name}": list(column) for (name, _), column in zip(columns, values)}
+
+    def __get_orders(self, orders: List[Order]) -> List[Tuple]:
+        return [
+            (
+                seq,
+                hash_key(order.id),
+                int(order.id),
+                order.date,
+                order.cost,
+                order.payment,
+                order.status,
+                hash_diff(self.__money(order.cost), self.__money(order.payment)),
+                hash_diff(order.status),
+                hash_key(order.user.id),
+                order.user.id,
+                order.user.name,
+                order.user.login,
+                hash_diff(order.user.name, order.user.login),
+                hash_key(order.restaurant.id),
+                order.restaurant.id,
+                order.restaurant.name,
+                hash_diff(order.restaurant.name),
+                hash_key(order.id, order.user.id),
+                self._load_src
+            )
+            for seq, order in enumerate(orders)
+        ]
+
+    # Текстовое представление суммы, совпадающее с DECIMAL(19, 5)::TEXT в Postgres,
+    # чтобы hashdiff из сервиса и из миграции совпадали.
+    def __money(self, value: Decimal) -> str:
+        return None if value is None else format(value.quantize(self.MONEY_SCALE, ROUND_HALF_UP), 'f')
+
+    def __get_items(self, orders: List[Order]) -> List[Tuple]:
         items = []
-        for product in order.products:
-            items.append({
-                "order_id": order.id,
-                "restaurant_id": order.restaurant.id,
-                "product_id": product.id,
-                "product_name": product.name,
-                "product_category": product.category,
-                "load_src": self._load_src
-            })
+        for seq, order in enumerate(orders):
+            h_order_pk = hash_key(order.id)
+            h_restaurant_pk = hash_key(order.restaurant.id)
+            for product in order.products:
+                items.append((
+                    seq,
+                    h_order_pk,
+                    h_restaurant_pk,
+                    hash_key(product.id),
+                    product.id,
+                    product.name,
+                    hash_diff(product.name),
+                    hash_key(product.category),
+                    product.category,
+                    hash_key(order.id, product.id),
+                    hash_key(product.id, order.restaurant.id),
+                    hash_key(product.id, product.category),
+                    self._load_src
+                ))
 
         return items
 
-    def __load_items_temp_table(self, cur: Cursor, items_temp_table: str, order: Order) -> None:
-        cur.executemany(
-            f"""
-                INSERT INTO {items_temp_table} (order_id, restaurant_id, product_id, product_name, product_category, 
-                    load_src)
-                VALUES 
-                (
-                    %(order_id)s,
-                    %(restaurant_id)s,
-                    %(product_id)s,
-                    %(product_name)s,
-                    %(product_category)s,
-                    %(load_src)s
-                )
-            """,
-            self.__get_items(order)
-        )
+    # Запросы загрузки хабов, линков и сателлитов из строк батча - временных таблиц или CTE.
+    def __get_load_statements(self, orders: str, items: str) -> List[str]:
+        return (self.__get_hub_statements(orders, items)
+                + self.__get_link_statements(orders, items)
+                + self.__get_satellite_statements(orders, items))
 
-    def __load_hubs(self, cur: Cursor, order_temp_table: str, items_temp_table: str) -> None:
-        cur.execute(
+    @staticmethod
+    def __split(sql: str) -> List[str]:
+        return [statement.strip() for statement in sql.split(';') if statement.strip()]
+
+    # ON CONFLICT DO NOTHING без указания колонок: строка пропускается и при совпадении ключа,
+    # и при совпадении бизнес-ключа.
+    def __get_hub_statements(self, orders: str, items: str) -> List[str]:
+        return self.__split(
             f"""
                 INSERT INTO dds.h_order (h_order_pk, order_id, order_dt, load_dt, load_src)
-                SELECT gen_random_uuid() AS h_order_pk, 
+                SELECT ott.h_order_pk    AS h_order_pk, 
                        ott.order_id      AS order_id, 
-                       ott.order_date      AS order_dt, 
+                       ott.order_date    AS order_dt, 
                        NOW()             AS load_dt, 
                        ott.load_src      AS load_src
-                FROM {order_temp_table} AS ott
-                ON CONFLICT(order_id) DO NOTHING;
+                FROM {orders} AS ott
+                ON CONFLICT DO NOTHING;
 
                 INSERT INTO dds.h_user (h_user_pk, user_id, load_dt, load_src)
-                SELECT gen_random_uuid() AS h_user_pk, 
-                       ott.user_id       AS user_id, 
-                       NOW()             AS load_dt, 
-                       ott.load_src      AS load_src
-                FROM {order_temp_table} AS ott
-                ON CONFLICT(user_id) DO NOTHING;
+                SELECT DISTINCT ott.h_user_pk       AS h_user_pk, 
+                                ott.user_id         AS user_id, 
+                                NOW()               AS load_dt, 
+                                ott.load_src        AS load_src
+                FROM {orders} AS ott
+                ON CONFLICT DO NOTHING;
 
                 INSERT INTO dds.h_restaurant (h_restaurant_pk, restaurant_id, load_dt, load_src)
-                SELECT gen_random_uuid() AS h_restaurant_pk, 
-                       ott.restaurant_id AS restaurant_id, 
-                       NOW()             AS load_dt, 
-                       ott.load_src      AS load_src
-                FROM {order_temp_table} AS ott
-                ON CONFLICT(restaurant_id) DO NOTHING;
+                SELECT DISTINCT ott.h_restaurant_pk AS h_restaurant_pk, 
+                                ott.restaurant_id   AS restaurant_id, 
+                                NOW()               AS load_dt, 
+                                ott.load_src        AS load_src
+                FROM {orders} AS ott
+                ON CONFLICT DO NOTHING;
 
                 INSERT INTO dds.h_product (h_product_pk, product_id, load_dt, load_src)
-                SELECT gen_random_uuid() AS h_product_pk, 
-                       itt.product_id    AS product_id, 
-                       NOW()             AS load_dt, 
-                       itt.load_src      AS load_src
-                FROM {items_temp_table} AS itt
-                ON CONFLICT(product_id) DO NOTHING;
+                SELECT DISTINCT itt.h_product_pk    AS h_product_pk, 
+                                itt.product_id      AS product_id, 
+                                NOW()               AS load_dt, 
+                                itt.load_src        AS load_src
+                FROM {items} AS itt
+                ON CONFLICT DO NOTHING;
 
                 INSERT INTO dds.h_category (h_category_pk, category_name, load_dt, load_src)
-                SELECT gen_random_uuid() AS h_product_pk, 
-                       pc.category_name  AS product_id, 
-                       NOW()             AS load_dt, 
-                       pc.load_src      AS load_src
-                FROM (SELECT DISTINCT product_category AS category_name, 
-                                      load_src AS load_src 
-                      FROM {items_temp_table}) AS pc
-                ON CONFLICT(category_name) DO NOTHING;
+                SELECT DISTINCT itt.h_category_pk   AS h_category_pk, 
+                                itt.product_category AS category_name, 
+                                NOW()               AS load_dt, 
+                                itt.load_src        AS load_src
+                FROM {items} AS itt
+                ON CONFLICT DO NOTHING;
             """
         )
 
-    def __load_h_temp_tables(self, cur: Cursor, order_temp_table: str, items_temp_table: str, h_order_temp_table: str,
-                             h_items_temp_table: str) -> None:
-        cur.execute(
-            f"""
-                CREATE TEMP TABLE {h_order_temp_table}
-                ON COMMIT DROP 
-                AS 
-                (
-                    SELECT  ho.h_order_pk       AS h_order_pk,
-                            ott.order_id        AS order_id, 
-                            ott.order_date      AS order_date, 
-                            ott.order_cost      AS order_cost, 
-                            ott.order_payment   AS order_payment, 
-                            ott.order_status    AS order_status,
-                            hu.h_user_pk        AS h_user_pk,
-                            ott.user_id         AS user_id, 
-                            ott.user_name       AS user_name, 
-                            ott.user_login      AS user_login, 
-                            hr.h_restaurant_pk  AS h_restaurant_pk,
-                            ott.restaurant_id   AS restaurant_id, 
-                            ott.restaurant_name AS restaurant_name,
-                            ott.load_src        AS load_src
-                    FROM {order_temp_table} AS ott
-                    LEFT JOIN dds.h_order AS ho
-                        ON ott.order_id = ho.order_id
-                    LEFT JOIN dds.h_user AS hu
-                        ON ott.user_id = hu.user_id
-                    LEFT JOIN dds.h_restaurant AS hr
-                        ON ott.restaurant_id = hr.restaurant_id
-                );
-
-                CREATE TEMP TABLE {h_items_temp_table}
-                ON COMMIT DROP
-                AS 
-                (
-                    SELECT  ho.h_order_pk           AS h_order_pk,
-                            itt.order_id            AS order_id,
-                            hr.h_restaurant_pk      AS h_restaurant_pk, 
-                            itt.restaurant_id       AS restaurant_id,
-                            hp.h_product_pk         AS h_product_pk, 
-                            itt.product_id          AS product_id, 
-                            itt.product_name        AS product_name, 
-                            hc.h_category_pk        AS h_category_pk,
-                            itt.product_category    AS product_category,
-                            itt.load_src            AS load_src
-                    FROM {items_temp_table} AS itt
-                    LEFT JOIN dds.h_order AS ho
-                        ON itt.order_id = ho.order_id
-                    LEFT JOIN dds.h_restaurant AS hr
-                        ON itt.restaurant_id = hr.restaurant_id
-                    LEFT JOIN dds.h_product AS hp
-                        ON itt.product_id = hp.product_id
-                    LEFT JOIN dds.h_category AS hc
-                        ON itt.product_category = hc.category_name
-                );
-            """
-        )
-
-    def __load_links(self, cur: Cursor, h_order_temp_table: str, h_items_temp_table: str) -> None:
-        cur.execute(
+    # Ключ линка - хэш от бизнес-ключей обоих хабов, поэтому повторная вставка того же линка
+    # отсекается по первичному ключу, без anti-join к таблице линка.
+    def __get_link_statements(self, orders: str, items: str) -> List[str]:
+        return self.__split(
             f"""
                 INSERT INTO dds.l_order_user (hk_order_user_pk, h_order_pk, h_user_pk, load_dt, load_src)
-                SELECT  gen_random_uuid()   AS hk_order_user_pk,
-                        hott.h_order_pk     AS h_order_pk,
-                        hott.h_user_pk      AS h_user_pk,
-                        NOW()               AS load_dt,
-                        hott.load_src       AS load_src
-                FROM {h_order_temp_table} AS hott
-                    LEFT JOIN dds.l_order_user AS lou
-                     ON hott.h_order_pk = lou.h_order_pk
-                        AND hott.h_user_pk = lou.h_user_pk
-                WHERE lou.hk_order_user_pk IS NULL;
+                SELECT  ott.hk_order_user_pk AS hk_order_user_pk,
+                        ott.h_order_pk       AS h_order_pk,
+                        ott.h_user_pk        AS h_user_pk,
+                        NOW()                AS load_dt,
+                        ott.load_src         AS load_src
+                FROM {orders} AS ott
+                ON CONFLICT DO NOTHING;
                 
                 INSERT INTO dds.l_order_product (hk_order_product_pk, h_order_pk, h_product_pk, load_dt, load_src)
-                SELECT  gen_random_uuid()   AS hk_order_product_pk,
-                        hitt.h_order_pk     AS h_order_pk,
-                        hitt.h_product_pk   AS h_product_pk,
-                        NOW()               AS load_dt,
-                        hitt.load_src       AS load_src
-                FROM {h_items_temp_table} AS hitt
-                    LEFT JOIN dds.l_order_product AS lop
-                     ON hitt.h_order_pk = lop.h_order_pk
-                        AND hitt.h_product_pk = lop.h_product_pk
-                WHERE lop.hk_order_product_pk IS NULL;
+                SELECT DISTINCT itt.hk_order_product_pk AS hk_order_product_pk,
+                                itt.h_order_pk          AS h_order_pk,
+                                itt.h_product_pk        AS h_product_pk,
+                                NOW()                   AS load_dt,
+                                itt.load_src            AS load_src
+                FROM {items} AS itt
+                ON CONFLICT DO NOTHING;
                 
                 INSERT INTO dds.l_product_restaurant (hk_product_restaurant_pk, h_product_pk, h_restaurant_pk, load_dt, 
                     load_src)
-                SELECT gen_random_uuid()    AS hk_product_restaurant_pk,
-                       hitt.h_product_pk    AS h_product_pk,
-                       hitt.h_restaurant_pk AS h_restaurant_pk,
-                       NOW()                AS load_dt,
-                       hitt.load_src        AS load_src
-                FROM {h_items_temp_table} AS hitt
-                    LEFT JOIN dds.l_product_restaurant AS lpr
-                     ON hitt.h_product_pk = lpr.h_product_pk
-                        AND hitt.h_restaurant_pk = lpr.h_restaurant_pk 
-                WHERE lpr.hk_product_restaurant_pk IS NULL;
+                SELECT DISTINCT itt.hk_product_restaurant_pk AS hk_product_restaurant_pk,
+                                itt.h_product_pk             AS h_product_pk,
+                                itt.h_restaurant_pk          AS h_restaurant_pk,
+                                NOW()                        AS load_dt,
+                                itt.load_src                 AS load_src
+                FROM {items} AS itt
+                ON CONFLICT DO NOTHING;
                 
                 INSERT INTO dds.l_product_category (hk_product_category_pk, h_product_pk, h_category_pk, load_dt, 
                     load_src)
-                SELECT gen_random_uuid()    AS hk_product_category_pk,
-                       hitt.h_product_pk    AS h_product_pk,
-                       hitt.h_category_pk   AS h_category_pk,
-                       NOW()                AS load_dt,
-                       hitt.load_src        AS load_src
-                FROM {h_items_temp_table} AS hitt
-                    LEFT JOIN dds.l_product_category AS lpc
-                     ON hitt.h_product_pk = lpc.h_product_pk
-                        AND hitt.h_category_pk = lpc.h_category_pk 
-                WHERE lpc.hk_product_category_pk IS NULL;
+                SELECT DISTINCT itt.hk_product_category_pk AS hk_product_category_pk,
+                                itt.h_product_pk           AS h_product_pk,
+                                itt.h_category_pk          AS h_category_pk,
+                                NOW()                      AS load_dt,
+                                itt.load_src               AS load_src
+                FROM {items} AS itt
+                ON CONFLICT DO NOTHING;
             """
         )
 
-    def __load_satellites(self, cur: Cursor, h_order_temp_table: str, h_items_temp_table: str) -> None:
-        cur.execute(
+    # Сателлиты хранят одну актуальную строку на ключ хаба, ключ сателлита совпадает с ключом хаба.
+    # Изменения определяются по hashdiff - хэшу атрибутов, рассчитанному при заполнении временных таблиц:
+    # строки, у которых hashdiff совпадает с сохраненным, отсекаются до вставки и сателлит не пишется вовсе.
+    # По каждому ключу хаба в батче берется последняя версия атрибутов (DISTINCT ON ... ORDER BY seq DESC).
+    def __get_satellite_statements(self, orders: str, items: str) -> List[str]:
+        return self.__split(
             f"""
-                INSERT INTO dds.s_order_cost (hk_order_cost_pk, h_order_pk, cost, payment, load_dt, load_src)
-                SELECT COALESCE(soc.hk_order_cost_pk, gen_random_uuid()) AS hk_order_cost_pk,
-                       hott.h_order_pk      AS h_order_pk,
-                       hott.order_cost      AS cost,
-                       hott.order_payment   AS payment,
-                       NOW()                AS load_dt,
-                       hott.load_src        AS load_src
-                FROM {h_order_temp_table} AS hott
-                LEFT JOIN dds.s_order_cost AS soc
-                     ON hott.h_order_pk = soc.h_order_pk
-                WHERE soc.hk_order_cost_pk IS NULL 
-                    OR hott.order_cost <> soc.cost
-                    OR hott.order_payment <> soc.payment;
+                INSERT INTO dds.s_order_cost (hk_order_cost_pk, h_order_pk, cost, payment, hashdiff, load_dt, load_src)
+                SELECT ott.h_order_pk           AS hk_order_cost_pk,
+                       ott.h_order_pk           AS h_order_pk,
+                       ott.order_cost           AS cost,
+                       ott.order_payment        AS payment,
+                       ott.order_cost_hashdiff  AS hashdiff,
+                       NOW()                    AS load_dt,
+                       ott.load_src             AS load_src
+                FROM {orders} AS ott
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM dds.s_order_cost AS soc
+                                  WHERE soc.hk_order_cost_pk = ott.h_order_pk
+                                    AND soc.hashdiff = ott.order_cost_hashdiff)
+                ON CONFLICT (hk_order_cost_pk) DO UPDATE
+                SET cost = EXCLUDED.cost,
+                    payment = EXCLUDED.payment,
+                    hashdiff = EXCLUDED.hashdiff,
+                    load_dt = EXCLUDED.load_dt,
+                    load_src = EXCLUDED.load_src;
                      
-                INSERT INTO dds.s_order_status (hk_order_status_pk, h_order_pk, status, load_dt, load_src)
-                SELECT COALESCE(sos.hk_order_status_pk, gen_random_uuid()) AS hk_order_status_pk,
-                       hott.h_order_pk AS h_order_pk,
-                       hott.order_status    AS status,
-                       NOW()         AS load_dt,
-                       hott.load_src  AS load_src
-                FROM {h_order_temp_table} AS hott
-                LEFT JOIN dds.s_order_status AS sos
-                     ON hott.h_order_pk = sos.h_order_pk
-                WHERE sos.hk_order_status_pk IS NULL 
-                    OR hott.order_status <> sos.status;
+                INSERT INTO dds.s_order_status (hk_order_status_pk, h_order_pk, status, hashdiff, load_dt, load_src)
+                SELECT ott.h_order_pk             AS hk_order_status_pk,
+                       ott.h_order_pk             AS h_order_pk,
+                       ott.order_status           AS status,
+                       ott.order_status_hashdiff  AS hashdiff,
+                       NOW()                      AS load_dt,
+                       ott.load_src               AS load_src
+                FROM {orders} AS ott
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM dds.s_order_status AS sos
+                                  WHERE sos.hk_order_status_pk = ott.h_order_pk
+                                    AND sos.hashdiff = ott.order_status_hashdiff)
+                ON CONFLICT (hk_order_status_pk) DO UPDATE
+                SET status = EXCLUDED.status,
+                    hashdiff = EXCLUDED.hashdiff,
+                    load_dt = EXCLUDED.load_dt,
+                    load_src = EXCLUDED.load_src;
                      
-                INSERT INTO dds.s_restaurant_names (hk_restaurant_names_pk, h_restaurant_pk, name, load_dt, load_src)
-                SELECT COALESCE(srn.hk_restaurant_names_pk, gen_random_uuid()) AS hk_restaurant_names_pk,
-                       hott.h_restaurant_pk AS h_restaurant_pk,
-                       hott.restaurant_name AS name,
-                       NOW()                AS load_dt,
-                       hott.load_src        AS load_src
-                FROM {h_order_temp_table} AS hott
-                LEFT JOIN dds.s_restaurant_names AS srn
-                     ON hott.h_restaurant_pk = srn.h_restaurant_pk
-                WHERE srn.hk_restaurant_names_pk IS NULL 
-                    OR hott.restaurant_name <> srn.name;
+                INSERT INTO dds.s_restaurant_names (hk_restaurant_names_pk, h_restaurant_pk, name, hashdiff, load_dt, 
+                    load_src)
+                SELECT ott.h_restaurant_pk            AS hk_restaurant_names_pk,
+                       ott.h_restaurant_pk            AS h_restaurant_pk,
+                       ott.restaurant_name            AS name,
+                       ott.restaurant_names_hashdiff  AS hashdiff,
+                       NOW()                          AS load_dt,
+                       ott.load_src                   AS load_src
+                FROM (SELECT DISTINCT ON (h_restaurant_pk) * 
+                      FROM {orders} 
+                      ORDER BY h_restaurant_pk, seq DESC) AS ott
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM dds.s_restaurant_names AS srn
+                                  WHERE srn.hk_restaurant_names_pk = ott.h_restaurant_pk
+                                    AND srn.hashdiff = ott.restaurant_names_hashdiff)
+                ON CONFLICT (hk_restaurant_names_pk) DO UPDATE
+                SET name = EXCLUDED.name,
+                    hashdiff = EXCLUDED.hashdiff,
+                    load_dt = EXCLUDED.load_dt,
+                    load_src = EXCLUDED.load_src;
                     
-                INSERT INTO dds.s_user_names (hk_user_names_pk, h_user_pk, username, userlogin, load_dt, load_src)
-                SELECT COALESCE(sun.hk_user_names_pk, gen_random_uuid()) AS hk_user_names_pk,
-                       hott.h_user_pk AS h_user_pk,
-                       hott.user_name           AS username,
-                       hott.user_login           AS userlogin,
-                       NOW()              AS load_dt,
-                       hott.load_src        AS load_src
-                FROM {h_order_temp_table} AS hott
-                LEFT JOIN dds.s_user_names AS sun
-                     ON hott.h_user_pk = sun.h_user_pk
-                WHERE sun.hk_user_names_pk IS NULL 
-                    OR hott.user_name <> sun.username
-                    OR hott.user_login <> sun.userlogin;
+                INSERT INTO dds.s_user_names (hk_user_names_pk, h_user_pk, username, userlogin, hashdiff, load_dt, 
+                    load_src)
+                SELECT ott.h_user_pk            AS hk_user_names_pk,
+                       ott.h_user_pk            AS h_user_pk,
+                       ott.user_name            AS username,
+                       ott.user_login           AS userlogin,
+                       ott.user_names_hashdiff  AS hashdiff,
+                       NOW()                    AS load_dt,
+                       ott.load_src             AS load_src
+                FROM (SELECT DISTINCT ON (h_user_pk) * 
+                      FROM {orders} 
+                      ORDER BY h_user_pk, seq DESC) AS ott
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM dds.s_user_names AS sun
+                                  WHERE sun.hk_user_names_pk = ott.h_user_pk
+                                    AND sun.hashdiff = ott.user_names_hashdiff)
+                ON CONFLICT (hk_user_names_pk) DO UPDATE
+                SET username = EXCLUDED.username,
+                    userlogin = EXCLUDED.userlogin,
+                    hashdiff = EXCLUDED.hashdiff,
+                    load_dt = EXCLUDED.load_dt,
+                    load_src = EXCLUDED.load_src;
                     
-                INSERT INTO dds.s_product_names (hk_product_names_pk, h_product_pk, name, load_dt, load_src)
-                SELECT  COALESCE(spn.hk_product_names_pk, gen_random_uuid()) AS hk_product_names_pk,
-                        hitt.h_product_pk   AS h_product_pk,
-                        hitt.product_name   AS name,
-                        NOW()               AS load_dt,
-                        hitt.load_src       AS load_src
-                FROM {h_items_temp_table} hitt
-                LEFT JOIN dds.s_product_names as spn
-                    ON hitt.h_product_pk = spn.h_product_pk
-                WHERE spn.hk_product_names_pk IS NULL 
-                    OR hitt.product_name <> spn.name;
+                INSERT INTO dds.s_product_names (hk_product_names_pk, h_product_pk, name, hashdiff, load_dt, load_src)
+                SELECT itt.h_product_pk            AS hk_product_names_pk,
+                       itt.h_product_pk            AS h_product_pk,
+                       itt.product_name            AS name,
+                       itt.product_names_hashdiff  AS hashdiff,
+                       NOW()                       AS load_dt,
+                       itt.load_src                AS load_src
+                FROM (SELECT DISTINCT ON (h_product_pk) * 
+                      FROM {items} 
+                      ORDER BY h_product_pk, seq DESC) AS itt
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM dds.s_product_names AS spn
+                                  WHERE spn.hk_product_names_pk = itt.h_product_pk
+                                    AND spn.hashdiff = itt.product_names_hashdiff)
+                ON CONFLICT (hk_product_names_pk) DO UPDATE
+                SET name = EXCLUDED.name,
+                    hashdiff = EXCLUDED.hashdiff,
+                    load_dt = EXCLUDED.load_dt,
+                    load_src = EXCLUDED.load_src;
             """
         )
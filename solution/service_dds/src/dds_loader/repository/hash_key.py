@@ -0,0 +1,18 @@
+import hashlib
+import uuid
+
+HASH_KEY_DELIMITER = '||'
+
+
+# Хэш-ключ в стиле Data Vault 2.0: MD5 от бизнес-ключей, склеенных через разделитель, в виде UUID.
+# Бизнес-ключи берутся как есть, без приведения регистра: это те же значения, что лежат в UNIQUE-колонках хабов,
+# и миграция V001__dds_hash_keys.sql считает ключи существующих строк той же формулой через md5() в Postgres.
+def hash_key(*business_keys) -> uuid.UUID:
+    value = HASH_KEY_DELIMITER.join('' if key is None else str(key) for key in business_keys)
+    return uuid.UUID(hashlib.md5(value.encode()).hexdigest())
+
+
+# Хэш атрибутов сателлита для проверки изменений: одно сравнение с сохраненным хэшем
+# вместо сравнения каждой колонки через <>. Формула та же, что у hash_key.
+def hash_diff(*attributes) -> uuid.UUID:
+    return hash_key(*attributes)
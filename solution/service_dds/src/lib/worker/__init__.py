@@ -0,0 +1,3 @@
+from .coalescer import Coalescer  # noqa
+from .keyed_pool import KeyedWorkerPool  # noqa
+from .streaming_worker import StreamingWorker  # noqa
@@ -0,0 +1,42 @@
+import threading
+import time
+from typing import Any, Dict, Hashable
+
+
+# Накопитель последних значений по ключу за окно времени.
+# Повторное значение по тому же ключу заменяет предыдущее. Окно отсчитывается от первого значения после очистки;
+# накопленное пора обработать, когда окно истекло или ключей набралось max_size.
+# Накопленное не удаляется при чтении: clear() вызывается после успешной обработки,
+# чтобы при ошибке ничего не потерять.
+class Coalescer:
+    def __init__(self, window: float, max_size: int) -> None:
+        self._window = window
+        self._max_size = max_size
+        self._items: Dict[Hashable, Any] = {}
+        self._started = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if not self._items:
+                self._started = time.monotonic()
+            self._items.pop(key, None)
+            self._items[key] = value
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self._items:
+                return False
+            return len(self._items) >= self._max_size or time.monotonic() - self._started >= self._window
+
+    def items(self) -> Dict[Hashable, Any]:
+        with self._lock:
+            return dict(self._items)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
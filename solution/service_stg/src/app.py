@@ -1,13 +1,20 @@
+import atexit
 import logging
+import signal
+import sys
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask
 
 from app_config import AppConfig
+from lib.worker import StreamingWorker
 from stg_loader.stg_message_processor_job import StgMessageProcessor
 
 app = Flask(__name__)
 
+# Инициализируем конфиг. Для удобства, вынесли логику получения значений переменных окружения в отдельный класс.
+config = AppConfig()
+
 
 # Заводим endpoint для проверки, поднялся ли сервис.
 # Обратиться к нему можно будет GET-запросом по адресу localhost:5000/health.
@@ -17,29 +24,58 @@ def health():
     return 'healthy'
 
 
+# Статистика пула соединений к Postgres: размер пула, ожидающие клиенты, ошибки и т.д.
+@app.get('/stats/pg')
+def pg_stats():
+    return config.pg_warehouse_db().stats()
+
+
+# Попадания и промахи кэша справочников ресторанов и пользователей.
+@app.get('/stats/cache')
+def cache_stats():
+    return config.catalog_cache().stats()
+
+
 if __name__ == '__main__':
     # Устанавливаем уровень логгирования в Debug, чтобы иметь возможность просматривать отладочные логи.
     app.logger.setLevel(logging.DEBUG)
 
-    # Инициализируем конфиг. Для удобства, вынесли логику получения значений переменных окружения в отдельный класс.
-    config = AppConfig()
+    consumer = config.kafka_consumer(app.logger)
 
     # Инициализируем процессор сообщений. SampleMessageProcessor(app.logger)
     # Пока он пустой. Нужен для того, чтобы потом в нем писать логику обработки сообщений из Kafka.
     proc = StgMessageProcessor(
-        config.kafka_consumer(),
+        consumer,
         config.kafka_producer(),
-        config.redis_client(),
+        config.catalog_cache(),
         config.stg_repository(),
+        config.worker_pool(),
         config.batch_size,
         app.logger
     )
 
+    # Закрываем пул соединений последним, после остановки процессора.
+    atexit.register(config.pg_warehouse_db().close)
+    # Пул потоков останавливается после процессора, но до закрытия пула соединений.
+    atexit.register(config.worker_pool().close)
+    # Консьюмер закрывается после остановки процессора, но до остановки пула потоков.
+    atexit.register(consumer.close)
+
     # Запускаем процессор в бэкграунде.
-    # BackgroundScheduler будет по расписанию вызывать функцию run нашего обработчика(SampleMessageProcessor).
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=proc.run, trigger="interval", seconds=config.DEFAULT_JOB_INTERVAL)
-    scheduler.start()
+    if config.processing_mode == 'schedule':
+        # Legacy-режим: BackgroundScheduler будет по расписанию вызывать функцию run нашего обработчика.
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(func=proc.run, trigger="interval", seconds=config.DEFAULT_JOB_INTERVAL)
+        scheduler.start()
+        atexit.register(scheduler.shutdown)
+    else:
+        # StreamingWorker вызывает run в отдельном потоке, пока в топике есть сообщения.
+        worker = StreamingWorker(proc.run, app.logger, config.idle_backoff, config.max_idle_backoff)
+        worker.start()
+        atexit.register(worker.stop)
+
+    # По SIGTERM выходим через sys.exit, чтобы отработали atexit-обработчики и текущий батч успел завершиться.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
     # стартуем Flask-приложение.
     app.run(debug=True, host='0.0.0.0', use_reloader=False)
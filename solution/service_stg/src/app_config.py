@@ -1,14 +1,26 @@
 import os
+from logging import Logger
+from typing import Optional
 
 from lib.kafka_connect import KafkaConsumer, KafkaProducer
 from lib.pg import PgConnect
 from lib.redis import RedisClient
+from lib.worker import KeyedWorkerPool
+from stg_loader.catalog_cache import CatalogCache
 from stg_loader.repository.stg_repository import StgRepository
 
 
 class AppConfig:
     CERTIFICATE_PATH = '/crt/YandexInternalRootCA.crt'
     DEFAULT_JOB_INTERVAL = 25
+    DEFAULT_PROCESSING_MODE = 'stream'
+    DEFAULT_IDLE_BACKOFF = 1.0
+    DEFAULT_MAX_IDLE_BACKOFF = 30.0
+    DEFAULT_PG_POOL_MIN_SIZE = 1
+    DEFAULT_PG_POOL_MAX_SIZE = 4
+    DEFAULT_WORKER_THREADS = 1
+    DEFAULT_CATALOG_CACHE_SIZE = 1000
+    DEFAULT_CATALOG_CACHE_TTL = 300.0
 
     def __init__(self) -> None:
         self.kafka_host = str(os.getenv('KAFKA_HOST') or "")
@@ -17,21 +29,36 @@ class AppConfig:
         self.kafka_consumer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD') or "")
         self.kafka_consumer_group = str(os.getenv('KAFKA_CONSUMER_GROUP') or "")
         self.kafka_consumer_topic = str(os.getenv('KAFKA_SOURCE_TOPIC') or "")
+        self.kafka_consumer_commit_async = (os.getenv('KAFKA_COMMIT_ASYNC') or 'false').lower() == 'true'
         self.kafka_producer_username = str(os.getenv('KAFKA_CONSUMER_USERNAME') or "")
         self.kafka_producer_password = str(os.getenv('KAFKA_CONSUMER_PASSWORD') or "")
         self.kafka_producer_topic = str(os.getenv('KAFKA_DESTINATION_TOPIC') or "")
+        self.kafka_producer_pipelined = (os.getenv('KAFKA_PRODUCER_PIPELINED') or 'true').lower() == 'true'
 
         self.redis_host = str(os.getenv('REDIS_HOST') or "")
         self.redis_port = int(str(os.getenv('REDIS_PORT')) or 0)
         self.redis_password = str(os.getenv('REDIS_PASSWORD') or "")
+        self.catalog_cache_size = int(os.getenv('CATALOG_CACHE_SIZE') or self.DEFAULT_CATALOG_CACHE_SIZE)
+        self.catalog_cache_ttl = float(os.getenv('CATALOG_CACHE_TTL_SECONDS') or self.DEFAULT_CATALOG_CACHE_TTL)
+        self._catalog_cache: Optional[CatalogCache] = None
 
         self.pg_warehouse_host = str(os.getenv('PG_WAREHOUSE_HOST') or "")
         self.pg_warehouse_port = int(str(os.getenv('PG_WAREHOUSE_PORT') or 0))
         self.pg_warehouse_dbname = str(os.getenv('PG_WAREHOUSE_DBNAME') or "")
         self.pg_warehouse_user = str(os.getenv('PG_WAREHOUSE_USER') or "")
         self.pg_warehouse_password = str(os.getenv('PG_WAREHOUSE_PASSWORD') or "")
+        self.pg_pool_min_size = int(os.getenv('PG_POOL_MIN_SIZE') or self.DEFAULT_PG_POOL_MIN_SIZE)
+        self.pg_pool_max_size = int(os.getenv('PG_POOL_MAX_SIZE') or self.DEFAULT_PG_POOL_MAX_SIZE)
+        self.pg_prepare_statements = (os.getenv('PG_PREPARE_STATEMENTS') or 'false').lower() == 'true'
+        self._pg_warehouse_db: Optional[PgConnect] = None
 
         self.batch_size = int(str(os.getenv('BATCH_SIZE')))
+        self.worker_threads = int(os.getenv('WORKER_THREADS') or self.DEFAULT_WORKER_THREADS)
+        self._worker_pool: Optional[KeyedWorkerPool] = None
+
+        self.processing_mode = str(os.getenv('PROCESSING_MODE') or self.DEFAULT_PROCESSING_MODE)
+        self.idle_backoff = float(os.getenv('IDLE_BACKOFF_SECONDS') or self.DEFAULT_IDLE_BACKOFF)
+        self.max_idle_backoff = float(os.getenv('MAX_IDLE_BACKOFF_SECONDS') or self.DEFAULT_MAX_IDLE_BACKOFF)
 
     def kafka_producer(self):
         return KafkaProducer(
@@ -40,10 +67,11 @@ class AppConfig:
             self.kafka_producer_username,
             self.kafka_producer_password,
             self.kafka_producer_topic,
-            self.CERTIFICATE_PATH
+            self.CERTIFICATE_PATH,
+            self.kafka_producer_pipelined
         )
 
-    def kafka_consumer(self):
+    def kafka_consumer(self, logger: Logger) -> KafkaConsumer:
         return KafkaConsumer(
             self.kafka_host,
             self.kafka_port,
@@ -51,7 +79,9 @@ class AppConfig:
             self.kafka_consumer_password,
             self.kafka_consumer_topic,
             self.kafka_consumer_group,
-            self.CERTIFICATE_PATH
+            self.CERTIFICATE_PATH,
+            self.kafka_consumer_commit_async,
+            logger
         )
 
     def redis_client(self) -> RedisClient:
@@ -62,14 +92,37 @@ class AppConfig:
             self.CERTIFICATE_PATH
         )
 
-    def pg_warehouse_db(self):
-        return PgConnect(
-            self.pg_warehouse_host,
-            self.pg_warehouse_port,
-            self.pg_warehouse_dbname,
-            self.pg_warehouse_user,
-            self.pg_warehouse_password
-        )
+    def catalog_cache(self) -> CatalogCache:
+        if self._catalog_cache is None:
+            self._catalog_cache = CatalogCache(
+                self.redis_client(),
+                self.catalog_cache_size,
+                self.catalog_cache_ttl
+            )
+        return self._catalog_cache
+
+    # Пул соединений один на приложение - все репозитории работают через него.
+    def pg_warehouse_db(self) -> PgConnect:
+        if self._pg_warehouse_db is None:
+            self._pg_warehouse_db = PgConnect(
+                self.pg_warehouse_host,
+                self.pg_warehouse_port,
+                self.pg_warehouse_dbname,
+                self.pg_warehouse_user,
+                self.pg_warehouse_password,
+                min_size=self.pg_pool_min_size,
+                max_size=self.pg_pool_max_size,
+                prepare=self.pg_prepare_statements
+            )
+        return self._pg_warehouse_db
 
     def stg_repository(self) -> StgRepository:
         return StgRepository(self.pg_warehouse_db())
+
+    # Пул потоков обработки батча. Каждый поток держит свое соединение к Postgres,
+    # поэтому WORKER_THREADS не должен превышать PG_POOL_MAX_SIZE. При WORKER_THREADS=1 батч обрабатывается
+    # в потоке процессора, как раньше.
+    def worker_pool(self) -> KeyedWorkerPool:
+        if self._worker_pool is None:
+            self._worker_pool = KeyedWorkerPool(self.worker_threads)
+        return self._worker_pool
@@ -1 +1 @@
-from .kafka_connectors import KafkaConsumer, KafkaProducer  # noqa
\ No newline at end of file
+from .kafka_connectors import KafkaConsumer, KafkaMessage, KafkaProducer  # noqa
@@ -1,12 +1,25 @@
 from contextlib import contextmanager
-from typing import Generator
+from typing import Dict, Generator
 
-import psycopg
 from psycopg import Connection
+from psycopg_pool import ConnectionPool
 
 
 class PgConnect:
-    def __init__(self, host: str, port: int, db_name: str, user: str, pw: str, sslmode: str = "require") -> None:
+    # Сколько раз запрос выполняется без подготовки, прежде чем psycopg подготовит его сам.
+    PREPARE_THRESHOLD = 5
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 db_name: str,
+                 user: str,
+                 pw: str,
+                 sslmode: str = "require",
+                 min_size: int = 1,
+                 max_size: int = 4,
+                 prepare: bool = False
+                 ) -> None:
         self.host = host
         self.port = port
         self.db_name = db_name
@@ -14,6 +27,21 @@ class PgConnect:
         self.pw = pw
         self.sslmode = sslmode
 
+        # Соединения переиспользуются между вызовами connection(): TLS-хендшейк и авторизация
+        # в pgbouncer выполняются один раз на соединение, а не на каждое сообщение.
+        # Перед выдачей соединение проверяется, разорванные соединения пул пересоздает сам.
+        # Prepared statements по умолчанию отключены: pgbouncer в transaction-режиме до версии 1.21
+        # их не поддерживает. При prepare=False запросы с execute(..., prepare=True) выполняются без подготовки.
+        self._pool = ConnectionPool(
+            self.url(),
+            kwargs={'prepare_threshold': self.PREPARE_THRESHOLD if prepare else None},
+            min_size=min_size,
+            max_size=max_size,
+            check=ConnectionPool.check_connection,
+            name=f'{db_name}@{host}',
+            open=True
+        )
+
     def url(self) -> str:
         return """
             host={host}
@@ -31,14 +59,14 @@ class PgConnect:
             pw=self.pw,
             sslmode=self.sslmode)
 
+    # Контракт прежний: commit при успешном выходе из блока, rollback при исключении.
     @contextmanager
     def connection(self) -> Generator[Connection, None, None]:
-        conn = psycopg.connect(self.url())
-        try:
+        with self._pool.connection() as conn:
             yield conn
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        return self._pool.get_stats()
+
+    def close(self) -> None:
+        self._pool.close()
@@ -0,0 +1,2 @@
+from .keyed_pool import KeyedWorkerPool  # noqa
+from .streaming_worker import StreamingWorker  # noqa
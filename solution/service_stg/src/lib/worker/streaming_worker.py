@@ -0,0 +1,46 @@
+import threading
+from logging import Logger
+from typing import Callable
+
+
+class StreamingWorker:
+    def __init__(self,
+                 job: Callable[[], int],
+                 logger: Logger,
+                 idle_backoff: float = 1.0,
+                 max_idle_backoff: float = 30.0
+                 ) -> None:
+        self._job = job
+        self._logger = logger
+        self._idle_backoff = idle_backoff
+        self._max_idle_backoff = max_idle_backoff
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self.__loop, name='streaming-worker', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._logger.warning('Streaming job did not finish in %s seconds', timeout)
+
+    # job возвращает количество вычитанных сообщений.
+    # Пока топик отдает сообщения, вызываем job без пауз, на пустом топике ждем с экспоненциальным backoff.
+    def __loop(self) -> None:
+        backoff = self._idle_backoff
+        while not self._stop_event.is_set():
+            try:
+                consumed = self._job()
+            except Exception:
+                self._logger.exception('Streaming job failed')
+                consumed = 0
+
+            if consumed:
+                backoff = self._idle_backoff
+                continue
+
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, self._max_idle_backoff)
@@ -1,2 +1,3 @@
 from .repository import * # noqa
+from .catalog_cache import CatalogCache # noqa
 from .stg_message_processor_job import StgMessageProcessor # noqa
\ No newline at end of file
@@ -0,0 +1,53 @@
+from typing import Dict, Iterable, List, Tuple
+
+from lib.cache import TTLCache
+from lib.redis import RedisClient
+from stg_loader.repository.model import RestaurantEntry, UserEntry
+
+
+# Кэш справочников поверх Redis. Хранит уже распарсенные RestaurantEntry и UserEntry,
+# все промахи батча добираются из Redis одним mget.
+class CatalogCache:
+    def __init__(self, redis: RedisClient, max_size: int, ttl: float) -> None:
+        self._redis = redis
+        self._restaurants = TTLCache(max_size, ttl)
+        self._users = TTLCache(max_size, ttl)
+
+    def get_many(self,
+                 restaurant_ids: Iterable[str],
+                 user_ids: Iterable[str]
+                 ) -> Tuple[Dict[str, RestaurantEntry], Dict[str, UserEntry]]:
+        restaurants, missing_restaurants = self.__lookup(self._restaurants, restaurant_ids)
+        users, missing_users = self.__lookup(self._users, user_ids)
+
+        keys = missing_restaurants + missing_users
+        if keys:
+            values = self._redis.mget(*keys)
+            for restaurant_id, value in zip(missing_restaurants, values[:len(missing_restaurants)]):
+                restaurant = RestaurantEntry.from_obj(value)
+                self._restaurants.put(restaurant_id, restaurant)
+                restaurants[restaurant_id] = restaurant
+            for user_id, value in zip(missing_users, values[len(missing_restaurants):]):
+                user = UserEntry.from_obj(value)
+                self._users.put(user_id, user)
+                users[user_id] = user
+
+        return restaurants, users
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'restaurants': self._restaurants.stats(),
+            'users': self._users.stats()
+        }
+
+    @staticmethod
+    def __lookup(cache: TTLCache, ids: Iterable[str]) -> Tuple[Dict, List[str]]:
+        found = {}
+        missing = []
+        for obj_id in dict.fromkeys(ids):
+            obj = cache.get(obj_id)
+            if obj is None:
+                missing.append(obj_id)
+            else:
+                found[obj_id] = obj
+        return found, missing
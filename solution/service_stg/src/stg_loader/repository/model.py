@@ -1,6 +1,6 @@
 from datetime import datetime
 from decimal import Decimal
-from typing import List
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -29,12 +29,46 @@ class Product(BaseModelId):
 
 class Restaurant(BaseModelId):
     name: str = None
-    menu: List[Product] = None
 
-    class Config:
-        fields = {
-            'menu': {'exclude': True},
-        }
+
+# Записи справочников из Redis. Это не pydantic-модели, а компактные классы со __slots__:
+# из меню ресторана берутся только id и category, остальные поля блюд (цены, описания) не парсятся.
+class RestaurantEntry:
+    __slots__ = ('id', 'name', 'categories')
+
+    def __init__(self, id: str, name: Optional[str], categories: Dict[str, str]) -> None:
+        self.id = id
+        self.name = name
+        self.categories = categories
+
+    @classmethod
+    def from_obj(cls, obj: Dict) -> 'RestaurantEntry':
+        categories = {}
+        for product in obj.get('menu') or []:
+            categories[product.get('_id') or product.get('id')] = product.get('category')
+        return cls(obj.get('_id') or obj.get('id'), obj.get('name'), categories)
+
+    def product_category(self, product_id: str) -> Optional[str]:
+        return self.categories.get(product_id)
+
+    def to_model(self) -> Restaurant:
+        return Restaurant(id=self.id, name=self.name)
+
+
+class UserEntry:
+    __slots__ = ('id', 'name', 'login')
+
+    def __init__(self, id: str, name: Optional[str], login: Optional[str]) -> None:
+        self.id = id
+        self.name = name
+        self.login = login
+
+    @classmethod
+    def from_obj(cls, obj: Dict) -> 'UserEntry':
+        return cls(obj.get('_id') or obj.get('id'), obj.get('name'), obj.get('login'))
+
+    def to_model(self) -> User:
+        return User(id=self.id, name=self.name, login=self.login)
 
 
 class Order(BaseModel):
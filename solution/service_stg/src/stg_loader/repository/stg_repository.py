@@ -1,4 +1,4 @@
-from datetime import datetime
+from typing import List
 
 from lib.pg import PgConnect
 
@@ -7,27 +7,37 @@ class StgRepository:
     def __init__(self, db: PgConnect) -> None:
         self._db = db
 
-    def order_events_insert(self,
-                            object_id: int,
-                            object_type: str,
-                            sent_dttm: datetime,
-                            payload: str
-                            ) -> None:
+    # Пишет весь батч одним INSERT ... ON CONFLICT.
+    # На вход - исходные байты сообщений из Kafka: они склеиваются в JSON-массив и разбираются уже в Postgres,
+    # payload ложится в таблицу без повторной сериализации в Python.
+    # Одна строка не может обновиться в одном запросе дважды, поэтому по каждому object_id
+    # оставляем событие с самым поздним sent_dttm.
+    # Текст запроса не зависит от батча, поэтому при PG_PREPARE_STATEMENTS=true он готовится на сервере один раз.
+    def order_events_insert_batch(self, messages: List[bytes]) -> None:
+        if not messages:
+            return
+
         with self._db.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
                         INSERT INTO stg.order_events (object_id, object_type, sent_dttm, payload)
-                        VALUES (%(object_id)s, %(object_type)s, %(sent_dttm)s, %(payload)s)
+                        SELECT DISTINCT ON (e.object_id) e.object_id, e.object_type, e.sent_dttm, e.payload
+                        FROM (SELECT (m ->> 'object_id')::INT          AS object_id,
+                                     m ->> 'object_type'               AS object_type,
+                                     (m ->> 'sent_dttm')::TIMESTAMP    AS sent_dttm,
+                                     m -> 'payload'                    AS payload,
+                                     n                                 AS n
+                              FROM json_array_elements(convert_from(%(messages)s, 'UTF8')::JSON) 
+                                  WITH ORDINALITY AS t(m, n)) AS e
+                        ORDER BY e.object_id, e.sent_dttm DESC, e.n DESC
                         ON CONFLICT(object_id) DO UPDATE 
                             SET object_type = EXCLUDED.object_type, 
                                 sent_dttm  = EXCLUDED.sent_dttm, 
                                 payload  = EXCLUDED.payload;
                     """,
                     {
-                        'object_id': object_id,
-                        'object_type': object_type,
-                        'sent_dttm': sent_dttm,
-                        'payload': payload
-                    }
+                        'messages': b'[' + b','.join(messages) + b']'
+                    },
+                    prepare=True
                 )
@@ -1,42 +1,41 @@
-import json
 from datetime import datetime
 from logging import Logger
-from typing import Dict, Tuple, List
+from typing import Dict, List
 
-from lib.kafka_connect.kafka_connectors import KafkaConsumer, KafkaProducer
-from lib.redis.redis_client import RedisClient
-from stg_loader.repository.model import User, Restaurant, OutputMessage, Order, Product
+from lib.kafka_connect.kafka_connectors import KafkaConsumer, KafkaMessage, KafkaProducer
+from lib.worker import KeyedWorkerPool
+from stg_loader.catalog_cache import CatalogCache
+from stg_loader.repository.model import UserEntry, RestaurantEntry, OutputMessage, Order, Product
 from stg_loader.repository.stg_repository import StgRepository
 
 
-def get_products(payload: Dict, menu: List[Product]) -> List[Product]:
+def get_products(payload: Dict, restaurant: RestaurantEntry) -> List[Product]:
     products = []
     for item in payload.get('order_items'):
         product = Product.parse_obj(item)
-        for i in menu:
-            if product.id == i.id:
-                product.category = i.category
-                break
+        category = restaurant.product_category(product.id)
+        if category is not None:
+            product.category = category
         products.append(product)
     return products
 
 
-def get_order(message: Dict, restaurant: Restaurant, user: User) -> Order:
+def get_order(message: Dict, restaurant: RestaurantEntry, user: UserEntry) -> Order:
     payload = message.get('payload')
-    products = get_products(payload, restaurant.menu)
+    products = get_products(payload, restaurant)
     return Order(
         id=message.get('object_id'),
         date=payload.get('date'),
         cost=payload.get('cost'),
         payment=payload.get('payment'),
         status=payload.get('final_status'),
-        restaurant=restaurant,
-        user=user,
+        restaurant=restaurant.to_model(),
+        user=user.to_model(),
         products=products
     )
 
 
-def get_output_message(message: Dict, restaurant: Restaurant, user: User) -> OutputMessage:
+def get_output_message(message: Dict, restaurant: RestaurantEntry, user: UserEntry) -> OutputMessage:
     return OutputMessage(
         object_id=message.get('object_id'),
         object_type=message.get('object_type'),
@@ -48,46 +47,63 @@ class StgMessageProcessor:
     def __init__(self,
                  consumer: KafkaConsumer,
                  producer: KafkaProducer,
-                 redis: RedisClient,
+                 catalog_cache: CatalogCache,
                  stg_repository: StgRepository,
+                 worker_pool: KeyedWorkerPool,
                  batch_size: int,
                  logger: Logger) -> None:
         self._logger = logger
         self._consumer = consumer
         self._producer = producer
-        self._redis = redis
+        self._catalog_cache = catalog_cache
         self._stg_repository = stg_repository
+        self._worker_pool = worker_pool
         self._batch_size = batch_size
 
-    # функция, которая будет вызываться по расписанию.
-    def run(self) -> None:
+    # функция, которая будет вызываться по расписанию или в цикле StreamingWorker.
+    # Возвращает количество вычитанных из топика сообщений.
+    def run(self) -> int:
         # Пишем в лог, что джоб был запущен.
         self._logger.info(f"{datetime.utcnow()}: START")
 
-        for _ in range(self._batch_size):
-            message = self._consumer.consume()
-            if not message:
-                break
-            if message.get("object_type") != "order":
-                continue
-            self.__save_message_to_stg(message)
-            restaurant, user = self.__get_catalogs(message)
-            output_message = get_output_message(message, restaurant, user)
-            self._producer.produce(output_message.dict())
+        # Забираем из Kafka сразу пачку сообщений, чтобы платить за fetch один раз на батч.
+        messages = self._consumer.consume_raw_batch(self._batch_size)
+        try:
+            # Заказы раскладываются по потокам по object_id: версии одного заказа обрабатываются по порядку.
+            self._worker_pool.map(messages, lambda message: message.json().get('object_id'), self.__process_batch)
+            self.__flush()
+        except Exception:
+            # Возвращаем консьюмер на начало батча, чтобы следующий run обработал его заново.
+            self._consumer.rewind()
+            raise
+
+        # Офсеты коммитим только после того, как батч записан в Postgres и доставлен в Kafka.
+        self._consumer.commit()
 
         # Пишем в лог, что джоб успешно завершен.
         self._logger.info(f"{datetime.utcnow()}: FINISH")
+        return len(messages)
 
-    def __save_message_to_stg(self, message: Dict) -> None:
-        self._stg_repository.order_events_insert(
-            message.get('object_id'),
-            message.get('object_type'),
-            message.get('sent_dttm'),
-            json.dumps(message.get('payload'))
+    def __process_batch(self, messages: List[KafkaMessage]) -> None:
+        raw_orders = [message for message in messages if message.json().get("object_type") == "order"]
+        # В STG пишем исходные байты сообщений, JSON из них Postgres разберет сам.
+        self._stg_repository.order_events_insert_batch([message.value for message in raw_orders])
+        orders = [message.json() for message in raw_orders]
+
+        restaurants, users = self._catalog_cache.get_many(
+            [message.get('payload').get('restaurant').get('id') for message in orders],
+            [message.get('payload').get('user').get('id') for message in orders]
         )
+        for message in orders:
+            payload = message.get('payload')
+            restaurant = restaurants[payload.get('restaurant').get('id')]
+            user = users[payload.get('user').get('id')]
+            output_message = get_output_message(message, restaurant, user)
+            # Ключ - номер заказа: все версии заказа читает один экземпляр DDS-Service, по порядку.
+            self._producer.produce(output_message.dict(), key=str(message.get('object_id')))
 
-    def __get_catalogs(self, message: Dict) -> Tuple[Restaurant, User]:
-        restaurant_id = message.get('payload').get('restaurant').get('id')
-        user_id = message.get('payload').get('user').get('id')
-        restaurant_args, user_args = self._redis.mget(restaurant_id, user_id)
-        return Restaurant.parse_obj(restaurant_args), User.parse_obj(user_args)
+    # Дожидаемся подтверждения доставки всего батча.
+    def __flush(self) -> None:
+        delivery_errors = self._producer.flush()
+        if delivery_errors:
+            raise Exception(f'Failed to deliver messages: {delivery_errors}')